@@ -1,8 +1,8 @@
 import os
 import json
-import sys
 from flask import (
     Flask,
+    Response,
     request,
     abort,
     render_template,
@@ -10,11 +10,56 @@ from flask import (
     session,
     redirect,
     url_for,
-    jsonify
+    jsonify,
+    g
+)
+from models import (
+    database_path,
+    setup_db,
+    db_drop_and_create_all,
+    db,
+    tables_committed,
+    Actor,
+    Casting,
+    ImportJob,
+    Movie
 )
-from models import setup_db, db_drop_and_create_all, setup_db, Actor, Movie
 from flask_cors import CORS, cross_origin
-from auth import AuthError, requires_auth
+from auth import (
+    AuthError,
+    check_permissions,
+    permission_set,
+    requires_auth
+)
+from bulk import PartialBulkWrite, bulk_delete, bulk_insert, bulk_update
+from casting import actors_by_movie, add_to_cast, include_args
+from encoding import init_encoding
+from export import ndjson_response, wants_ndjson
+from filters import actor_filters, filter_key, movie_filters
+from http_cache import conditional
+from imports import start_import, upload_format
+from instrumentation import init_instrumentation
+from metrics import (
+    METRICS_ALLOW,
+    allowed_networks,
+    render as render_metrics,
+    scrape_allowed
+)
+from response_cache import make_cache
+import schemas
+from schemas import MAX_CONTENT_LENGTH, ValidationError, validate_body
+from search import search, search_args
+from updates import if_match_versions, update_returning
+from projection import Projection, field_args
+from rate_limit import RateLimitError, init_rate_limit
+from replicas import use_primary
+from pagination import (
+    COUNT_CACHE_TTL,
+    CountCache,
+    keyset_page,
+    page_args,
+    wants_total
+)
 from authlib.integrations.flask_client import OAuth
 from urllib.parse import urlencode
 
@@ -32,8 +77,66 @@ def create_app(test_config=None):
     app = Flask(__name__)
     app.secret_key = SECRET_KEY
     app.config['SECRET_KEY'] = SECRET_KEY
-    setup_db(app)
+    app.config['RESPONSE_CACHE'] = os.getenv('RESPONSE_CACHE', 'memory')
+    app.config['JSON_BACKEND'] = os.getenv('JSON_BACKEND', 'auto')
+    app.config['MAX_CONTENT_LENGTH'] = int(
+        os.getenv('MAX_CONTENT_LENGTH', MAX_CONTENT_LENGTH))
+    app.config['METRICS'] = os.getenv(
+        'METRICS', 'false').lower() in ('1', 'true')
+    app.config['METRICS_ALLOW'] = os.getenv('METRICS_ALLOW', METRICS_ALLOW)
+    if test_config is not None:
+        app.config.update(test_config)
+    setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
     CORS(app)
+    init_instrumentation(app)
+    init_encoding(app)
+    init_rate_limit(app)
+    init_login(app)
+
+    # listing responses, dropped when a commit changes their tables
+    response_cache = make_cache(app.config)
+    app.extensions['response_cache'] = response_cache
+    if response_cache is not None:
+        tables_committed.connect(
+            lambda sender, tables: response_cache.invalidate(tables),
+            app, weak=False)
+
+    # totals are optional on the listings and cached between requests,
+    # dropped when a commit changes their table (POST, PATCH, DELETE, bulk
+    # writes and imports alike)
+    counts = CountCache(app.config.get('COUNT_CACHE_TTL', COUNT_CACHE_TTL))
+    counted = {Movie.__tablename__: 'movies', Actor.__tablename__: 'actors'}
+
+    def invalidate_counts(sender, tables):
+        for name in tables:
+            if name in counted:
+                counts.invalidate(counted[name])
+
+    tables_committed.connect(invalidate_counts, app, weak=False)
+
+    def import_upload(kind, payload):
+        file_format = upload_format(request.mimetype,
+                                    request.args.get('filename'))
+        if file_format is None:
+            abort(415)
+        job = start_import(kind, request.stream, file_format,
+                           payload.get('sub'))
+        running = job.status in ('pending', 'running')
+        return jsonify({
+            'success': True,
+            'import': job.format()
+        }), 202 if running else 201, {
+            'Location': url_for('get_import', job_id=job.id)}
+
+    def write_bulk(write, model, items):
+        try:
+            return write(model, items)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception(e)
+            if isinstance(e, PartialBulkWrite):
+                raise
+            abort(422)
 
     @app.after_request
     def after_request(response):
@@ -54,6 +157,19 @@ def create_app(test_config=None):
             'date': '2023-03-14'
         }), 200
 
+    if app.config['METRICS']:
+        scrapers = allowed_networks(app.config['METRICS_ALLOW'])
+
+        @app.route('/metrics')
+        def metrics():
+            '''
+            Prometheus scrape, for the addresses in METRICS_ALLOW only
+            '''
+            if not scrape_allowed(request.remote_addr, scrapers):
+                abort(404)
+            body, content_type = render_metrics(app)
+            return Response(body, content_type=content_type)
+
     """
     @TODO:
     Create an endpoint to handle GET requests
@@ -62,71 +178,180 @@ def create_app(test_config=None):
     @app.route('/movies', methods=['GET'])
     @cross_origin()
     @requires_auth(permission='get:movies')
+    @conditional(Movie, include={'actors': ('get:actors', (Actor, Casting))})
     def get_movie(payload):
-        try:
-            movies = Movie.query.order_by(Movie.id).all()
-            movies_data = list(map(lambda movie: movie.format(), movies))
+        projection = Projection(Movie, field_args(Movie))
+        criteria = movie_filters()
+        # permission to include them was checked by @conditional
+        include = include_args('actors')
+        query = projection.query().filter(*criteria)
+        if wants_ndjson():
+            return ndjson_response(
+                query.order_by(Movie.id), projection.to_dict)
+
+        limit, after_id = page_args()
+        rows, next_cursor = keyset_page(query, Movie.id, limit, after_id)
+        movies_data = [projection.to_dict(row) for row in rows]
+        if include:
+            cast = actors_by_movie([row.id for row in rows])
+            for movie, row in zip(movies_data, rows):
+                movie['actors'] = cast[row.id]
+
+        app.logger.debug('Movies: %s', movies_data)
+
+        if len(movies_data) == 0:
+            abort(404)
 
-            print('Movies: {}'.format(movies_data))
+        body = {
+            'success': True,
+            'movies': movies_data,
+            'next_cursor': next_cursor
+        }
+        if wants_total():
+            body['total_movies'] = counts.get(
+                filter_key('movies'), Movie.query.filter(*criteria).count)
 
-            if len(movies_data) == 0:
-                abort(404)
+        return jsonify(body)
 
-            return jsonify({
-                'success': True,
-                'movies': movies_data,
-                'total_movies': len(movies_data)
-            })
+    @app.route('/movies/export', methods=['GET'])
+    @cross_origin()
+    @requires_auth(permission='get:movies')
+    @conditional(Movie)
+    def export_movies(payload):
+        '''
+        Stream every movie as newline-delimited JSON, filtered like
+        GET /movies
+        '''
+        projection = Projection(Movie, field_args(Movie))
+        query = projection.query().filter(*movie_filters())
+        return ndjson_response(query.order_by(Movie.id), projection.to_dict)
 
-        except Exception as e:
-            print(sys.exc_info())
-            abort(422)
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @cross_origin()
+    @requires_auth('get:movies', 'get:actors')
+    @conditional(Movie, Actor, Casting)
+    def get_movie_actors(payload, movie_id):
+        '''
+        A page of the actors cast in a movie
+        '''
+        if db.session.query(Movie.id).filter(
+                Movie.id == movie_id).one_or_none() is None:
+            abort(404)
 
-    @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+        projection = Projection(Actor, field_args(Actor))
+        query = projection.query() \
+            .join(Casting, Casting.actor_id == Actor.id) \
+            .filter(Casting.movie_id == movie_id)
+        limit, after_id = page_args()
+        rows, next_cursor = keyset_page(query, Actor.id, limit, after_id)
+
+        return jsonify({
+            'success': True,
+            'movie': movie_id,
+            'actors': [projection.to_dict(row) for row in rows],
+            'next_cursor': next_cursor
+        }), 200
+
+    @app.route('/movies/<int:movie_id>/cast', methods=['POST'])
     @cross_origin()
-    @requires_auth(permission='patch:movies')
-    def update_movie(payload, movie_id):
+    @validate_body(schemas.ACTOR_IDS)
+    @requires_auth('patch:movies')
+    def cast_movie(payload, movie_id, body):
+        '''
+        Add actors to a movie's cast
+        '''
+        actor_ids = body
+        movie = Movie.query.get(movie_id)
+        if movie is None:
+            abort(404)
 
-        try:
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        return jsonify({
+            'success': True,
+            'movie': movie_id,
+            'added': add_to_cast(movie, actor_ids)
+        }), 200
 
-            if movie is None:
-                abort(404)
+    @app.route('/movies/<int:movie_id>/cast/<int:actor_id>',
+               methods=['DELETE'])
+    @cross_origin()
+    @requires_auth('patch:movies')
+    def uncast_movie(payload, movie_id, actor_id):
+        '''
+        Remove an actor from a movie's cast
+        '''
+        casting = Casting.query.get((movie_id, actor_id))
+        if casting is None:
+            abort(404)
 
-            print('Movie: {}'.format(movie))
-            movie = Movie(
-                title=request.json['title'],
-                release_date=request.json['release_year']
-            )
-            movie.update()
+        db.session.delete(casting)
+        db.session.commit()
 
-            return jsonify({
-                'success': True,
-                'movie': movie_id
-            }), 200
+        return jsonify({
+            'success': True,
+            'movie': movie_id,
+            'removed': actor_id
+        }), 200
 
-        except Exception as e:
-            print(e)
-            abort(422)
+    @app.route('/search', methods=['GET'])
+    @cross_origin()
+    @requires_auth('get:movies', 'get:actors', match='any')
+    def search_cast(payload):
+        '''
+        Ranked title and name search over the movies and actors the
+        caller may read
+        '''
+        terms, kinds, limit, cursor = search_args()
+        granted = permission_set(payload)
+        if len(kinds) == 1:
+            check_permissions('get:' + kinds[0], payload, granted)
+        kinds = [kind for kind in kinds if 'get:' + kind in granted]
+
+        results, next_cursor, truncated = search(
+            terms, kinds, limit, cursor)
+        return jsonify({
+            'success': True,
+            'results': results,
+            'next_cursor': next_cursor,
+            'truncated': truncated
+        }), 200
+
+    @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+    @cross_origin()
+    @validate_body(schemas.MOVIE_PATCH)
+    @requires_auth(permission='patch:movies')
+    def update_movie(payload, movie_id, body):
+        '''
+        Update the fields sent for one movie; with If-Match, only if it
+        is still at that version
+        '''
+        versions = if_match_versions()
+        movie = update_returning(Movie, movie_id, body, versions)
+        app.logger.debug('Movie: %s', movie)
+
+        response = jsonify({
+            'success': True,
+            'movie': movie_id,
+            'updated': movie
+        })
+        response.set_etag(str(movie['version']))
+        return response
 
     @app.route('/movies', methods=['POST'])
     @cross_origin()
+    @validate_body(schemas.MOVIE)
     @requires_auth('post:movies')
-    def add_movie(payload):
+    def add_movie(payload, body):
         '''
         Add a new movie to the database
         '''
 
         # add user-submitted data and commit to db
-        movie = Movie(
-            title=request.json['title'],
-            release_date=request.json['release_year']
-        )
-
         try:
+            movie = Movie(**body)
             movie.insert()
 
-        except BaseException:
+        except Exception as e:
+            app.logger.exception(e)
             abort(422)
 
         return jsonify({
@@ -134,6 +359,54 @@ def create_app(test_config=None):
             'movie': movie.id
         }), 200
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @cross_origin()
+    @validate_body(schemas.MOVIES)
+    @requires_auth('post:movies')
+    def add_movies(payload, body):
+        '''
+        Add a batch of movies in one transaction
+        '''
+        results = write_bulk(bulk_insert, Movie, body)
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @cross_origin()
+    @validate_body(schemas.MOVIES_PATCH)
+    @requires_auth(permission='patch:movies')
+    def update_movies(payload, body):
+        results = write_bulk(bulk_update, Movie, body)
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @cross_origin()
+    @validate_body(schemas.IDS)
+    @requires_auth(permission='delete:movies')
+    def delete_movies(payload, body):
+        results = write_bulk(bulk_delete, Movie, body)
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    @app.route('/movies/import', methods=['POST'])
+    @cross_origin()
+    @requires_auth('post:movies')
+    def import_movies(payload):
+        '''
+        Load a CSV or NDJSON file of movies sent as the request body
+        '''
+        return import_upload('movies', payload)
+
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @cross_origin()
     @requires_auth(permission='delete:movies')
@@ -156,33 +429,80 @@ def create_app(test_config=None):
             }), 200
 
         except Exception as e:
-            print(e)
+            app.logger.exception(e)
             abort(422)
 
     @app.route('/actors', methods=['GET'])
     @cross_origin()
     @requires_auth('get:actors')
+    @conditional(Actor)
     def get_actors(payload):
-        actors = Actor.query.all()
-        actors_data = list(map(lambda actor: actor.format(), actors))
+        projection = Projection(Actor, field_args(Actor))
+        criteria = actor_filters()
+        query = projection.query().filter(*criteria)
+        if wants_ndjson():
+            return ndjson_response(
+                query.order_by(Actor.id), projection.to_dict)
+
+        limit, after_id = page_args()
+        rows, next_cursor = keyset_page(query, Actor.id, limit, after_id)
+        actors_data = [projection.to_dict(row) for row in rows]
 
-        # print actors
-        print('Actors: {}'.format(actors_data))
+        app.logger.debug('Actors: %s', actors_data)
 
         if len(actors_data) == 0:
             abort(404)
 
-        return jsonify({
+        body = {
             "success": True,
-            "actors": actors_data
-        }), 200
+            "actors": actors_data,
+            "next_cursor": next_cursor
+        }
+        if wants_total():
+            body['total_actors'] = counts.get(
+                filter_key('actors'), Actor.query.filter(*criteria).count)
+
+        return jsonify(body), 200
+
+    @app.route('/actors/export', methods=['GET'])
+    @cross_origin()
+    @requires_auth('get:actors')
+    @conditional(Actor)
+    def export_actors(payload):
+        '''
+        Stream every actor as newline-delimited JSON, filtered like
+        GET /actors
+        '''
+        projection = Projection(Actor, field_args(Actor))
+        query = projection.query().filter(*actor_filters())
+        return ndjson_response(query.order_by(Actor.id), projection.to_dict)
+
+    @app.route('/actors/<int:actor_id>', methods=['PATCH'])
+    @cross_origin()
+    @validate_body(schemas.ACTOR_PATCH)
+    @requires_auth(permission='patch:actors')
+    def update_actor(payload, actor_id, body):
+        '''
+        Update the fields sent for one actor; with If-Match, only if they
+        are still at that version
+        '''
+        versions = if_match_versions()
+        actor = update_returning(Actor, actor_id, body, versions)
+
+        response = jsonify({
+            'success': True,
+            'actor': actor_id,
+            'updated': actor
+        })
+        response.set_etag(str(actor['version']))
+        return response
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @cross_origin()
     @requires_auth(permission='delete:actors')
     def delete_actor(payload, actor_id):
         try:
-            print('Actor ID: {}'.format(actor_id))
+            app.logger.debug('Actor ID: %s', actor_id)
             actor = Actor.query.filter(
                 Actor.id == actor_id).one_or_none()
 
@@ -200,25 +520,20 @@ def create_app(test_config=None):
             })
 
         except Exception as e:
-            print(e)
+            app.logger.exception(e)
             abort(422)
 
     @app.route('/actors/create', methods=['POST'])
     @cross_origin()
+    @validate_body(schemas.ACTOR)
     @requires_auth('post:actors')
-    def add_actor(payload):
-
-        if request.json['name'] == '' or request.json['gender'] == '' or request.json['age'] == '':
-            abort(422)
+    def add_actor(payload, body):
         try:
-            actor = Actor(
-                gender=request.json['gender'],
-                name=request.json['name'],
-                age=request.json['age'])
+            actor = Actor(**body)
             actor.insert()
 
         except Exception as e:
-            print(e)
+            app.logger.exception(e)
             abort(422)
 
         return jsonify({
@@ -226,6 +541,76 @@ def create_app(test_config=None):
             "created_actor_id": actor.id
         }), 200
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @cross_origin()
+    @validate_body(schemas.ACTORS)
+    @requires_auth('post:actors')
+    def add_actors(payload, body):
+        '''
+        Add a batch of actors in one transaction
+        '''
+        results = write_bulk(bulk_insert, Actor, body)
+
+        return jsonify({
+            "success": True,
+            "results": results
+        }), 200
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @cross_origin()
+    @validate_body(schemas.ACTORS_PATCH)
+    @requires_auth(permission='patch:actors')
+    def update_actors(payload, body):
+        results = write_bulk(bulk_update, Actor, body)
+
+        return jsonify({
+            "success": True,
+            "results": results
+        }), 200
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @cross_origin()
+    @validate_body(schemas.IDS)
+    @requires_auth(permission='delete:actors')
+    def delete_actors(payload, body):
+        results = write_bulk(bulk_delete, Actor, body)
+
+        return jsonify({
+            "success": True,
+            "results": results
+        }), 200
+
+    @app.route('/actors/import', methods=['POST'])
+    @cross_origin()
+    @requires_auth('post:actors')
+    def import_actors(payload):
+        '''
+        Load a CSV or NDJSON file of actors sent as the request body
+        '''
+        return import_upload('actors', payload)
+
+    @app.route('/imports/<int:job_id>', methods=['GET'])
+    @cross_origin()
+    @requires_auth('post:movies', 'post:actors', match='any')
+    def get_import(payload, job_id):
+        '''
+        Progress of an import, then its outcome and rejected rows. Only
+        the caller who started it, while still allowed to import that kind,
+        can see a job; anyone else gets a 404. Read from the primary:
+        import_jobs isn't a versioned table, so starting one doesn't pin
+        the caller, and a replica may not have the job or its progress yet
+        '''
+        use_primary()
+        job = ImportJob.query.get(job_id)
+        if job is None or job.subject != payload.get('sub') or \
+                'post:' + job.kind not in g.permissions:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'import': job.format()
+        }), 200
+
     """
     @TODO:
     Create error handlers for all expected errors
@@ -247,6 +632,14 @@ def create_app(test_config=None):
             'message': 'Not found'
         }), 404
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            'success': False,
+            'error': 412,
+            'message': 'Precondition failed'
+        }), 412
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -255,6 +648,57 @@ def create_app(test_config=None):
             'message': 'Unprocessable'
         }), 422
 
+    @app.errorhandler(428)
+    def precondition_required(error):
+        return jsonify({
+            'success': False,
+            'error': 428,
+            'message': 'Precondition required'
+        }), 428
+
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return jsonify({
+            'success': False,
+            'error': 413,
+            'message': 'Request body too large'
+        }), 413
+
+    @app.errorhandler(415)
+    def unsupported_media_type(error):
+        return jsonify({
+            'success': False,
+            'error': 415,
+            'message': 'Unsupported media type'
+        }), 415
+
+    @app.errorhandler(ValidationError)
+    def validation_error(error):
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': error.message,
+            'errors': error.errors
+        }), 422
+
+    @app.errorhandler(PartialBulkWrite)
+    def partial_bulk_write(error):
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'The batch failed after %d items were written; '
+                       'those stay written.' % len(error.results),
+            'results': error.results
+        }), 422
+
+    @app.errorhandler(RateLimitError)
+    def rate_limited(error):
+        return jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'Too many requests'
+        }), 429, {'Retry-After': error.retry_after_header}
+
     @app.errorhandler(AuthError)
     def authorization_error(error):
         return jsonify({
@@ -266,54 +710,71 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
-oauth = OAuth(app)
-
-auth0 = oauth.register(
-    'auth0',
-    client_id=AUTH0_CLIENT_ID,
-    client_secret=AUTH0_CLIENT_SECRET,
-    api_base_url=AUTH0_BASE_URL,
-    access_token_url='https://dev-2rphxhqkvfsgcgle.us.auth0.com' +
-    '/oauth/token',
-    authorize_url='https://dev-2rphxhqkvfsgcgle.us.auth0.com' +
-    '/authorize',
-    client_kwargs={
-        'scope': 'openid profile email'})
-
-
-@app.route('/login', methods=['GET'])
-@cross_origin()
-def login():
-    print('Audience: {}'.format(API_AUDIENCE))
-    return auth0.authorize_redirect(
-        redirect_uri='%s/post-login' % AUTH0_CALLBACK_URL,
-        audience=API_AUDIENCE
-    )
-
-
-@app.route('/post-login', methods=['GET'])
-@cross_origin()
-def post_login():
-    token = auth0.authorize_access_token()
-    session['token'] = token['access_token']
-    print(session['token'])
-    return render_template('pages/home.html'), 200
-
-
-@app.route('/logout')
-def log_out():
-    session.clear()
-    params = {
-        'returnTo': url_for(
-            'index',
-            _external=True),
-        'client_id': AUTH0_CLIENT_ID}
-    return redirect(
-        'https://dev-2rphxhqkvfsgcgle.us.auth0.com' +
-        '/v2/logout?' +
-        urlencode(params))
+# the Auth0 client for the login pages, registered on first use so that
+# building an app needs neither the Auth0 settings nor the network
+oauth = OAuth()
+
+
+def auth0_client():
+    client = oauth.create_client('auth0')
+    if client is None:
+        client = oauth.register(
+            'auth0',
+            client_id=AUTH0_CLIENT_ID,
+            client_secret=AUTH0_CLIENT_SECRET,
+            api_base_url=AUTH0_BASE_URL,
+            access_token_url='https://dev-2rphxhqkvfsgcgle.us.auth0.com' +
+            '/oauth/token',
+            authorize_url='https://dev-2rphxhqkvfsgcgle.us.auth0.com' +
+            '/authorize',
+            client_kwargs={
+                'scope': 'openid profile email'})
+    return client
+
+
+def init_login(app):
+    oauth.init_app(app)
+
+    @app.route('/login', methods=['GET'])
+    @cross_origin()
+    def login():
+        app.logger.debug('Audience: %s', API_AUDIENCE)
+        return auth0_client().authorize_redirect(
+            redirect_uri='%s/post-login' % AUTH0_CALLBACK_URL,
+            audience=API_AUDIENCE
+        )
+
+    @app.route('/post-login', methods=['GET'])
+    @cross_origin()
+    def post_login():
+        token = auth0_client().authorize_access_token()
+        session['token'] = token['access_token']
+        return render_template('pages/home.html'), 200
+
+    @app.route('/logout')
+    def log_out():
+        session.clear()
+        params = {
+            'returnTo': url_for(
+                'index',
+                _external=True),
+            'client_id': AUTH0_CLIENT_ID}
+        return redirect(
+            'https://dev-2rphxhqkvfsgcgle.us.auth0.com' +
+            '/v2/logout?' +
+            urlencode(params))
+
+
+def __getattr__(name):
+    '''
+    `app.app` (gunicorn app:app, manage.py) is built on first access
+    rather than at import, so importing this module has no side effects
+    '''
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
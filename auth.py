@@ -1,14 +1,61 @@
-import json
-from flask import request, _request_ctx_stack, abort
+import logging
+import time
+from flask import request, abort, g
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 import os
 
+import metrics
+from instrumentation import current_timings
+from jwks import JWKSCache
+from rate_limit import rate_limiter
+from token_cache import TokenCache
+
 
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = os.getenv('ALGORITHMS')
 API_AUDIENCE = os.getenv('API_AUDIENCE')
+logger = logging.getLogger(__name__)
+
+JWKS_URL = os.getenv(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+# signing keys are cached per process, see jwks.py
+jwks = JWKSCache(
+    JWKS_URL,
+    ttl=int(os.getenv('JWKS_CACHE_TTL', 600)),
+    refresh_margin=int(os.getenv('JWKS_REFRESH_MARGIN', 60)),
+    min_refetch_interval=int(os.getenv('JWKS_MIN_REFETCH_INTERVAL', 30)),
+    on_fetch=lambda ok: metrics.JWKS_FETCHES.labels(
+        'ok' if ok else 'error').inc())
+
+# verified payloads of recently seen tokens, see token_cache.py
+token_cache = TokenCache(maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 1024)))
+
+
+'''
+configure(domain, audience, algorithms, jwks_url)
+    points the module at a different issuer (e.g. a local one in tests)
+    and drops everything cached for the previous one
+'''
+
+
+def configure(domain=None, audience=None, algorithms=None, jwks_url=None):
+    global AUTH0_DOMAIN, API_AUDIENCE, ALGORITHMS
+
+    if domain is not None:
+        AUTH0_DOMAIN = domain
+        if jwks_url is None:
+            jwks_url = f'https://{domain}/.well-known/jwks.json'
+    if audience is not None:
+        API_AUDIENCE = audience
+    if algorithms is not None:
+        ALGORITHMS = algorithms
+    if jwks_url is not None:
+        jwks.url = jwks_url
+        jwks.clear()
+    token_cache.clear()
+
 
 # AuthError Exception
 '''
@@ -70,8 +117,12 @@ def get_token_auth_header():
 '''
 @TODO implement check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'), or a collection
+            of them
         payload: decoded jwt payload
+        granted: the payload's permissions as a frozenset, if already
+            computed (see permission_set)
+        match: 'all' if every permission is required, 'any' if one will do
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
@@ -80,15 +131,36 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
-
+def permission_set(payload):
     if 'permissions' not in payload:
+        return None
+    return frozenset(payload['permissions'])
+
+
+def required_permissions(permission):
+    if isinstance(permission, str):
+        return frozenset((permission,))
+    return frozenset(permission)
+
+
+def check_permissions(permission, payload, granted=None, match='all'):
+
+    if granted is None:
+        granted = permission_set(payload)
+
+    if granted is None:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    required = required_permissions(permission)
+    if match == 'any':
+        allowed = not required or not granted.isdisjoint(required)
+    else:
+        allowed = required <= granted
+
+    if not allowed:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -104,6 +176,7 @@ def check_permissions(permission, payload):
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        (keys come from the process-wide `jwks` cache)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -114,9 +187,6 @@ def check_permissions(permission, payload):
 
 def verify_decode_jwt(token):
 
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
     try:
         unverified_header = jwt.get_unverified_header(token)
     except jwt.JWTError:
@@ -125,23 +195,13 @@ def verify_decode_jwt(token):
             'description': 'Invalid header.'
         }, 401)
 
-    rsa_key = {}
-
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks.get_key(unverified_header['kid'])
 
     if rsa_key:
         try:
@@ -180,31 +240,100 @@ def verify_decode_jwt(token):
     raise Exception('Not Implemented')
 
 
+'''
+decode_token(token)
+    verify_decode_jwt() behind the token cache: a token that was verified
+    before and hasn't expired is returned without touching its signature
+
+    returns (payload, permissions) where permissions is the frozenset
+    built once per token by permission_set()
+'''
+
+
+def decode_token(token):
+    entry = token_cache.get(token)
+    if entry is None:
+        start = time.perf_counter()
+        try:
+            payload = verify_decode_jwt(token)
+        finally:
+            metrics.AUTH_STAGE_TIME.labels('verify_decode_jwt').observe(
+                time.perf_counter() - start)
+        entry = (payload, permission_set(payload))
+        token_cache.put(token, entry, payload.get('exp'))
+    return entry
+
+
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
+        *permissions: further permissions the endpoint needs
+        match: 'all' (default) to require every permission, 'any' for one
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        (through decode_token so repeat tokens hit the token cache)
+    it should charge the caller's rate limit, if any (see rate_limit.py)
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
 
 
-def requires_auth(permission=''):
+def requires_auth(permission='', *permissions, match='all'):
+    if match not in ('all', 'any'):
+        raise ValueError(f'match must be "all" or "any", not {match!r}')
+
+    # built once per endpoint rather than once per request
+    required = required_permissions((permission,) + permissions)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
+            start = time.perf_counter()
+            limiter = rate_limiter()
+            limit = limiter and limiter.limit_for(required)
             try:
-                payload = verify_decode_jwt(token)
-            except BaseException:
-                abort(401)
-            print("PAYLOAD PERMISSION: " + ' '.join(str(item) for item in payload['permissions']))
-            print("PERMISSION: " + permission)
-            check_permissions(permission, payload)
+                token = get_token_auth_header()
+                address = 'ip:%s' % request.remote_addr
+                if limit is not None and token not in token_cache:
+                    # charged before anything verifies the token, and
+                    # refused if tokens from this address keep failing
+                    limiter.check(address, limit)
+                    limiter.charge(
+                        'token:' + token_cache.key(token).hex(), limit)
+                try:
+                    payload, granted = decode_token(token)
+                except BaseException as e:
+                    metrics.AUTH_ERRORS.labels(
+                        e.error['code'] if isinstance(e, AuthError)
+                        else 'invalid_token').inc()
+                    if limit is not None:
+                        limiter.charge(address, limit)
+                    abort(401)
+                if limit is not None:
+                    limiter.charge('sub:%s' % payload.get('sub'), limit)
+                logger.debug('Token permissions: %s, required (%s): %s',
+                             granted, match, required)
+                check_permissions(required, payload, granted, match)
+            except AuthError as e:
+                metrics.AUTH_ERRORS.labels(e.error['code']).inc()
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                metrics.AUTH_STAGE_TIME.labels('requires_auth').observe(
+                    elapsed)
+                timings = current_timings()
+                if timings is not None:
+                    timings.auth_time += elapsed
+
+            # what the caller was granted, e.g. for cache keys
+            g.permissions = granted
+            # who is asking, e.g. to pin recent writers to the primary
+            g.subject = payload.get('sub')
             return f(payload, *args, **kwargs)
 
+        # marks the view as authenticated, see rate_limit.py
+        wrapper.required_permissions = required
         return wrapper
     return requires_auth_decorator
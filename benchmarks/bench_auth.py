@@ -0,0 +1,62 @@
+'''
+Microbenchmark: cost of requires_auth per request with and without the
+verified-token cache.
+
+    python -m benchmarks.bench_auth [iterations]
+
+Tokens are minted by a LocalIssuer and its keys served from a file://
+JWKS, so no network access is needed and the JWKS fetch is paid once
+for both runs; the difference is the RS256 verification the token cache
+avoids.
+'''
+import os
+import sys
+import tempfile
+import time
+
+from flask import Flask
+
+import auth
+from local_auth import LocalIssuer
+
+
+def run(iterations):
+    issuer = LocalIssuer()
+    tmp = tempfile.TemporaryDirectory()
+    auth.configure(
+        domain=issuer.domain,
+        audience=issuer.audience,
+        algorithms=['RS256'],
+        jwks_url=issuer.write_jwks(os.path.join(tmp.name, 'jwks.json')))
+
+    app = Flask(__name__)
+    token = issuer.token(['get:movies'])
+    headers = {'Authorization': 'Bearer ' + token}
+
+    @auth.requires_auth('get:movies')
+    def endpoint(payload):
+        return payload
+
+    def measure(maxsize):
+        auth.token_cache.maxsize = maxsize
+        auth.token_cache.clear()
+        with app.test_request_context('/movies', headers=headers):
+            endpoint()  # warm up the JWKS cache
+            start = time.perf_counter()
+            for _ in range(iterations):
+                endpoint()
+            return (time.perf_counter() - start) / iterations
+
+    uncached = measure(0)
+    cached = measure(1024)
+    tmp.cleanup()
+
+    print(f'iterations:        {iterations}')
+    print(f'uncached per call: {uncached * 1e6:10.1f} us')
+    print(f'cached per call:   {cached * 1e6:10.1f} us')
+    print(f'speedup:           {uncached / cached:10.1f}x')
+    print(f'cache stats:       {auth.token_cache.stats()}')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
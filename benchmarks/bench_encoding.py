@@ -0,0 +1,75 @@
+'''
+Benchmark: size and CPU cost of encoding a movie listing as the API
+sends it, at several table sizes.
+
+    python -m benchmarks.bench_encoding [rows,rows,...]
+
+For each size, rows shaped like GET /movies (see projection.py) are
+encoded pretty-printed (what jsonify used to send in debug mode),
+compact with the standard library, and compact with orjson, then the
+compact body is gzipped and brotli-compressed at the levels encoding.py
+uses. Reports bytes and milliseconds per step; orjson and brotli rows
+are skipped when they aren't installed (requirements-speedups.txt).
+'''
+import json
+import sys
+import time
+from datetime import date, timedelta
+
+import encoding
+
+
+def listing(rows):
+    first = date(1950, 1, 1)
+    return {'movies': [{
+        'id': i,
+        'title': 'Movie title number %d' % i,
+        'release_year': (first + timedelta(days=i % 25000)).isoformat(),
+        'version': 1 + i % 3} for i in range(1, rows + 1)],
+        'next_cursor': rows, 'success': True}
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run(sizes):
+    steps = [
+        ('pretty json', lambda v: json.dumps(
+            v, indent=2, separators=(', ', ': '), sort_keys=True).encode()),
+        ('compact json', lambda v: encoding.AppJSONEncoder(
+            sort_keys=True).encode(v).encode()),
+    ]
+    if encoding.orjson is not None:
+        steps.append(('compact orjson', lambda v: encoding.FastAppJSONEncoder(
+            sort_keys=True).encode(v).encode()))
+
+    print(f'{"rows":>8} {"step":<16} {"bytes":>12} {"ms":>9}')
+    for rows in sizes:
+        value = listing(rows)
+        compact = None
+        for name, encode in steps:
+            body, seconds = timed(lambda: encode(value))
+            compact = body if name == 'compact json' else compact
+            print(f'{rows:>8} {name:<16} {len(body):>12,} '
+                  f'{seconds * 1000:>9.2f}')
+
+        codings = [('gzip', 'gzip')]
+        if encoding.brotli is not None:
+            codings.append(('brotli', 'br'))
+        for name, coding in codings:
+            body, seconds = timed(lambda: encoding.compressor(
+                coding, {}).finish(compact))
+            print(f'{rows:>8} {"+ " + name:<16} {len(body):>12,} '
+                  f'{seconds * 1000:>9.2f}')
+
+
+if __name__ == '__main__':
+    run([int(size) for size in sys.argv[1].split(',')]
+        if len(sys.argv) > 1 else [100, 1000, 10000, 100000])
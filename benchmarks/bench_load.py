@@ -0,0 +1,214 @@
+'''
+Load test: drives every route of an app built by create_app() over real
+HTTP at several concurrency levels and reports latency percentiles,
+throughput and peak RSS as JSON, so runs can be diffed between releases.
+
+    python -m benchmarks.bench_load [--rows N] [--database-url URL]
+        [--concurrency 1,8,32] [--requests N] [--output FILE]
+
+Tokens come from a LocalIssuer and its keys from a file:// JWKS, so no
+Auth0 account or network access is needed. Without --database-url the
+app runs against a fresh SQLite file; a local Postgres URL is used as
+is, after dropping and recreating the tables. The server is werkzeug's
+threaded server in this process, so peak RSS covers the app and the
+client threads together.
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import requests
+from werkzeug.serving import make_server
+
+import auth
+from app import create_app
+from local_auth import LocalIssuer
+from models import Actor, Movie, db
+
+PERMISSIONS = ('get:movies', 'get:actors', 'post:movies', 'post:actors',
+               'patch:movies', 'delete:movies', 'delete:actors')
+
+
+def seed(rows, chunk=10000):
+    for model, row in ((Movie, lambda i: {
+            'title': 'Movie %d' % i, 'release_date': date(2020, 1, 1)}),
+            (Actor, lambda i: {
+                'name': 'Actor %d' % i, 'age': 30, 'gender': 'female'})):
+        table = model.__table__
+        for start in range(0, rows, chunk):
+            db.session.execute(table.insert(), [
+                row(i) for i in range(start, min(start + chunk, rows))])
+    db.session.commit()
+
+
+def scenarios(rows):
+    '''
+    (name, method, path for the i-th request, JSON body or None)
+
+    DELETE walks the seeded movies from the top down, so the load test
+    needs at least as many rows as DELETE requests.
+    '''
+    return (
+        ('GET /movies', 'GET', lambda i: '/movies', None),
+        ('GET /actors', 'GET', lambda i: '/actors', None),
+        ('POST /actors/create', 'POST', lambda i: '/actors/create',
+         {'name': 'Load Actor', 'age': '40', 'gender': 'male'}),
+        ('PATCH /movies/<id>', 'PATCH',
+         lambda i: '/movies/%d' % (i % rows + 1),
+         {'title': 'Patched', 'release_year': '2021-01-01'}),
+        ('DELETE /movies/<id>', 'DELETE',
+         lambda i: '/movies/%d' % (rows - i), None),
+    )
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def drive(base_url, headers, name, method, path, body, total, concurrency,
+          offset):
+    local = threading.local()
+    latencies = [None] * total
+    statuses = {}
+    lock = threading.Lock()
+
+    def one(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+            session.headers.update(headers)
+        start = time.perf_counter()
+        response = session.request(method, base_url + path(offset + i),
+                                   json=body)
+        latencies[i] = time.perf_counter() - start
+        with lock:
+            statuses[response.status_code] = \
+                statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+
+    ordered = sorted(latencies)
+    return {
+        'route': name,
+        'concurrency': concurrency,
+        'requests': total,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 1),
+        'p50_ms': round(percentile(ordered, .50) * 1000, 2),
+        'p95_ms': round(percentile(ordered, .95) * 1000, 2),
+        'p99_ms': round(percentile(ordered, .99) * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+        'status': {str(code): count for code, count in sorted(
+            statuses.items())},
+        'peak_rss_mib': round(peak_rss_mib(), 1)
+    }
+
+
+def run(rows, database_url, levels, total):
+    tmp = tempfile.TemporaryDirectory()
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tmp.name, 'load.db')
+
+    deletes = total * len(levels)
+    if rows < deletes:
+        raise SystemExit(f'--rows must be at least {deletes} '
+                         f'(one movie per DELETE request)')
+
+    issuer = LocalIssuer()
+    auth.configure(
+        domain=issuer.domain,
+        audience=issuer.audience,
+        algorithms=['RS256'],
+        jwks_url=issuer.write_jwks(os.path.join(tmp.name, 'jwks.json')))
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        seed(rows)
+        seed_seconds = time.perf_counter() - start
+        db.session.remove()
+
+    # one access log line per request would dominate the run
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+    headers = {'Authorization': 'Bearer ' + issuer.token(PERMISSIONS)}
+
+    results = []
+    try:
+        for name, method, path, body in scenarios(rows):
+            offset = 0
+            for concurrency in levels:
+                results.append(drive(base_url, headers, name, method, path,
+                                     body, total, concurrency, offset))
+                offset += total
+    finally:
+        server.shutdown()
+        thread.join()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+        tmp.cleanup()
+
+    return {
+        'database': database_url.split(':', 1)[0],
+        'rows': rows,
+        'seed_seconds': round(seed_seconds, 2),
+        'python': platform.python_version(),
+        'results': results,
+        'peak_rss_mib': round(peak_rss_mib(), 1)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='movies and actors to seed (default 10000)')
+    parser.add_argument('--database-url', default=None,
+                        help='database to test against (default: SQLite)')
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help='comma-separated client thread counts')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and concurrency level')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    report = run(args.rows, args.database_url, levels, args.requests)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+Benchmark: cost of one page of GET /movies at different depths of a
+large table, keyset (after_id) against OFFSET.
+
+    python -m benchmarks.bench_pagination [rows] [database_url]
+
+Seeds `rows` movies (default 1,000,000) into a SQLite file unless a
+database URL is given. Keyset pages should cost the same at the start
+and the end of the table; OFFSET pages grow with their position.
+'''
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+from flask import Flask
+
+from models import Movie, db, setup_db
+from pagination import keyset_page
+
+PAGE_SIZE = 50
+REPEAT = 20
+
+
+def seed(rows, chunk=50000):
+    table = Movie.__table__
+    for start in range(0, rows, chunk):
+        db.session.execute(table.insert(), [
+            {'title': 'Movie %d' % i, 'release_date': date(2020, 1, 1)}
+            for i in range(start, min(start + chunk, rows))])
+    db.session.commit()
+
+
+def timed(fn):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        fn()
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def run(rows, database_url=None):
+    tmp = tempfile.TemporaryDirectory()
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tmp.name, 'bench.db')
+
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        seed(rows)
+        print(f'seeded {rows} rows in {time.perf_counter() - start:.1f}s')
+
+        print(f'{"position":>10} {"keyset ms":>10} {"offset ms":>10}')
+        for position in (0, rows // 2, rows - PAGE_SIZE):
+            keyset = timed(lambda: [m.format() for m in keyset_page(
+                Movie.query, Movie.id, PAGE_SIZE, position)[0]])
+            offset = timed(lambda: [m.format() for m in Movie.query.order_by(
+                Movie.id).offset(position).limit(PAGE_SIZE).all()])
+            print(f'{position:>10} {keyset:>10.2f} {offset:>10.2f}')
+
+        db.session.remove()
+        db.drop_all()
+    tmp.cleanup()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,75 @@
+'''
+Benchmark: serializing a large listing from hydrated ORM instances
+(Movie.query + Movie.format) against the column projection used by
+GET /movies.
+
+    python -m benchmarks.bench_projection [rows] [database_url]
+
+Reports rows/sec for query + dict building + JSON encoding, and the peak
+memory allocated while doing it (tracemalloc).
+'''
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from flask import Flask
+
+from models import Movie, db, setup_db
+from projection import Projection
+from benchmarks.bench_pagination import seed
+
+
+def orm_listing():
+    return json.dumps([movie.format() for movie in
+                       Movie.query.order_by(Movie.id).all()])
+
+
+def projected_listing():
+    projection = Projection(Movie)
+    rows = projection.query().order_by(Movie.id).all()
+    return json.dumps([projection.to_dict(row) for row in rows])
+
+
+def measure(fn, rows):
+    db.session.expunge_all()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+
+    db.session.expunge_all()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return rows / elapsed, peak / 2 ** 20
+
+
+def run(rows, database_url=None):
+    tmp = tempfile.TemporaryDirectory()
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tmp.name, 'bench.db')
+
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(rows)
+
+        print(f'{"read path":>10} {"rows/sec":>12} {"peak MiB":>10}')
+        for name, fn in (('orm', orm_listing),
+                         ('projected', projected_listing)):
+            rate, peak = measure(fn, rows)
+            print(f'{name:>10} {rate:>12,.0f} {peak:>10.1f}')
+
+        db.session.remove()
+        db.drop_all()
+    tmp.cleanup()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+        sys.argv[2] if len(sys.argv) > 2 else None)
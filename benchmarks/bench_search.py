@@ -0,0 +1,59 @@
+'''
+Benchmark: GET /search query cost on a large table.
+
+    python -m benchmarks.bench_search [rows] [database_url]
+
+Seeds `rows` movies (default 1,000,000) into a SQLite file unless a
+database URL is given, then times a rare word, a common word and a
+two-word prefix query through the full-text index. A rare word should
+cost about the same at any table size; for a word every row shares,
+FTS5 scores every match but only the SEARCH_MAX_CANDIDATES best are
+sorted and joined to the table.
+'''
+import os
+import sys
+import tempfile
+import time
+
+from flask import Flask
+
+from models import db, setup_db
+from search import search
+from benchmarks.bench_pagination import seed
+
+REPEAT = 20
+QUERIES = (('rare word', ['123457']),
+           ('common word', ['movie']),
+           ('two-word prefix', ['mov', '99999']))
+
+
+def run(rows, database_url=None):
+    tmp = tempfile.TemporaryDirectory()
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tmp.name, 'bench.db')
+
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        seed(rows)
+        print(f'seeded {rows} rows in {time.perf_counter() - start:.1f}s')
+
+        print(f'{"query":>16} {"ms":>10} {"results":>8}')
+        for name, terms in QUERIES:
+            start = time.perf_counter()
+            for _ in range(REPEAT):
+                results, _, _ = search(terms, ['movies'], 20)
+            elapsed = (time.perf_counter() - start) / REPEAT * 1000
+            print(f'{name:>16} {elapsed:>10.2f} {len(results):>8}')
+
+        db.session.remove()
+        db.drop_all()
+    tmp.cleanup()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        sys.argv[2] if len(sys.argv) > 2 else None)
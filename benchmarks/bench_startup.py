@@ -0,0 +1,178 @@
+'''
+Benchmark: what a worker pays before it serves its first request.
+
+    python -m benchmarks.bench_startup [--database-url URL] [--runs 5]
+        [--workers 4] [--output FILE]
+
+Each run starts a fresh interpreter, as a gunicorn worker without
+--preload does, and times `import app`, create_app() and the first
+authenticated GET /movies (which opens the first database connection
+and loads the JWKS). Then gunicorn is started with --workers workers,
+with and without PRELOAD_APP, and timed to its first response and to
+each worker being ready to serve. Tokens come from a LocalIssuer with a
+file:// JWKS, so neither Auth0 nor the network is needed.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from flask import Flask
+
+from local_auth import LocalIssuer
+from models import db, setup_db
+from benchmarks.bench_workers import ROOT, free_port
+from benchmarks.bench_load import seed
+
+WORKER = '''
+import json, os, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+response = application.test_client().get(
+    '/movies', headers={'Authorization': 'Bearer ' + os.environ['TOKEN']})
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (served - created) * 1000,
+                  'total_ms': (served - start) * 1000}))
+'''
+
+
+def worker_startup(env, runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', WORKER], cwd=ROOT,
+                                env=env, check=True, capture_output=True,
+                                text=True).stdout
+        samples.append(json.loads(output))
+    return {name: round(statistics.median(s[name] for s in samples), 1)
+            for name in samples[0]}
+
+
+# gunicorn.conf.py plus a hook noting when each worker is ready to serve
+CONFIG = '''
+exec(open(%(config)r).read())
+
+
+def post_worker_init(worker):
+    import time
+    with open(%(ready)r, 'a') as f:
+        f.write('%%d %%f\\n' %% (worker.pid, time.time()))
+'''
+
+
+def gunicorn_startup(env, workers, preload, tmp):
+    port = free_port()
+    config = os.path.join(tmp, 'gunicorn.bench.py')
+    ready = os.path.join(tmp, 'ready-%s' % preload)
+    with open(config, 'w') as f:
+        f.write(CONFIG % {
+            'config': os.path.join(ROOT, 'gunicorn.conf.py'),
+            'ready': ready})
+    env = dict(env, PORT=str(port), WEB_CONCURRENCY=str(workers),
+               PRELOAD_APP='true' if preload else 'false')
+    url = 'http://127.0.0.1:%d/movies' % port
+    headers = {'Authorization': 'Bearer ' + env['TOKEN']}
+
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', config,
+         '--bind', '127.0.0.1:%d' % port, '--log-level', 'warning',
+         'app:app'], cwd=ROOT, env=env)
+    try:
+        first = None
+        while first is None:
+            if process.poll() is not None:
+                raise SystemExit(f'gunicorn exited with {process.returncode}')
+            if time.time() - start > 60:
+                raise SystemExit('gunicorn did not start')
+            try:
+                if requests.get(url, headers=headers,
+                                timeout=5).status_code == 200:
+                    first = time.time() - start
+            except requests.RequestException:
+                time.sleep(0.01)
+
+        times = []
+        while len(times) < workers and time.time() - start < 60:
+            with open(ready) as f:
+                times = [float(line.split()[1]) for line in f]
+            time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait()
+    return {'preload': preload, 'workers': workers,
+            'first_response_ms': round(first * 1000, 1),
+            'workers_ready_ms': [round((t - start) * 1000, 1)
+                                 for t in sorted(times)]}
+
+
+def run(database_url, runs, workers):
+    tmp = tempfile.TemporaryDirectory()
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tmp.name, 'bench.db')
+
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(100)
+        db.session.remove()
+
+    issuer = LocalIssuer()
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        AUTH0_DOMAIN=issuer.domain,
+        API_AUDIENCE=issuer.audience,
+        ALGORITHMS='RS256',
+        JWKS_URL=issuer.write_jwks(os.path.join(tmp.name, 'jwks.json')),
+        TOKEN=issuer.token(['get:movies']))
+
+    try:
+        report = {
+            'database': database_url.split(':', 1)[0],
+            'worker': worker_startup(env, runs),
+            'gunicorn': [gunicorn_startup(env, workers, preload, tmp.name)
+                         for preload in (False, True)]
+        }
+    finally:
+        with app.app_context():
+            db.drop_all()
+        tmp.cleanup()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database-url', default=None,
+                        help='database to serve (default: SQLite)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='fresh interpreters to time (default 5)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn workers (default 4)')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    text = json.dumps(run(args.database_url, args.runs, args.workers),
+                      indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
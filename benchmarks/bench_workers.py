@@ -0,0 +1,151 @@
+'''
+Benchmark: GET /movies throughput as client concurrency grows, under
+gunicorn with sync workers against gthread and gevent workers.
+
+    python -m benchmarks.bench_workers [--database-url URL] [--rows N]
+        [--workers 2] [--worker-classes sync,gthread,gevent]
+        [--concurrency 1,8,32,64] [--requests N] [--output FILE]
+
+Each worker class gets a fresh gunicorn (gunicorn.conf.py, the same
+number of workers) serving app:app, with tokens from a LocalIssuer and
+its keys from a file:// JWKS. Sync workers stop scaling at the worker
+count; gevent keeps scaling for as long as requests spend their time
+waiting on the network, so run it against Postgres to see the
+difference; on SQLite every query holds the CPU. gevent needs
+requirements-gevent.txt installed.
+'''
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from flask import Flask
+
+from local_auth import LocalIssuer
+from models import db, setup_db
+from benchmarks.bench_load import drive, seed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(worker_class, workers, env):
+    port = free_port()
+    env = dict(env, PORT=str(port), WEB_CONCURRENCY=str(workers),
+               WORKER_CLASS=worker_class, THREADS='8')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--bind', '127.0.0.1:%d' % port, '--log-level', 'warning',
+         'app:app'], cwd=ROOT, env=env)
+
+    base_url = 'http://127.0.0.1:%d' % port
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'gunicorn ({worker_class}) exited with '
+                             f'{process.returncode}')
+        try:
+            requests.get(base_url + '/', timeout=5)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    process.wait()
+    raise SystemExit(f'gunicorn ({worker_class}) did not start')
+
+
+def run(database_url, rows, workers, worker_classes, levels, total):
+    tmp = tempfile.TemporaryDirectory()
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tmp.name, 'bench.db')
+
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(rows)
+        db.session.remove()
+
+    issuer = LocalIssuer()
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        AUTH0_DOMAIN=issuer.domain,
+        API_AUDIENCE=issuer.audience,
+        ALGORITHMS='RS256',
+        JWKS_URL=issuer.write_jwks(os.path.join(tmp.name, 'jwks.json')),
+        RESPONSE_CACHE='none')
+    headers = {'Authorization': 'Bearer ' + issuer.token(['get:movies'])}
+
+    results = []
+    try:
+        for worker_class in worker_classes:
+            process, base_url = start_gunicorn(worker_class, workers, env)
+            try:
+                for concurrency in levels:
+                    result = drive(base_url, headers, 'GET /movies', 'GET',
+                                   lambda i: '/movies', None, total,
+                                   concurrency, 0)
+                    del result['peak_rss_mib']  # the client's, not gunicorn's
+                    result['worker_class'] = worker_class
+                    results.append(result)
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        with app.app_context():
+            db.drop_all()
+        tmp.cleanup()
+
+    return {
+        'database': database_url.split(':', 1)[0],
+        'rows': rows,
+        'workers': workers,
+        'results': results
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database-url', default=None,
+                        help='database to serve (default: SQLite)')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='movies and actors to seed (default 1000)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn workers per run (default 2)')
+    parser.add_argument('--worker-classes', default='sync,gthread,gevent',
+                        help='comma-separated gunicorn worker classes')
+    parser.add_argument('--concurrency', default='1,8,32,64',
+                        help='comma-separated client thread counts')
+    parser.add_argument('--requests', type=int, default=400,
+                        help='requests per worker class and concurrency')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = run(args.database_url, args.rows, args.workers,
+                 args.worker_classes.split(','),
+                 [int(level) for level in args.concurrency.split(',')],
+                 args.requests)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
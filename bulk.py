@@ -0,0 +1,157 @@
+from flask import current_app
+from sqlalchemy import select
+
+from models import Casting, db, touch
+from schemas import ValidationError
+
+BULK_CHUNK_SIZE = 1000
+
+'''
+BulkError
+    raised when a batch that passed its schema (see schemas.py) can't be
+    written as a whole; `errors` lists the offending items as
+    {'index': i, 'errors': {field: message}}
+
+PartialBulkWrite
+    raised when a chunk fails after earlier ones were committed (with
+    BULK_COMMIT_EACH_CHUNK): `results` holds the results of the items that
+    were written and stay written
+'''
+
+
+class BulkError(ValidationError):
+    pass
+
+
+class PartialBulkWrite(Exception):
+    def __init__(self, results):
+        self.results = results
+
+
+'''
+bulk_insert(model, mappings) / bulk_update(model, mappings) /
+bulk_delete(model, ids)
+    write a batch validated by schemas.Items / schemas.Ids and return one
+    result per item, in order
+
+    rows are written BULK_CHUNK_SIZE at a time, without the per-object
+    unit of work, and committed once at the end, or after every chunk when
+    BULK_COMMIT_EACH_CHUNK is set. Inserts are one Core statement per chunk
+    (see _insert_chunk), updates use the session's bulk mappings. Neither
+    fires the flush events, so the table version is bumped here, and
+    updated rows get their version bumped by one query-level UPDATE per
+    chunk.
+    Updates and deletes report ids that don't exist as 'not_found' instead
+    of failing the whole batch. Deletes take the rows' castings with them,
+    as the ORM cascade does for single deletes.
+
+    a chunk that fails after others were committed raises
+    PartialBulkWrite with the results of those, so the caller can tell the
+    client what was written.
+'''
+
+
+def bulk_insert(model, mappings):
+    def insert(chunk):
+        ids = _insert_chunk(model, chunk)
+        touch(model)
+        return [{'id': id, 'status': 'created'} for id in ids]
+
+    return _write(mappings, insert)
+
+
+def bulk_update(model, mappings):
+    def update(chunk):
+        existing = _existing_ids(model, [mapping['id'] for mapping in chunk])
+        if existing:
+            db.session.bulk_update_mappings(model, [
+                mapping for mapping in chunk if mapping['id'] in existing])
+            model.query.filter(model.id.in_(existing)).update(
+                {model.version: model.version + 1},
+                synchronize_session=False)
+        return [{
+            'id': mapping['id'],
+            'status': 'updated' if mapping['id'] in existing else 'not_found'
+        } for mapping in chunk]
+
+    return _write(mappings, update)
+
+
+def bulk_delete(model, ids):
+    def delete(chunk):
+        existing = _existing_ids(model, chunk)
+        if existing:
+            _delete_castings(model, existing)
+            model.query.filter(model.id.in_(existing)).delete(
+                synchronize_session=False)
+        return [{
+            'id': id,
+            'status': 'deleted' if id in existing else 'not_found'
+        } for id in chunk]
+
+    return _write(ids, delete)
+
+
+def _write(items, write_chunk):
+    commit_each_chunk = current_app.config.get(
+        'BULK_COMMIT_EACH_CHUNK', False)
+    results = []
+    committed = 0
+    try:
+        for chunk in _chunks(items):
+            results.extend(write_chunk(chunk))
+            if commit_each_chunk:
+                db.session.commit()
+                committed = len(results)
+            else:
+                db.session.flush()
+        db.session.commit()
+    except Exception as e:
+        if committed:
+            raise PartialBulkWrite(_indexed(results[:committed])) from e
+        raise
+    return _indexed(results)
+
+
+def _insert_chunk(model, chunk):
+    '''
+    inserts `chunk` and returns the new ids, in order
+    '''
+    table = model.__table__
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        # one multi-row INSERT ... RETURNING
+        return [id for (id,) in connection.execute(
+            table.insert().values(chunk).returning(table.c.id))]
+
+    # one executemany; SQLite hands out ids above the largest, and the
+    # transaction holds the write lock until it ends, so the newest
+    # len(chunk) ids are this chunk's
+    connection.execute(table.insert(), chunk)
+    newest = connection.execute(select([table.c.id]).order_by(
+        table.c.id.desc()).limit(len(chunk)))
+    return sorted(id for (id,) in newest)
+
+
+def _delete_castings(model, ids):
+    key = Casting.KEYS.get(model.__tablename__)
+    if key is not None:
+        Casting.query.filter(getattr(Casting, key).in_(ids)).delete(
+            synchronize_session=False)
+
+
+def _existing_ids(model, ids):
+    return {id for (id,) in
+            db.session.query(model.id).filter(model.id.in_(ids))}
+
+
+def _chunks(items):
+    size = current_app.config.get('BULK_CHUNK_SIZE', BULK_CHUNK_SIZE)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _indexed(results):
+    for index, result in enumerate(results):
+        result['index'] = index
+    return results
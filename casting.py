@@ -0,0 +1,71 @@
+from flask import abort, request
+
+from bulk import BulkError
+from models import Actor, Casting, db
+from projection import Projection
+
+'''
+include_args(*allowed)
+    the related collections asked for with ?include=actors, checked
+    against `allowed`; aborts with 400 on anything else
+'''
+
+
+def include_args(*allowed):
+    value = request.args.get('include')
+    if not value:
+        return ()
+    names = tuple(dict.fromkeys(
+        name.strip() for name in value.split(',') if name.strip()))
+    if any(name not in allowed for name in names):
+        abort(400)
+    return names
+
+
+'''
+actors_by_movie(movie_ids)
+    {movie id: [actor dict, ...]} for the given movies, in actor id order
+
+    one query for the whole page however many movies it holds, the same
+    select-IN that selectinload() issues, but on the projected columns
+    the listings already work with rather than ORM instances
+'''
+
+
+def actors_by_movie(movie_ids):
+    cast = {movie_id: [] for movie_id in movie_ids}
+    if not cast:
+        return cast
+
+    projection = Projection(Actor)
+    rows = db.session.query(Casting.movie_id, *projection.columns) \
+        .join(Actor, Actor.id == Casting.actor_id) \
+        .filter(Casting.movie_id.in_(cast)) \
+        .order_by(Casting.movie_id, Actor.id)
+    for row in rows:
+        cast[row[0]].append(projection.to_dict(row[1:]))
+    return cast
+
+
+'''
+add_to_cast(movie, actor_ids)
+    casts the given actors in `movie` and returns the ids that weren't in
+    its cast already; raises BulkError, writing nothing, if any actor
+    doesn't exist
+'''
+
+
+def add_to_cast(movie, actor_ids):
+    existing = {id for (id,) in db.session.query(Actor.id).filter(
+        Actor.id.in_(actor_ids))}
+    errors = [{'index': index, 'errors': {'id': 'Actor not found.'}}
+              for index, id in enumerate(actor_ids) if id not in existing]
+    if errors:
+        raise BulkError('Some actors could not be found.', errors)
+
+    cast = {id for (id,) in db.session.query(Casting.actor_id).filter(
+        Casting.movie_id == movie.id)}
+    added = [id for id in dict.fromkeys(actor_ids) if id not in cast]
+    db.session.add_all([Casting(movie.id, id) for id in added])
+    db.session.commit()
+    return added
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+'''
+Connection pool settings
+    each can be set in the app config (e.g. create_app's test_config) or
+    the environment, config first:
+
+    DB_POOL_SIZE          connections kept open per worker (5)
+    DB_MAX_OVERFLOW       extra connections allowed under load (10)
+    DB_POOL_TIMEOUT       seconds to wait for a free connection (30)
+    DB_POOL_RECYCLE       seconds after which a connection is replaced,
+                          keep it under the server's idle timeout (1800)
+    DB_POOL_PRE_PING      test connections on checkout so ones dropped
+                          while idle are replaced, not failed (true)
+    DB_STATEMENT_TIMEOUT  Postgres statement_timeout in ms, 0 for none (0)
+
+    any other create_engine() arguments go in the DB_ENGINE_OPTIONS dict.
+'''
+
+POOL_SETTINGS = (
+    ('DB_POOL_SIZE', 'pool_size', int, 5),
+    ('DB_MAX_OVERFLOW', 'max_overflow', int, 10),
+    ('DB_POOL_TIMEOUT', 'pool_timeout', float, 30),
+    ('DB_POOL_RECYCLE', 'pool_recycle', int, 1800),
+)
+
+
+def setting(config, name, cast, default):
+    value = config.get(name)
+    if value is None:
+        value = os.getenv(name)
+    if value is None:
+        return default
+    if cast is bool and isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return cast(value)
+
+
+def engine_options(config, database_uri):
+    '''
+    returns SQLALCHEMY_ENGINE_OPTIONS for `database_uri`
+    '''
+    options = dict(config.get('DB_ENGINE_OPTIONS') or {})
+    options.setdefault('pool_pre_ping', setting(
+        config, 'DB_POOL_PRE_PING', bool, True))
+
+    if not database_uri:
+        return options
+    url = make_url(database_uri)
+    if url.get_backend_name() == 'sqlite':
+        # Flask-SQLAlchemy picks SQLite's pool itself
+        return options
+
+    options.setdefault('poolclass', InstrumentedQueuePool)
+    for name, option, cast, default in POOL_SETTINGS:
+        options.setdefault(option, setting(config, name, cast, default))
+
+    statement_timeout = setting(config, 'DB_STATEMENT_TIMEOUT', int, 0)
+    if statement_timeout and url.get_backend_name() == 'postgresql':
+        connect_args = dict(options.get('connect_args') or {})
+        connect_args['options'] = ('%s -c statement_timeout=%d' % (
+            connect_args.get('options', ''), statement_timeout)).strip()
+        options['connect_args'] = connect_args
+    return options
+
+
+'''
+InstrumentedQueuePool
+    QueuePool that also records how long checkouts wait for a connection
+    (including opening a new one) and how many give up with a timeout
+'''
+
+
+class InstrumentedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+
+'''
+pool_stats(engine)
+    live numbers for `engine`'s pool, for sizing workers against the
+    database's max_connections
+'''
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0)
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update({
+            'checkouts': pool.checkouts,
+            'timeouts': pool.timeouts,
+            'wait_seconds_total': pool.wait_time,
+            'wait_seconds_max': pool.max_wait
+        })
+    return stats
@@ -0,0 +1,168 @@
+import json
+import zlib
+
+from flask import request
+from flask.json import JSONEncoder
+
+from instrumentation import TimedJSONEncoder
+
+try:
+    import orjson
+except ImportError:  # see requirements-speedups.txt
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+NDJSON = 'application/x-ndjson'
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = ('application/json', NDJSON)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+'''
+Response encoding
+    compact JSON for every response, through orjson when it is installed,
+    and gzip or brotli compression negotiated with Accept-Encoding
+
+    JSON_BACKEND picks the encoder: 'auto' (orjson if importable, the
+    default) or 'json' (the standard library). Either way responses have
+    no indentation or spaces, even in debug mode, and decode to the same
+    values; orjson falls back to the standard library for anything it
+    can't encode.
+
+    JSON and NDJSON responses of at least COMPRESS_MIN_SIZE bytes are
+    compressed with brotli (when installed) or gzip, whichever the client
+    prefers; streamed exports are compressed chunk by chunk, flushed after
+    every batch so clients still get rows as they are read. Set
+    COMPRESS_MIN_SIZE to None to turn compression off, e.g. behind a proxy
+    that compresses already.
+'''
+
+
+class CompactJSONEncoder(JSONEncoder):
+
+    fast = False
+
+    def __init__(self, **kwargs):
+        # jsonify asks for indentation in debug mode
+        kwargs.update(indent=None, separators=(',', ':'))
+        super().__init__(**kwargs)
+
+    def encode(self, o):
+        if self.fast:
+            try:
+                return orjson.dumps(o, default=self.default, option=(
+                    orjson.OPT_SORT_KEYS if self.sort_keys else 0)).decode()
+            except TypeError:
+                pass
+        return super().encode(o)
+
+
+class AppJSONEncoder(TimedJSONEncoder, CompactJSONEncoder):
+    pass
+
+
+class FastAppJSONEncoder(AppJSONEncoder):
+    fast = True
+
+
+def use_orjson(config):
+    return orjson is not None and config.get('JSON_BACKEND', 'auto') != 'json'
+
+
+def row_encoder(config):
+    '''
+    returns a function encoding one row dict as compact JSON, for the
+    NDJSON exports
+    '''
+    if use_orjson(config):
+        return lambda row: orjson.dumps(row).decode()
+    return json.JSONEncoder(separators=(',', ':')).encode
+
+
+def init_encoding(app):
+    app.json_encoder = FastAppJSONEncoder if use_orjson(app.config) \
+        else AppJSONEncoder
+    min_size = app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    codings = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    @app.after_request
+    def compress(response):
+        if min_size is not None and response.status_code == 304:
+            # stands in for a 200 that varies on it
+            response.vary.add('Accept-Encoding')
+        if min_size is None or response.status_code != 200 or \
+                response.mimetype not in COMPRESS_MIMETYPES or \
+                response.direct_passthrough or \
+                'Content-Encoding' in response.headers:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if not response.is_streamed and \
+                response.calculate_content_length() < min_size:
+            return response
+        coding = request.accept_encodings.best_match(codings)
+        if coding is None:
+            return response
+
+        stream = compressor(coding, app.config)
+        if response.is_streamed:
+            response.response = _compressed_stream(response.response, stream)
+            response.headers.pop('Content-Length', None)
+        else:
+            response.set_data(stream.finish(response.get_data()))
+        response.headers['Content-Encoding'] = coding
+        return response
+
+
+def compressor(coding, config):
+    '''
+    returns a gzip ('gzip') or brotli ('br') stream: chunk(data) returns
+    what can be sent so far, finish(data) the rest
+    '''
+    if coding == 'br':
+        return _Brotli(config.get('BROTLI_QUALITY', BROTLI_QUALITY))
+    return _Gzip(config.get('GZIP_LEVEL', GZIP_LEVEL))
+
+
+def _compressed_stream(chunks, stream):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = stream.chunk(chunk)
+            if data:
+                yield data
+        yield stream.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class _Gzip:
+
+    def __init__(self, level):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data):
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b''):
+        return self._z.compress(data) + self._z.flush()
+
+
+class _Brotli:
+
+    def __init__(self, quality):
+        self._c = brotli.Compressor(quality=quality)
+
+    def chunk(self, data):
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self, data=b''):
+        return self._c.process(data) + self._c.finish()
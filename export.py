@@ -0,0 +1,50 @@
+from flask import Response, current_app, request, stream_with_context
+
+from encoding import NDJSON, row_encoder
+
+EXPORT_BATCH_SIZE = 1000
+
+'''
+wants_ndjson()
+    True when the client prefers newline-delimited JSON over JSON
+'''
+
+
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    return best == NDJSON
+
+
+'''
+ndjson_response(query, to_dict)
+    streams every row of `query` as one JSON object per line
+
+    rows come off a server-side cursor (stream_results + yield_per) and
+    each batch is written out as soon as it is serialized, so memory stays
+    flat however large the table is. `to_dict` gives rows the same shape
+    as the listings (e.g. Projection.to_dict); they are encoded like the
+    other responses (see encoding.py).
+'''
+
+
+def ndjson_response(query, to_dict):
+    batch_size = current_app.config.get(
+        'EXPORT_BATCH_SIZE', EXPORT_BATCH_SIZE)
+    rows = query.execution_options(stream_results=True).yield_per(batch_size)
+    return Response(
+        stream_with_context(_ndjson_lines(
+            rows, to_dict, row_encoder(current_app.config), batch_size)),
+        mimetype=NDJSON)
+
+
+def _ndjson_lines(rows, to_dict, dumps, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(dumps(to_dict(row)))
+        if len(batch) >= batch_size:
+            batch.append('')
+            yield '\n'.join(batch)
+            batch = []
+    if batch:
+        batch.append('')
+        yield '\n'.join(batch)
@@ -0,0 +1,64 @@
+from datetime import date
+
+from flask import abort, request
+
+from models import Actor, Movie
+
+'''
+movie_filters() / actor_filters()
+    the listing filters of the current request as a list of SQL criteria
+
+    ?year=     movies released that year
+    ?min_age=  actors at least that old
+    ?gender=   actors of that gender, matched exactly
+
+    each filter is a plain comparison on an indexed column: ?year= is the
+    range [1 Jan, 1 Jan next year) on Movies.release_date rather than
+    EXTRACT(YEAR ...), and ?gender= with ?min_age= is one range scan of
+    the (gender, age) index. Bad values abort with 400.
+'''
+
+
+def movie_filters():
+    criteria = []
+    year = _int_arg('year', 1, 9998)
+    if year is not None:
+        criteria.append(Movie.release_date >= date(year, 1, 1))
+        criteria.append(Movie.release_date < date(year + 1, 1, 1))
+    return criteria
+
+
+def actor_filters():
+    criteria = []
+    gender = request.args.get('gender')
+    if gender:
+        criteria.append(Actor.gender == gender)
+    min_age = _int_arg('min_age', 0, None)
+    if min_age is not None:
+        criteria.append(Actor.age >= min_age)
+    return criteria
+
+
+def filter_key(name):
+    '''
+    `name` plus the filters in use, e.g. for CountCache keys
+    '''
+    used = sorted((arg, request.args[arg])
+                  for arg in ('year', 'min_age', 'gender')
+                  if request.args.get(arg))
+    if not used:
+        return name
+    return name + '?' + '&'.join('%s=%s' % pair for pair in used)
+
+
+def _int_arg(name, minimum, maximum):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if value < minimum or (maximum is not None and value > maximum):
+        abort(400)
+    return value
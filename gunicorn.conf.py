@@ -0,0 +1,67 @@
+import glob
+import multiprocessing
+import os
+
+'''
+gunicorn settings
+
+    gunicorn -c gunicorn.conf.py app:app
+
+    WEB_CONCURRENCY sets the number of workers (default 2 * CPUs + 1) and
+    PORT the port to listen on. With PROMETHEUS_MULTIPROC_DIR set, the
+    directory is emptied when the master starts and dead workers' metric
+    files are marked so /metrics stays correct across restarts.
+
+    WORKER_CLASS picks how a worker serves requests:
+
+    sync     one request at a time per worker (the default)
+    gthread  THREADS requests at a time per worker
+    gevent   up to WORKER_CONNECTIONS requests per worker, switching
+             whenever one waits on the network (Postgres, the JWKS
+             fetch); needs requirements-gevent.txt. Size DB_POOL_SIZE and
+             DB_MAX_OVERFLOW for the requests a worker runs at once, not
+             for one.
+
+    PRELOAD_APP=true builds the app once in the master and forks workers
+    from it, so they boot in a fraction of the time and share its memory
+    pages. The master closes any pooled database connection before each
+    fork. Use it with sync and gthread workers: gevent has to patch the
+    worker before the app is imported.
+'''
+
+bind = '0.0.0.0:%s' % os.getenv('PORT', '8000')
+workers = int(os.getenv('WEB_CONCURRENCY',
+                        multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.getenv('WORKER_CLASS', 'sync')
+threads = int(os.getenv('THREADS', 1))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+preload_app = os.getenv('PRELOAD_APP', 'false').lower() in ('1', 'true')
+
+
+def on_starting(server):
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+
+
+def pre_fork(server, worker):
+    # the app only exists in the master when it was preloaded
+    app = getattr(server.app, 'callable', None)
+    if app is not None:
+        from models import dispose_engine
+        dispose_engine(app)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # before the worker loads the app and opens any connection
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
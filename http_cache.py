@@ -0,0 +1,127 @@
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import Response, current_app, g, make_response, request
+
+from auth import check_permissions
+from casting import include_args
+from models import table_versions
+from response_cache import RESPONSE_CACHE_MAX_ENTRY_BYTES
+
+'''
+@conditional(*models, include=None)
+    conditional GET and response caching for endpoints whose response
+    only depends on the rows of `models`, the request's query string and
+    Accept header, and the permissions the caller was granted. Nothing
+    else about the caller (their subject, say) may change the response:
+    cached responses are shared by every caller holding the same
+    permissions.
+
+    `include` maps the names ?include= takes (parsed by
+    casting.include_args) to the permission each needs and the further
+    models such a response depends on, e.g.
+    {'actors': ('get:actors', (Actor, Casting))}, so plain listings
+    aren't invalidated by writes to tables they don't show. The
+    permissions are checked here, before revalidation or a cache lookup
+    can answer without running the endpoint.
+
+    the weak ETag combines the tables' version counters (see
+    models.TableVersion) with a digest of the query, and Last-Modified is
+    the time of the last write. If-None-Match that still matches, or
+    without it If-Modified-Since, gets a 304 after a single primary-key
+    lookup, without touching row data. Last-Modified has whole seconds,
+    so while the second of the last write is still running (another
+    write could land in it unseen) it isn't sent and If-Modified-Since
+    counts as modified.
+
+    other requests are looked up in the app's response cache (see
+    response_cache.py) under a key made of the endpoint, the versions,
+    the query and the caller's permissions before the endpoint runs. Streamed
+    responses and bodies over RESPONSE_CACHE_MAX_ENTRY_BYTES aren't
+    cached.
+
+    the version is read before the endpoint runs: a write landing in
+    between can only make the ETag older than the body (costing the
+    client one extra full response), never newer.
+'''
+
+
+def conditional(*models, include=None):
+    include = include or {}
+
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            depends_on = models
+            for name in include_args(*include) if include else ():
+                permission, related = include[name]
+                check_permissions(permission, {}, g.get('permissions'))
+                depends_on += related
+            tables = tuple(model.__tablename__ for model in depends_on)
+            versions, modified = table_versions(depends_on)
+            version = '.'.join(str(versions[name]) for name in tables)
+            query = request.query_string + b'|' + \
+                request.headers.get('Accept', '').encode()
+            etag = '%s-%s' % (
+                version, hashlib.blake2b(query, digest_size=8).hexdigest())
+            if modified is not None:
+                second = modified.replace(microsecond=0)
+                settled = datetime.utcnow().replace(microsecond=0) > second
+                modified = second.replace(tzinfo=timezone.utc) \
+                    if settled else None
+
+            if not_modified(etag, modified):
+                response = make_response('', 304)
+            else:
+                key = '%s|%s|%s|%s' % (
+                    request.endpoint, version, query.decode('latin-1'),
+                    ' '.join(sorted(g.get('permissions', ()))))
+                response = cached_response(f, args, kwargs, tables, key)
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if modified is not None:
+                response.last_modified = modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+def not_modified(etag, modified):
+    '''
+    `modified` is None when there is no Last-Modified to compare with
+    '''
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and modified is not None:
+        return modified <= request.if_modified_since
+    return False
+
+
+def cached_response(f, args, kwargs, tables, key):
+    cache = current_app.extensions.get('response_cache')
+    if cache is None:
+        return make_response(f(*args, **kwargs))
+
+    cached = cache.get(key)
+    if cached is not None:
+        status, mimetype, body = cached
+        response = Response(body, status=status, mimetype=mimetype)
+        response.headers['X-Cache'] = 'HIT'
+        return response
+
+    response = make_response(f(*args, **kwargs))
+    max_bytes = current_app.config.get(
+        'RESPONSE_CACHE_MAX_ENTRY_BYTES', RESPONSE_CACHE_MAX_ENTRY_BYTES)
+    if response.status_code == 200 and not response.is_streamed:
+        body = response.get_data()
+        if len(body) <= max_bytes:
+            cache.set(key, (response.status_code, response.mimetype, body),
+                      tables)
+    response.headers['X-Cache'] = 'MISS'
+    return response
@@ -0,0 +1,295 @@
+import csv
+import io
+import json
+import logging
+import tempfile
+import threading
+from datetime import datetime
+from itertools import islice
+
+from flask import abort, current_app
+from sqlalchemy import Column, MetaData, Table, literal, select
+
+from encoding import NDJSON
+from models import Actor, ImportJob, Movie, db, touch
+from replicas import use_primary
+from schemas import Fields
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_MAX_REJECTED = 1000
+IMPORT_MAX_BYTES = 1024 ** 3
+SPOOL_CHUNK_BYTES = 64 * 1024
+
+# upload Content-Type / file extension -> format
+FORMATS = {'text/csv': 'csv', NDJSON: 'ndjson'}
+EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+MODELS = {'movies': Movie, 'actors': Actor}
+SCHEMAS = {kind: Fields(model) for kind, model in MODELS.items()}
+
+# stands in for an NDJSON line that doesn't parse
+INVALID_JSON = object()
+# where csv.DictReader puts cells beyond the header
+EXTRA_CELLS = 'extra_cells'
+
+'''
+Catalogue imports
+    load a CSV file (with a header row naming the fields) or an NDJSON
+    file (one object per line) of movies or actors, with the fields
+    POST /movies and POST /actors/create take
+
+    the file is read as a stream, IMPORT_CHUNK_SIZE rows at a time, and
+    every row is checked against the same schema as the single writes.
+    Rejected rows are reported by line number (the first
+    IMPORT_MAX_REJECTED of them) and don't stop the import.
+
+    on Postgres, valid rows are COPYed into a temporary staging table and
+    merged into the model's table with one INSERT ... SELECT when the
+    file is done, so the import lands whole or not at all. Elsewhere
+    they are inserted with one executemany per chunk, committed as they
+    go. Progress is kept in an ImportJob row, written on its own
+    connection after every chunk so it can be read while the import runs.
+'''
+
+
+def upload_format(mimetype=None, filename=None):
+    '''
+    returns 'csv' or 'ndjson' for an upload, or None
+    '''
+    if mimetype in FORMATS:
+        return FORMATS[mimetype]
+    for extension, file_format in EXTENSIONS.items():
+        if filename and filename.lower().endswith(extension):
+            return file_format
+    return None
+
+
+'''
+start_import(kind, stream, file_format, subject=None, done=None)
+    spools an upload to a temporary file, a piece at a time so it is
+    never whole in memory, and imports it in a background thread, or
+    before returning when IMPORT_ASYNC is off. `done` is called once the
+    import has finished. Returns the ImportJob.
+
+    an upload over IMPORT_MAX_BYTES gets a 413.
+'''
+
+
+def start_import(kind, stream, file_format, subject=None, done=None):
+    config = current_app.config
+    source = spool(stream, config.get('IMPORT_MAX_BYTES', IMPORT_MAX_BYTES))
+
+    job = create_job(kind, file_format, subject)
+    if config.get('IMPORT_ASYNC', True):
+        threading.Thread(
+            target=_run_in_background, name='import-%d' % job.id,
+            args=(current_app._get_current_object(), job.id, source, done),
+            daemon=True).start()
+    else:
+        run_import(job.id, source)
+        db.session.refresh(job)
+        if done is not None:
+            done()
+    return job
+
+
+def spool(stream, max_bytes):
+    source = tempfile.TemporaryFile()
+    size = 0
+    while True:
+        chunk = stream.read(SPOOL_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            source.close()
+            abort(413)
+        source.write(chunk)
+    source.seek(0)
+    return source
+
+
+def create_job(kind, file_format, subject=None):
+    job = ImportJob(kind=kind, file_format=file_format, subject=subject)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def _run_in_background(app, job_id, source, done):
+    with app.app_context():
+        try:
+            run_import(job_id, source)
+            if done is not None:
+                done()
+        finally:
+            db.session.remove()
+
+
+'''
+run_import(job_id, source)
+    imports the binary file `source` into the job's table and closes it.
+    The job ends 'done' or 'failed'; a failure is logged and its message
+    kept on the job.
+'''
+
+
+def run_import(job_id, source):
+    use_primary()
+    job = ImportJob.query.get(job_id)
+    model = MODELS[job.kind]
+    schema = SCHEMAS[job.kind]
+    copy = db.session.get_bind().dialect.name == 'postgresql'
+    chunk_size = current_app.config.get(
+        'IMPORT_CHUNK_SIZE', IMPORT_CHUNK_SIZE)
+    progress = _Progress(job.id, current_app.config.get(
+        'IMPORT_MAX_REJECTED', IMPORT_MAX_REJECTED))
+
+    job.status = 'running'
+    job.method = 'copy' if copy else 'executemany'
+    db.session.commit()
+    logger.info('Import %d: %s from %s by %s', job.id, job.kind,
+                job.file_format, job.method)
+
+    try:
+        rows = progress.checked(
+            read_rows(source, job.file_format, schema), schema)
+        if copy:
+            _copy(model, schema, rows, progress, chunk_size)
+        else:
+            _executemany(model, rows, progress, chunk_size)
+    except Exception as e:
+        db.session.rollback()
+        logger.exception('Import %d failed', job_id)
+        progress.finish('failed', str(e) if isinstance(e, ValueError)
+                        else 'The import failed, see the server log.')
+    else:
+        progress.finish('done')
+    finally:
+        source.close()
+
+
+def read_rows(source, file_format, schema):
+    '''
+    yields (line number, object) for each row of a binary CSV or NDJSON
+    file
+    '''
+    text = io.TextIOWrapper(source, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text, restkey=EXTRA_CELLS)
+        unknown = set(reader.fieldnames or ()) - schema.known
+        if unknown:
+            raise ValueError('Unknown columns: %s.' % ', '.join(
+                sorted(unknown)))
+        for item in reader:
+            yield reader.line_num, item
+    else:
+        for line, row in enumerate(text, 1):
+            if not row.strip():
+                continue
+            try:
+                item = json.loads(row)
+            except ValueError:
+                item = INVALID_JSON
+            yield line, item
+
+
+def _copy(model, schema, rows, progress, chunk_size):
+    columns = [model.__table__.c[attribute]
+               for _, attribute, _ in schema.fields]
+    staging = Table(
+        'import_staging', MetaData(),
+        *[Column(column.name, column.type) for column in columns],
+        prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
+
+    connection = db.session.connection()
+    staging.create(connection)
+    quote = connection.dialect.identifier_preparer.quote
+    sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+        quote(staging.name), ', '.join(quote(c.name) for c in columns))
+    cursor = connection.connection.cursor()
+
+    staged = 0
+    for chunk in _chunks(rows, chunk_size):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            [values[column.key] for column in columns] for values in chunk)
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+        staged += len(chunk)
+        progress.save()
+
+    connection.execute(model.__table__.insert().from_select(
+        [column.name for column in columns] + ['updated_at'],
+        select(list(staging.c) + [
+            literal(datetime.utcnow(), type_=db.DateTime)])))
+    touch(model)
+    db.session.commit()
+    progress.imported = staged
+
+
+def _executemany(model, rows, progress, chunk_size):
+    for chunk in _chunks(rows, chunk_size):
+        db.session.execute(model.__table__.insert(), chunk)
+        touch(model)
+        db.session.commit()
+        progress.imported += len(chunk)
+        progress.save()
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Progress:
+
+    def __init__(self, job_id, max_rejected):
+        self.job_id = job_id
+        self.max_rejected = max_rejected
+        self.read = 0
+        self.imported = 0
+        self.rejected = []
+        self.rejected_count = 0
+
+    def checked(self, rows, schema):
+        '''
+        yields the values of the valid rows, counting and noting the rest
+        '''
+        for line, item in rows:
+            self.read += 1
+            if item is INVALID_JSON:
+                values, errors = None, {'item': 'Invalid JSON.'}
+            else:
+                values, errors = schema.check(item)
+            if not errors:
+                yield values
+                continue
+            self.rejected_count += 1
+            if len(self.rejected) < self.max_rejected:
+                self.rejected.append({'line': line, 'errors': errors})
+
+    def save(self, **values):
+        # on a connection of its own, so the import's transaction can
+        # stay open
+        with db.get_engine().begin() as connection:
+            connection.execute(ImportJob.__table__.update().where(
+                ImportJob.id == self.job_id).values(
+                rows_read=self.read,
+                rows_imported=self.imported,
+                rows_rejected=self.rejected_count,
+                rejected=self.rejected,
+                **values))
+
+    def finish(self, status, error=None):
+        self.save(status=status, error=error,
+                  finished_at=datetime.utcnow())
+        logger.info('Import %d %s: %d read, %d imported, %d rejected',
+                    self.job_id, status, self.read, self.imported,
+                    self.rejected_count)
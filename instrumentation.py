@@ -0,0 +1,151 @@
+import logging
+import time
+from datetime import date
+
+from flask import g, has_request_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = 500
+SLOW_QUERY_MS = 100
+
+'''
+Per-request instrumentation
+    SQLAlchemy cursor events count the statements each request runs and
+    the time spent in them, a JSON encoder subclass times serialization,
+    and Flask request hooks turn that into
+
+    - a Server-Timing header (auth, db, serialize, app and total
+      durations; requires_auth adds its own time)
+    - a warning for requests over SLOW_REQUEST_MS and statements over
+      SLOW_QUERY_MS
+    - per-route histograms exported on /metrics (see metrics.py)
+
+    routes are labelled by their URL rule (/movies/<int:movie_id>), not
+    the path, so the number of series stays bounded.
+'''
+
+
+class RequestTimings:
+
+    __slots__ = ('start', 'queries', 'db_time', 'serialize_time',
+                 'auth_time')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.auth_time = 0.0
+
+
+def current_timings():
+    if has_request_context():
+        return g.get('timings')
+    return None
+
+
+class TimedJSONEncoder(JSONEncoder):
+
+    def default(self, o):
+        # ISO 8601 rather than the RFC 822 strings Flask gives dates
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
+
+    def encode(self, o):
+        start = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            timings = current_timings()
+            if timings is not None:
+                timings.serialize_time += time.perf_counter() - start
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+
+    timings = current_timings()
+    if timings is not None:
+        timings.queries += 1
+        timings.db_time += elapsed
+        threshold = g.get('slow_query_ms', SLOW_QUERY_MS)
+    else:
+        threshold = SLOW_QUERY_MS
+
+    if elapsed * 1000 >= threshold:
+        metrics.SLOW_QUERIES.inc()
+        logger.warning('Slow query (%.1f ms): %s', elapsed * 1000,
+                       statement[:500])
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    starts = context.connection.info.get('query_start') \
+        if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def init_instrumentation(app):
+    app.json_encoder = TimedJSONEncoder
+    slow_request_ms = app.config.get('SLOW_REQUEST_MS', SLOW_REQUEST_MS)
+    slow_query_ms = app.config.get('SLOW_QUERY_MS', SLOW_QUERY_MS)
+    server_timing = app.config.get('SERVER_TIMING', True)
+
+    @app.before_request
+    def start_timings():
+        g.timings = RequestTimings()
+        g.slow_query_ms = slow_query_ms
+
+    @app.after_request
+    def record_timings(response):
+        timings = g.pop('timings', None)
+        if timings is None:
+            return response
+
+        total = time.perf_counter() - timings.start
+        app_time = max(total - timings.auth_time - timings.db_time -
+                       timings.serialize_time, 0)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+        if server_timing:
+            response.headers['Server-Timing'] = ', '.join((
+                'auth;dur=%.2f' % (timings.auth_time * 1000),
+                'db;dur=%.2f;desc="%d queries"' % (
+                    timings.db_time * 1000, timings.queries),
+                'serialize;dur=%.2f' % (timings.serialize_time * 1000),
+                'app;dur=%.2f' % (app_time * 1000),
+                'total;dur=%.2f' % (total * 1000)))
+
+        metrics.REQUESTS.labels(
+            route, request.method, response.status_code).inc()
+        metrics.REQUEST_LATENCY.labels(
+            route, request.method, response.status_code).observe(total)
+        metrics.REQUEST_DB_TIME.labels(route).observe(timings.db_time)
+        metrics.REQUEST_SERIALIZE_TIME.labels(route).observe(
+            timings.serialize_time)
+        metrics.REQUEST_QUERIES.labels(route).observe(timings.queries)
+
+        if total * 1000 >= slow_request_ms:
+            metrics.SLOW_REQUESTS.labels(route).inc()
+            logger.warning(
+                'Slow request %s %s: %.1f ms total, %d queries in %.1f ms,'
+                ' %.1f ms serializing', request.method, request.full_path,
+                total * 1000, timings.queries, timings.db_time * 1000,
+                timings.serialize_time * 1000)
+        return response
@@ -0,0 +1,136 @@
+import json
+import logging
+import threading
+import time
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
+
+'''
+JWKSCache
+    process-wide store of the issuer's signing keys, indexed by kid
+
+    keys are fetched once and kept for `ttl` seconds. When a key is asked
+    for within `refresh_margin` seconds of expiry a background thread
+    refreshes the set so requests never wait on the issuer. An unknown kid
+    triggers a synchronous refetch, at most once every
+    `min_refetch_interval` seconds, so forged kids can't cause a fetch
+    storm. If the issuer can't be reached the last good keys keep being
+    served.
+
+    `url` may be any URL urlopen understands, including file:// for a
+    local JWKS document. `on_fetch`, if given, is called with True or
+    False after every fetch attempt.
+'''
+
+
+class JWKSCache:
+
+    def __init__(self, url, ttl=600, refresh_margin=60,
+                 min_refetch_interval=30, timeout=5, on_fetch=None):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl)
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.on_fetch = on_fetch
+
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+        self.fetch_count = 0
+        self.fetch_errors = 0
+
+    def get_key(self, kid):
+        '''
+        returns the RSA key dict for `kid`, or None if the issuer does
+        not publish it
+        '''
+        now = time.monotonic()
+
+        if self._fetched_at is None or now >= self._fetched_at + self.ttl:
+            # nothing usable yet, or the keys have expired: block on a
+            # fetch (stale keys are still served if it fails)
+            self._refresh(now)
+        elif now >= self._fetched_at + self.ttl - self.refresh_margin:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch(time.monotonic()):
+            logger.info('Unknown kid %r, refetching JWKS', kid)
+            self._refresh(time.monotonic())
+            key = self._keys.get(kid)
+
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def _may_refetch(self, now):
+        return (self._last_attempt is None or
+                now - self._last_attempt >= self.min_refetch_interval)
+
+    def _refresh(self, now):
+        with self._lock:
+            # another thread may have fetched (or failed to) while we
+            # waited for the lock
+            if not self._may_refetch(now):
+                return
+            self._fetch()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or not self._may_refetch(time.monotonic()):
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with self._lock:
+                    self._fetch()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    def _fetch(self):
+        # callers must hold self._lock
+        self._last_attempt = time.monotonic()
+        try:
+            with urlopen(self.url, timeout=self.timeout) as response:
+                jwks = json.loads(response.read())
+            keys = parse_jwks(jwks)
+        except Exception as e:
+            self.fetch_errors += 1
+            logger.warning('Unable to fetch JWKS from %s: %s', self.url, e)
+            if self.on_fetch is not None:
+                self.on_fetch(False)
+            return
+
+        self.fetch_count += 1
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        if self.on_fetch is not None:
+            self.on_fetch(True)
+
+
+def parse_jwks(jwks):
+    '''
+    turns a JWKS document into a {kid: rsa_key} dict
+    '''
+    keys = {}
+    for key in jwks['keys']:
+        keys[key['kid']] = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
+    return keys
@@ -0,0 +1,74 @@
+import base64
+import json
+import time
+import uuid
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+'''
+LocalIssuer
+    a stand-in for Auth0 used by the tests and benchmarks
+
+    it owns an RSA keypair, publishes the public half as a JWKS document
+    (write_jwks() gives a file:// URL the JWKS cache can read) and mints
+    RS256 access tokens with whatever permissions are asked for.
+'''
+
+
+def _b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class LocalIssuer:
+
+    def __init__(self, domain='casting.local', audience='capstone', kid=None):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid or uuid.uuid4().hex
+        self._private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048)
+        self._private_pem = self._private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption())
+
+    @property
+    def issuer(self):
+        return f'https://{self.domain}/'
+
+    def jwks(self):
+        numbers = self._private_key.public_key().public_numbers()
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64url_uint(numbers.n),
+            'e': _b64url_uint(numbers.e)
+        }]}
+
+    def write_jwks(self, path):
+        '''
+        writes the JWKS document to `path` and returns its file:// URL
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+        return 'file://' + str(path)
+
+    def token(self, permissions=(), subject='local|tester', expires_in=3600,
+              kid=None, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': self.issuer,
+            'sub': subject,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self._private_pem, algorithm='RS256',
+                          headers={'kid': kid or self.kid})
@@ -1,7 +1,10 @@
+import json
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
+from imports import MODELS, create_job, run_import, upload_format
 from models import db
 
 migrate = Migrate(app, db)
@@ -10,5 +13,27 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-f', '--format', dest='file_format', default=None,
+                choices=('csv', 'ndjson'),
+                help='file format (default: from the file extension)')
+@manager.option('path', help='CSV or NDJSON file to load')
+@manager.option('kind', choices=sorted(MODELS), help='what the file holds')
+def load(kind, path, file_format=None):
+    '''
+    Import a CSV or NDJSON file of movies or actors, like POST
+    /movies/import and POST /actors/import
+    '''
+    file_format = file_format or upload_format(filename=path)
+    if file_format is None:
+        raise SystemExit('Pass --format: %s is not .csv or .ndjson' % path)
+
+    job = create_job(kind, file_format)
+    run_import(job.id, open(path, 'rb'))
+    db.session.refresh(job)
+    print(json.dumps(job.format(), indent=2))
+    if job.status != 'done':
+        raise SystemExit(1)
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
@@ -0,0 +1,182 @@
+import ipaddress
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+
+'''
+Prometheus metrics
+    request-level metrics are process-wide and fed by instrumentation.py
+    and auth.py. Per-app numbers that already live elsewhere (response
+    cache, token cache, connection pool) are read at scrape time by
+    AppCollector, so they cost nothing between scrapes.
+
+    under gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty directory
+    (gunicorn.conf.py clears it on start and cleans up after dead
+    workers): every worker then writes its counters and histograms to
+    memory-mapped files there and a scrape of any worker aggregates all
+    of them. AppCollector numbers are per worker and carry a pid label.
+
+    /metrics is off unless METRICS is set, and then only answers the
+    addresses and networks in METRICS_ALLOW (by default the host itself);
+    everyone else gets a 404.
+'''
+
+METRICS_ALLOW = '127.0.0.1, ::1'
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75,
+                   1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram(
+    'casting_request_duration_seconds',
+    'Time from the start of the request to the response being built.',
+    ['route', 'method', 'status'], buckets=LATENCY_BUCKETS)
+
+REQUEST_DB_TIME = Histogram(
+    'casting_request_db_seconds',
+    'Time spent executing SQL per request.',
+    ['route'], buckets=LATENCY_BUCKETS)
+
+REQUEST_SERIALIZE_TIME = Histogram(
+    'casting_request_serialize_seconds',
+    'Time spent encoding JSON per request.',
+    ['route'], buckets=LATENCY_BUCKETS)
+
+REQUEST_QUERIES = Histogram(
+    'casting_request_db_queries',
+    'SQL statements executed per request.',
+    ['route'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+
+REQUESTS = Counter(
+    'casting_requests_total',
+    'Requests handled.',
+    ['route', 'method', 'status'])
+
+AUTH_STAGE_TIME = Histogram(
+    'casting_auth_seconds',
+    'Time spent authenticating: the whole of requires_auth, and '
+    'verify_decode_jwt on token cache misses.',
+    ['stage'], buckets=LATENCY_BUCKETS)
+
+AUTH_ERRORS = Counter(
+    'casting_auth_errors_total',
+    'Rejected requests by AuthError code.',
+    ['code'])
+
+JWKS_FETCHES = Counter(
+    'casting_jwks_fetches_total',
+    'JWKS fetches from the issuer.',
+    ['result'])
+
+SLOW_REQUESTS = Counter(
+    'casting_slow_requests_total',
+    'Requests slower than SLOW_REQUEST_MS.',
+    ['route'])
+
+SLOW_QUERIES = Counter(
+    'casting_slow_queries_total',
+    'SQL statements slower than SLOW_QUERY_MS.')
+
+
+DB_ROUTES = Counter(
+    'casting_db_routes_total',
+    'Read requests by the database they read from.',
+    ['target'])
+
+
+RATE_LIMITED = Counter(
+    'casting_rate_limited_total',
+    'Requests turned away with a 429, by limit.',
+    ['limit'])
+
+
+def multiprocess_mode():
+    return bool(os.getenv('PROMETHEUS_MULTIPROC_DIR') or
+                os.getenv('prometheus_multiproc_dir'))
+
+
+class AppCollector:
+
+    def __init__(self, app):
+        self.app = app
+
+    def collect(self):
+        # imported lazily so auth and models can record into this module
+        import auth
+        from models import db_pool_stats
+
+        cache = self.app.extensions.get('response_cache')
+        if cache is not None:
+            yield from _gauges('casting_response_cache', cache.stats())
+
+        yield from _gauges('casting_token_cache', auth.token_cache.stats())
+
+        limiter = self.app.extensions.get('rate_limiter')
+        if limiter is not None:
+            yield from _gauges('casting_rate_limit', limiter.stats())
+
+        with self.app.app_context():
+            stats = db_pool_stats(self.app)
+        yield from _gauges('casting_db_pool', stats)
+
+        replicas = self.app.extensions.get('replicas')
+        if replicas is not None:
+            yield from _gauges('casting_db_replicas', replicas.stats())
+
+
+def _gauges(prefix, stats):
+    labels, values = ([], [])
+    if multiprocess_mode():
+        labels, values = (['pid'], [str(os.getpid())])
+
+    for name, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauge = GaugeMetricFamily(
+                '%s_%s' % (prefix, name), '%s %s' % (prefix, name),
+                labels=labels)
+            gauge.add_metric(values, value)
+            yield gauge
+
+
+def allowed_networks(text):
+    '''
+    the networks of a comma-separated METRICS_ALLOW, e.g.
+    '127.0.0.1, 10.0.0.0/8'
+    '''
+    return [ipaddress.ip_network(item.strip(), strict=False)
+            for item in text.split(',') if item.strip()]
+
+
+def scrape_allowed(address, networks):
+    try:
+        address = ipaddress.ip_address(address or '')
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def render(app):
+    '''
+    returns (body, content type) for a /metrics scrape
+    '''
+    registry = app.extensions.get('metrics_registry')
+    if registry is None:
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(AppCollector(app))
+        app.extensions['metrics_registry'] = registry
+
+    if multiprocess_mode():
+        shared = CollectorRegistry()
+        multiprocess.MultiProcessCollector(shared)
+    else:
+        shared = REGISTRY
+    return (generate_latest(shared) + generate_latest(registry),
+            CONTENT_TYPE_LATEST)
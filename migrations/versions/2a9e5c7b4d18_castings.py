@@ -0,0 +1,47 @@
+"""castings
+
+The Castings association between Movies and Actors, and its
+table_versions counter.
+
+Revision ID: 2a9e5c7b4d18
+Revises: f3b8d2a6c410
+Create Date: 2024-05-20 11:47:15.382604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2a9e5c7b4d18'
+down_revision = 'f3b8d2a6c410'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'Castings',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False,
+                  server_default=sa.func.now()),
+        sa.ForeignKeyConstraint(['movie_id'], ['Movies.id'],
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['actor_id'], ['Actors.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_Castings_actor_id', 'Castings', ['actor_id'])
+
+    table_versions = sa.table(
+        'table_versions', sa.column('name', sa.String),
+        sa.column('version', sa.Integer), sa.column('updated_at'))
+    op.execute(table_versions.insert().values(
+        name='Castings', version=1, updated_at=sa.func.now()))
+
+
+def downgrade():
+    op.execute("DELETE FROM table_versions WHERE name = 'Castings'")
+    op.drop_index('ix_Castings_actor_id', table_name='Castings')
+    op.drop_table('Castings')
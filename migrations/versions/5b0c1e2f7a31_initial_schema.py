@@ -0,0 +1,43 @@
+"""initial schema
+
+Movies and Actors as created by db.create_all() before migrations were
+committed. Databases created that way should be stamped with this
+revision (python3 manage.py db stamp 5b0c1e2f7a31) before upgrading.
+
+Revision ID: 5b0c1e2f7a31
+Revises:
+Create Date: 2024-04-21 10:12:08.417392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0c1e2f7a31'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'Movies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(), nullable=True),
+        sa.Column('release_date', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'Actors',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('age', sa.String(), nullable=True),
+        sa.Column('gender', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('Actors')
+    op.drop_table('Movies')
@@ -0,0 +1,34 @@
+"""row versions
+
+A version counter on Movies and Actors rows, bumped by every write and
+checked against If-Match by PATCH.
+
+Revision ID: 6e1f0b9d3a27
+Revises: 2a9e5c7b4d18
+Create Date: 2024-05-27 09:12:41.906213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e1f0b9d3a27'
+down_revision = '2a9e5c7b4d18'
+branch_labels = None
+depends_on = None
+
+TABLES = ('Movies', 'Actors')
+
+
+def upgrade():
+    # plain ADD/DROP COLUMN rather than batch_alter_table: rebuilding the
+    # tables on SQLite would drop their search triggers
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(),
+                                       nullable=False, server_default='1'))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, 'version')
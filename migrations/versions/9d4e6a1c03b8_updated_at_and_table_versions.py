@@ -0,0 +1,46 @@
+"""updated_at columns and table_versions
+
+Adds Movies.updated_at / Actors.updated_at and the table_versions
+counters used for conditional GETs.
+
+Revision ID: 9d4e6a1c03b8
+Revises: 5b0c1e2f7a31
+Create Date: 2024-04-22 18:40:51.093114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4e6a1c03b8'
+down_revision = '5b0c1e2f7a31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('Movies', 'Actors'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column(
+                'updated_at', sa.DateTime(), nullable=False,
+                server_default=sa.func.now()))
+
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    now = sa.func.now()
+    op.execute(table_versions.insert().values([
+        {'name': 'Movies', 'version': 1, 'updated_at': now},
+        {'name': 'Actors', 'version': 1, 'updated_at': now}]))
+
+
+def downgrade():
+    op.drop_table('table_versions')
+    for table in ('Actors', 'Movies'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
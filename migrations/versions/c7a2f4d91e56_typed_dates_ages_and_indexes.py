@@ -0,0 +1,123 @@
+"""typed release dates and ages, lookup indexes
+
+Converts Movies.release_date from free-form text to DATE and
+Actors.age to INTEGER, backfilling the existing rows, and adds the
+indexes behind title/name lookups and the ?year=, ?min_age= and
+?gender= filters.
+
+Values that can't be read as a date or a number become NULL and are
+logged; a bare year ('1999') becomes the 1st of January.
+
+Revision ID: c7a2f4d91e56
+Revises: 9d4e6a1c03b8
+Create Date: 2024-05-06 09:31:44.260817
+
+"""
+import logging
+import re
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+from dateutil import parser as date_parser
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7a2f4d91e56'
+down_revision = '9d4e6a1c03b8'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+BATCH_SIZE = 1000
+
+
+def parse_date(value):
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        return date_parser.parse(value, default=datetime(2000, 1, 1)).date()
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_age(value):
+    match = re.search(r'\d+', value or '')
+    return int(match.group()) if match else None
+
+
+def format_date(value):
+    return value.isoformat() if value is not None else None
+
+
+def format_age(value):
+    return str(value) if value is not None else None
+
+
+def convert(table, column, old_type, new_type, cast):
+    '''
+    rewrites `column` of `table` from `old_type` to `new_type`, passing
+    every value through `cast`, BATCH_SIZE rows at a time (in id order,
+    after the last id done) so the table is never held in memory
+    '''
+    temporary = column + '_new'
+    with op.batch_alter_table(table) as batch_op:
+        batch_op.add_column(sa.Column(temporary, new_type, nullable=True))
+
+    connection = op.get_bind()
+    source = sa.table(table, sa.column('id', sa.Integer),
+                      sa.column(column, old_type),
+                      sa.column(temporary, new_type))
+    update = source.update() \
+        .where(source.c.id == sa.bindparam('row_id')) \
+        .values({temporary: sa.bindparam('value')})
+    unreadable = 0
+    last_id = None
+    while True:
+        query = sa.select([source.c.id, source.c[column]]) \
+            .order_by(source.c.id).limit(BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(source.c.id > last_id)
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            break
+        batch = []
+        for id, value in rows:
+            converted = cast(value)
+            if converted is None and value not in (None, ''):
+                unreadable += 1
+            batch.append({'row_id': id, 'value': converted})
+        connection.execute(update, batch)
+        last_id = rows[-1][0]
+    if unreadable:
+        logger.warning('%s.%s: %d values could not be converted and were '
+                       'set to NULL', table, column, unreadable)
+
+    with op.batch_alter_table(table) as batch_op:
+        batch_op.drop_column(column)
+        batch_op.alter_column(temporary, new_column_name=column,
+                              existing_type=new_type)
+
+
+def upgrade():
+    convert('Movies', 'release_date', sa.String(), sa.Date(), parse_date)
+    convert('Actors', 'age', sa.String(), sa.Integer(), parse_age)
+
+    op.create_index('ix_Movies_title', 'Movies', ['title'])
+    op.create_index('ix_Movies_release_date', 'Movies', ['release_date'])
+    op.create_index('ix_Actors_name', 'Actors', ['name'])
+    op.create_index('ix_Actors_age', 'Actors', ['age'])
+    op.create_index('ix_Actors_gender_age', 'Actors', ['gender', 'age'])
+
+
+def downgrade():
+    op.drop_index('ix_Actors_gender_age', table_name='Actors')
+    op.drop_index('ix_Actors_age', table_name='Actors')
+    op.drop_index('ix_Actors_name', table_name='Actors')
+    op.drop_index('ix_Movies_release_date', table_name='Movies')
+    op.drop_index('ix_Movies_title', table_name='Movies')
+
+    convert('Actors', 'age', sa.Integer(), sa.String(), format_age)
+    convert('Movies', 'release_date', sa.Date(), sa.String(), format_date)
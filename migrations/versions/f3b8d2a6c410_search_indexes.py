@@ -0,0 +1,74 @@
+"""search indexes
+
+Full-text and trigram indexes over Movies.title and Actors.name for
+GET /search. Postgres gets GIN indexes (to_tsvector and pg_trgm, which
+this revision enables); SQLite gets FTS5 tables kept in step by
+triggers.
+
+Revision ID: f3b8d2a6c410
+Revises: c7a2f4d91e56
+Create Date: 2024-05-13 14:02:37.551920
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d2a6c410'
+down_revision = 'c7a2f4d91e56'
+branch_labels = None
+depends_on = None
+
+COLUMNS = (('Movies', 'title', 'movies_fts'),
+           ('Actors', 'name', 'actors_fts'))
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, column, fts in COLUMNS:
+        names = {'table': table, 'column': column, 'fts': fts}
+        if dialect == 'postgresql':
+            op.execute(
+                'CREATE INDEX "ix_%(table)s_%(column)s_fts" '
+                'ON "%(table)s" USING gin '
+                "(to_tsvector('simple', coalesce(%(column)s, '')))" % names)
+            op.execute(
+                'CREATE INDEX "ix_%(table)s_%(column)s_trgm" '
+                'ON "%(table)s" USING gin (%(column)s gin_trgm_ops)' % names)
+        elif dialect == 'sqlite':
+            op.execute(
+                'CREATE VIRTUAL TABLE %(fts)s USING fts5(%(column)s, '
+                "content='%(table)s', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2')" % names)
+            op.execute(
+                'CREATE TRIGGER %(fts)s_insert AFTER INSERT ON "%(table)s" '
+                'BEGIN INSERT INTO %(fts)s(rowid, %(column)s) '
+                'VALUES (new.id, new.%(column)s); END' % names)
+            op.execute(
+                'CREATE TRIGGER %(fts)s_delete AFTER DELETE ON "%(table)s" '
+                'BEGIN INSERT INTO %(fts)s(%(fts)s, rowid, %(column)s) '
+                "VALUES ('delete', old.id, old.%(column)s); END" % names)
+            op.execute(
+                'CREATE TRIGGER %(fts)s_update '
+                'AFTER UPDATE OF %(column)s ON "%(table)s" '
+                'BEGIN INSERT INTO %(fts)s(%(fts)s, rowid, %(column)s) '
+                "VALUES ('delete', old.id, old.%(column)s); "
+                'INSERT INTO %(fts)s(rowid, %(column)s) '
+                'VALUES (new.id, new.%(column)s); END' % names)
+            op.execute("INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild')"
+                       % names)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column, fts in COLUMNS:
+        names = {'table': table, 'column': column, 'fts': fts}
+        if dialect == 'postgresql':
+            op.execute('DROP INDEX "ix_%(table)s_%(column)s_trgm"' % names)
+            op.execute('DROP INDEX "ix_%(table)s_%(column)s_fts"' % names)
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute('DROP TRIGGER %s_%s' % (fts, trigger))
+            op.execute('DROP TABLE %s' % fts)
@@ -1,22 +1,63 @@
 import os
-from sqlalchemy import Column, String, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import re
+from datetime import date, datetime
+from sqlalchemy import DDL, Column, String, create_engine, event
+from sqlalchemy.orm import object_session, validates
+from flask import current_app
+from flask.signals import Namespace
 import json
 
+from dbpool import engine_options, pool_stats
+from replicas import RoutingSQLAlchemy, init_replicas, pin_writer
+
 database_path = os.getenv('DATABASE_URL')
 
-db = SQLAlchemy()
+# reads of GET requests may go to a replica, see replicas.py
+db = RoutingSQLAlchemy()
+
+# sent with the app and the set of versioned tables a commit changed
+tables_committed = Namespace().signal('tables-committed')
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+
+    the connection pool is tuned from the app config or environment, see
+    dbpool.py, and DATABASE_REPLICA_URLS adds read replicas, see
+    replicas.py. Nothing connects until the first query: the schema comes
+    from the migrations (flask db upgrade), and tests and benchmarks call
+    db.create_all() themselves.
 '''
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config, database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    replicas = init_replicas(app, db)
+    if replicas is not None:
+        tables_committed.connect(
+            lambda sender, tables: pin_writer(replicas), app, weak=False)
+
+
+'''
+dispose_engine(app)
+    closes the connections pooled by `app`'s engines. The gunicorn master
+    calls it before forking a worker (see gunicorn.conf.py) so that an app
+    preloaded there never hands its connections to the workers.
+'''
+
+
+def dispose_engine(app):
+    db.get_engine(app).dispose()
+    replicas = app.extensions.get('replicas')
+    if replicas is not None:
+        replicas.dispose()
+
+
+def db_pool_stats(app=None):
+    return pool_stats(db.get_engine(app))
 
 
 def db_drop_and_create_all():
@@ -24,6 +65,50 @@ def db_drop_and_create_all():
     db.create_all()
 
 
+'''
+parse_text(value) / parse_date(value) / parse_age(value)
+    turn a value sent by a client into what the column stores, raising
+    ValueError with a message fit for the response otherwise
+
+    text must be a non-blank string (a number is not taken as its
+    digits). Dates are ISO 8601 ('2021-10-22'); a bare year ('2021')
+    means the 1st of January. Ages are whole numbers of years, as int or
+    string.
+'''
+
+
+def parse_text(value):
+    if not isinstance(value, str):
+        raise ValueError('Expected a string.')
+    if value.strip() == '':
+        raise ValueError('This field may not be blank.')
+    return value
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            if re.fullmatch(r'\d{4}', value):
+                return date(int(value), 1, 1)
+            return date.fromisoformat(value)
+        except ValueError:
+            pass
+    raise ValueError('Expected a date (YYYY-MM-DD).')
+
+
+def parse_age(value):
+    if isinstance(value, str) and re.fullmatch(r'\s*\d+\s*', value):
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError('Expected a whole number of years.')
+    return value
+
+
 '''
  Movie table & Model
 '''
@@ -33,18 +118,47 @@ class Movie(db.Model):
     __tablename__ = 'Movies'
 
     id = Column(db.Integer, primary_key=True)
-    title = Column(String)
-    release_date = Column(String)
+    title = Column(String, index=True)
+    release_date = Column(db.Date, index=True)
+    version = Column(db.Integer, nullable=False, default=1,
+                     server_default='1')
+    updated_at = Column(db.DateTime, nullable=False,
+                        default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # public field name -> attribute, in the order format() emits them
+    FIELDS = {
+        'id': 'id',
+        'title': 'title',
+        'release_year': 'release_date',
+        'version': 'version'}
+
+    # public field name -> parser for values sent by clients; the fields
+    # clients can write
+    PARSERS = {
+        'title': parse_text,
+        'release_year': parse_date}
+
+    # deleting a movie deletes its castings
+    castings = db.relationship('Casting', backref='movie',
+                               cascade='all, delete-orphan')
+    actors = db.relationship('Actor', secondary='Castings', viewonly=True,
+                             order_by='Actor.id')
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
+    @validates('release_date')
+    def _parse_release_date(self, key, value):
+        return None if value is None else parse_date(value)
+
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
-            'release_year': self.release_date}
+            'release_year': (self.release_date.isoformat()
+                             if self.release_date else None),
+            'version': self.version}
 
     def insert(self):
         db.session.add(self)
@@ -65,21 +179,54 @@ class Actor(db.Model):
     __tablename__ = 'Actors'
 
     id = Column(db.Integer, primary_key=True)
-    name = Column(String)
-    age = Column(String)
+    name = Column(String, index=True)
+    age = Column(db.Integer, index=True)
     gender = Column(String)
+    version = Column(db.Integer, nullable=False, default=1,
+                     server_default='1')
+    updated_at = Column(db.DateTime, nullable=False,
+                        default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_Actors_gender_age', 'gender', 'age'),)
+
+    # public field name -> attribute, in the order format() emits them
+    FIELDS = {
+        'id': 'id',
+        'name': 'name',
+        'age': 'age',
+        'gender': 'gender',
+        'version': 'version'}
+
+    # public field name -> parser for values sent by clients; the fields
+    # clients can write
+    PARSERS = {
+        'name': parse_text,
+        'age': parse_age,
+        'gender': parse_text}
+
+    # deleting an actor deletes their castings
+    castings = db.relationship('Casting', backref='actor',
+                               cascade='all, delete-orphan')
+    movies = db.relationship('Movie', secondary='Castings', viewonly=True,
+                             order_by='Movie.id')
 
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
         self.gender = gender
 
+    @validates('age')
+    def _parse_age(self, key, value):
+        return None if value is None else parse_age(value)
+
     def format(self):
         return {
             'id': self.id,
             'name': self.name,
             'age': self.age,
-            'gender': self.gender}
+            'gender': self.gender,
+            'version': self.version}
 
     def insert(self):
         db.session.add(self)
@@ -91,3 +238,260 @@ class Actor(db.Model):
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+
+
+'''
+Casting table & Model
+    which actors are in which movie. The primary key (movie_id, actor_id)
+    serves "who is in this movie", the actor_id index "what is this actor
+    in". Written through Casting instances so the table version is
+    bumped; Movie.actors and Actor.movies are read-only views.
+'''
+
+
+class Casting(db.Model):
+    __tablename__ = 'Castings'
+
+    movie_id = Column(db.Integer,
+                      db.ForeignKey('Movies.id', ondelete='CASCADE'),
+                      primary_key=True)
+    actor_id = Column(db.Integer,
+                      db.ForeignKey('Actors.id', ondelete='CASCADE'),
+                      primary_key=True, index=True)
+    created_at = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # model table -> the column pointing at it
+    KEYS = {'Movies': 'movie_id', 'Actors': 'actor_id'}
+
+    def __init__(self, movie_id, actor_id):
+        self.movie_id = movie_id
+        self.actor_id = actor_id
+
+
+'''
+TableVersion table & Model
+    one row per versioned table, bumped in the same transaction as every
+    write to it. Conditional GETs compare against it instead of scanning
+    the table (see http_cache.py).
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(db.Integer, nullable=False, default=0)
+    updated_at = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+VERSIONED_TABLES = (Movie.__tablename__, Actor.__tablename__,
+                    Casting.__tablename__)
+
+
+'''
+ImportJob table & Model
+    one row per catalogue import (see imports.py): its progress while it
+    runs, then its outcome. `rejected` holds the first rejected rows as
+    {'line': n, 'errors': {field: message}}; rows_rejected counts them all.
+'''
+
+
+class ImportJob(db.Model):
+    __tablename__ = 'import_jobs'
+
+    id = Column(db.Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    file_format = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='pending')
+    method = Column(String)
+    subject = Column(String)
+    rows_read = Column(db.Integer, nullable=False, default=0)
+    rows_imported = Column(db.Integer, nullable=False, default=0)
+    rows_rejected = Column(db.Integer, nullable=False, default=0)
+    rejected = Column(db.JSON, nullable=False, default=list)
+    error = Column(String)
+    created_at = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(db.DateTime, nullable=False,
+                        default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(db.DateTime)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'format': self.file_format,
+            'status': self.status,
+            'method': self.method,
+            'rows_read': self.rows_read,
+            'rows_imported': self.rows_imported,
+            'rows_rejected': self.rows_rejected,
+            'rejected': self.rejected,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat(),
+            'finished_at': (self.finished_at.isoformat()
+                            if self.finished_at else None)}
+
+
+'''
+touch(*models)
+    bumps the version of the given models' tables in the current
+    transaction. ORM flushes and query-level update/delete do this on
+    their own; bulk mapping writes have to call it.
+'''
+
+
+def touch(*models):
+    bump_versions(db.session, {model.__tablename__ for model in models})
+
+
+def bump_versions(session, tables):
+    session.info.setdefault('changed_tables', set()).update(tables)
+
+    table = TableVersion.__table__
+    connection = session.connection()
+    now = datetime.utcnow()
+    for name in sorted(tables):
+        result = connection.execute(
+            table.update()
+            .where(table.c.name == name)
+            .values(version=table.c.version + 1, updated_at=now))
+        if result.rowcount == 0:
+            connection.execute(
+                table.insert().values(name=name, version=1, updated_at=now))
+
+
+def table_versions(models):
+    '''
+    returns ({table name: version}, last modified) for `models`
+    '''
+    names = [model.__tablename__ for model in models]
+    rows = db.session.query(
+        TableVersion.name, TableVersion.version, TableVersion.updated_at
+    ).filter(TableVersion.name.in_(names)).all()
+
+    versions = dict.fromkeys(names, 0)
+    modified = None
+    for name, version, updated_at in rows:
+        versions[name] = version
+        if modified is None or updated_at > modified:
+            modified = updated_at
+    return versions, modified
+
+
+@event.listens_for(db.session, 'after_flush')
+def _bump_flushed_tables(session, flush_context):
+    changed = list(session.new) + list(session.deleted) + [
+        instance for instance in session.dirty
+        if session.is_modified(instance)]
+    tables = {
+        instance.__tablename__ for instance in changed
+        if getattr(instance, '__tablename__', None) in VERSIONED_TABLES}
+    if tables:
+        bump_versions(session, tables)
+
+
+'''
+row versions
+    Movies and Actors carry a version, bumped by every write to the row:
+    here for ORM flushes, by bulk.bulk_update for bulk mappings and in the
+    UPDATE itself for PATCH (see updates.py). It is the row's ETag for
+    If-Match.
+'''
+
+
+@event.listens_for(Movie, 'before_update')
+@event.listens_for(Actor, 'before_update')
+def _bump_row_version(mapper, connection, target):
+    if object_session(target).is_modified(
+            target, include_collections=False):
+        target.version = mapper.local_table.c.version + 1
+
+
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def _bump_bulk_tables(context):
+    name = context.mapper.local_table.name
+    if name in VERSIONED_TABLES:
+        bump_versions(context.session, {name})
+
+
+@event.listens_for(db.session, 'after_commit')
+def _announce_committed_tables(session):
+    tables = session.info.pop('changed_tables', None)
+    if tables:
+        tables_committed.send(current_app._get_current_object(),
+                              tables=tables)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_rolled_back_tables(session):
+    session.info.pop('changed_tables', None)
+
+
+'''
+Search indexes
+    what GET /search (see search.py) reads, created with the tables
+
+    Postgres gets a GIN index over to_tsvector('simple', ...) of each
+    searched column for word and prefix matches, and a pg_trgm GIN index
+    for typo-tolerant similarity. SQLite (tests, benchmarks) gets an FTS5
+    table per searched column, kept in step with triggers.
+'''
+
+SEARCH_COLUMNS = (('Movies', 'title', 'movies_fts'),
+                  ('Actors', 'name', 'actors_fts'))
+
+
+def search_ddl(table, column, fts_table):
+    '''
+    returns (postgres statements, sqlite statements) creating the search
+    indexes for `column`
+    '''
+    postgres = (
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX IF NOT EXISTS "ix_%(table)s_%(column)s_fts" '
+        'ON "%(table)s" USING gin '
+        "(to_tsvector('simple', coalesce(%(column)s, '')))",
+        'CREATE INDEX IF NOT EXISTS "ix_%(table)s_%(column)s_trgm" '
+        'ON "%(table)s" USING gin (%(column)s gin_trgm_ops)')
+    sqlite = (
+        'CREATE VIRTUAL TABLE IF NOT EXISTS %(fts)s USING fts5('
+        "%(column)s, content='%(table)s', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        'CREATE TRIGGER IF NOT EXISTS %(fts)s_insert '
+        'AFTER INSERT ON "%(table)s" BEGIN '
+        'INSERT INTO %(fts)s(rowid, %(column)s) '
+        'VALUES (new.id, new.%(column)s); END',
+        'CREATE TRIGGER IF NOT EXISTS %(fts)s_delete '
+        'AFTER DELETE ON "%(table)s" BEGIN '
+        'INSERT INTO %(fts)s(%(fts)s, rowid, %(column)s) '
+        "VALUES ('delete', old.id, old.%(column)s); END",
+        'CREATE TRIGGER IF NOT EXISTS %(fts)s_update '
+        'AFTER UPDATE OF %(column)s ON "%(table)s" BEGIN '
+        'INSERT INTO %(fts)s(%(fts)s, rowid, %(column)s) '
+        "VALUES ('delete', old.id, old.%(column)s); "
+        'INSERT INTO %(fts)s(rowid, %(column)s) '
+        'VALUES (new.id, new.%(column)s); END',
+        "INSERT INTO %(fts)s(%(fts)s) VALUES ('rebuild')")
+    names = {'table': table, 'column': column, 'fts': fts_table}
+    return ([statement % names for statement in postgres],
+            [statement % names for statement in sqlite])
+
+
+def _listen_for_search_ddl():
+    for table, column, fts_table in SEARCH_COLUMNS:
+        postgres, sqlite = search_ddl(table, column, fts_table)
+        target = db.metadata.tables[table]
+        for statement in postgres:
+            event.listen(target, 'after_create',
+                         DDL(statement).execute_if(dialect='postgresql'))
+        for statement in sqlite:
+            event.listen(target, 'after_create',
+                         DDL(statement).execute_if(dialect='sqlite'))
+        event.listen(target, 'before_drop', DDL(
+            'DROP TABLE IF EXISTS %s' % fts_table).execute_if(
+                dialect='sqlite'))
+
+
+_listen_for_search_ddl()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from flask import abort, current_app, request
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+COUNT_CACHE_TTL = 30
+
+'''
+page_args()
+    reads the keyset pagination parameters of the current request
+
+    ?limit=   page size, capped at the app's MAX_PAGE_SIZE
+    ?after_id= the next_cursor of the previous page
+
+    aborts with 400 on anything that isn't a positive integer
+'''
+
+
+def page_args():
+    config = current_app.config
+    max_size = config.get('MAX_PAGE_SIZE', MAX_PAGE_SIZE)
+    limit = _positive_int('limit', config.get('PAGE_SIZE', DEFAULT_PAGE_SIZE))
+    after_id = _positive_int('after_id', None)
+    return min(limit, max_size), after_id
+
+
+def _positive_int(name, default):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if value < 0 or (value == 0 and name == 'limit'):
+        abort(400)
+    return value
+
+
+def wants_total():
+    return request.args.get('include_total', '').lower() in ('1', 'true')
+
+
+'''
+keyset_page(query, id_column, limit, after_id)
+    returns (rows, next_cursor) for the page of `query` that follows
+    `after_id` in id order
+
+    the page is found through the primary key index (WHERE id > :after_id
+    ORDER BY id LIMIT n) so it costs the same wherever it is in the table,
+    unlike OFFSET. One extra row is fetched to tell whether there is a
+    next page; next_cursor is None on the last one.
+'''
+
+
+def keyset_page(query, id_column, limit, after_id=None):
+    if after_id is not None:
+        query = query.filter(id_column > after_id)
+    rows = query.order_by(id_column).limit(limit + 1).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1].id
+    return rows, None
+
+
+'''
+CountCache
+    row counts kept for `ttl` seconds
+
+    COUNT(*) is a full scan on Postgres, so listings only return a total
+    when asked for one (?include_total=true) and share it between requests.
+'''
+
+
+class CountCache:
+
+    def __init__(self, ttl=COUNT_CACHE_TTL):
+        self.ttl = ttl
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, count):
+        now = time.monotonic()
+        cached = self._counts.get(key)
+        if cached is not None and now < cached[0]:
+            return cached[1]
+
+        value = count()
+        with self._lock:
+            self._counts[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, key=None):
+        '''
+        drops `key` and its filtered variants ('movies?year=2020'), or
+        everything
+        '''
+        with self._lock:
+            if key is None:
+                self._counts.clear()
+                return
+            prefix = key + '?'
+            for cached in list(self._counts):
+                if cached == key or cached.startswith(prefix):
+                    del self._counts[cached]
@@ -0,0 +1,294 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+
+import metrics
+
+RATE_LIMIT_BUCKETS = 100000
+# SQLite buckets idle this long are full again and can be dropped
+RATE_LIMIT_IDLE_SECONDS = 3600
+PRUNE_EVERY = 1000
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+'''
+Rate limiting
+    token buckets, one per caller and limit: a bucket holds up to `burst`
+    requests and refills at `rate` per second. A request finding its
+    bucket empty gets a 429 with Retry-After, the seconds until it would
+    be let through.
+
+    requires_auth charges the bucket of the token's subject. A token that
+    isn't in the token cache yet (the first request with it, or one that
+    never verifies) is first charged to a bucket keyed by its SHA-256
+    digest, before the JWKS lookup and RS256 check, so a client replaying
+    a bad token is turned away at the cost of a hash. A token that fails
+    verification is also charged to its client address, and an address
+    with an empty bucket gets no new token verified, so a flood of
+    distinct garbage tokens is turned away too. Routes without
+    requires_auth are limited by client address.
+
+    RATE_LIMIT picks the backend: '' / 'none' (the default: no limits),
+    'memory' (per worker process), or a path such as
+    'sqlite:////var/run/casting/limits.db' shared by every worker on the
+    host. Limits are written '100/minute' (a burst of 100, refilled over a
+    minute):
+
+        RATE_LIMITS         per permission, e.g. {'post:movies': '1/second'}
+                            or 'post:movies=1/second,get:movies=20/second';
+                            an endpoint needing several uses the strictest
+        RATE_LIMIT_DEFAULT  authenticated endpoints with none of those
+        RATE_LIMIT_ANONYMOUS  routes without requires_auth, per address
+'''
+
+
+class Limit:
+
+    def __init__(self, name, count, seconds):
+        self.name = name
+        self.burst = count
+        self.rate = count / seconds
+
+    def __repr__(self):
+        return 'Limit(%r, %s/s, burst %s)' % (
+            self.name, self.rate, self.burst)
+
+
+def parse_limit(name, text):
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d*)\s*([a-z]+?)s?\s*', text)
+    if match is None or match.group(3) not in PERIODS or \
+            int(match.group(1)) <= 0:
+        raise ValueError(f'Bad rate limit for {name}: {text!r}, expected '
+                         'e.g. 100/minute')
+    count, multiple, period = match.groups()
+    return Limit(name, int(count),
+                 int(multiple or 1) * PERIODS[period])
+
+
+class RateLimitError(Exception):
+    def __init__(self, limit, retry_after):
+        self.limit = limit
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class RateLimiter:
+
+    def __init__(self, buckets, limits=None, default=None, anonymous=None):
+        self.buckets = buckets
+        self.limits = {name: parse_limit(name, text)
+                       for name, text in (limits or {}).items()}
+        self.default = default and parse_limit('default', default)
+        self.anonymous = anonymous and parse_limit('anonymous', anonymous)
+        self._for_permissions = {}
+        self.allowed = 0
+        self.limited = 0
+
+    def limit_for(self, permissions):
+        '''
+        the strictest limit among `permissions` (a frozenset), else the
+        default
+        '''
+        try:
+            return self._for_permissions[permissions]
+        except KeyError:
+            pass
+        limits = [self.limits[p] for p in permissions if p in self.limits]
+        limit = min(limits, key=lambda limit: limit.rate) if limits else \
+            self.default
+        self._for_permissions[permissions] = limit
+        return limit
+
+    def charge(self, who, limit, cost=1):
+        '''
+        takes a request from `who`'s bucket for `limit`, or raises
+        RateLimitError
+        '''
+        retry_after = self.buckets.take(
+            who + '|' + limit.name, limit.rate, limit.burst, cost)
+        if retry_after is None:
+            self.allowed += cost
+            return
+        self.limited += 1
+        metrics.RATE_LIMITED.labels(limit.name).inc()
+        raise RateLimitError(limit, retry_after)
+
+    def check(self, who, limit):
+        '''
+        raises RateLimitError if `who`'s bucket for `limit` is empty,
+        without taking from it
+        '''
+        self.charge(who, limit, cost=0)
+
+    def stats(self):
+        return {
+            'buckets': len(self.buckets),
+            'allowed': self.allowed,
+            'limited': self.limited
+        }
+
+
+'''
+MemoryBuckets / SQLiteBuckets
+    take(key, rate, burst, cost) takes `cost` requests (one, or none to
+    only look) from the bucket under `key` and returns None, or, when it
+    is empty, the seconds until it holds one again. New buckets start
+    full.
+
+    MemoryBuckets keeps the RATE_LIMIT_BUCKETS most recently used buckets
+    of one process. SQLiteBuckets keeps them in a SQLite file, updated in
+    one short write transaction per request, so every worker on the host
+    sees the same counts.
+'''
+
+
+class MemoryBuckets:
+
+    def __init__(self, maxsize=RATE_LIMIT_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = None
+            if tokens >= 1:
+                tokens -= cost
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteBuckets:
+
+    def __init__(self, path, idle_seconds=RATE_LIMIT_IDLE_SECONDS):
+        self.path = path
+        self.idle_seconds = idle_seconds
+        self._local = threading.local()
+        self._takes = 0
+
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            ' key TEXT PRIMARY KEY,'
+            ' tokens REAL NOT NULL,'
+            ' updated REAL NOT NULL)')
+
+    def _connect(self):
+        # per thread and per process, as in response_cache.SQLiteCache
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, key, rate, burst, cost=1):
+        connection = self._connect()
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so two workers can't
+        # both read the same count and each take the last request
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated FROM buckets WHERE key = ?',
+                (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+            retry_after = None
+            if tokens >= 1:
+                tokens -= cost
+            else:
+                retry_after = (1 - tokens) / rate
+            connection.execute(
+                'INSERT OR REPLACE INTO buckets (key, tokens, updated)'
+                ' VALUES (?, ?, ?)', (key, tokens, now))
+            self._takes += 1
+            if self._takes % PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM buckets WHERE updated < ?',
+                                   (now - self.idle_seconds,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return retry_after
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM buckets').fetchone()[0]
+
+
+'''
+make_rate_limiter(config)
+    the RateLimiter configured by RATE_LIMIT and the limits above, from
+    the app config or the environment, or None when RATE_LIMIT is off
+'''
+
+
+def make_rate_limiter(config):
+    url = _setting(config, 'RATE_LIMIT') or 'none'
+    if url == 'none':
+        return None
+    if url == 'memory':
+        buckets = MemoryBuckets(config.get('RATE_LIMIT_BUCKETS',
+                                           RATE_LIMIT_BUCKETS))
+    elif url.startswith('sqlite:///'):
+        buckets = SQLiteBuckets(url[len('sqlite:///'):])
+    else:
+        raise ValueError(f'Unknown RATE_LIMIT backend: {url!r}')
+
+    limits = _setting(config, 'RATE_LIMITS') or {}
+    if isinstance(limits, str):
+        limits = dict(item.strip().split('=', 1)
+                      for item in limits.split(',') if item.strip())
+    return RateLimiter(buckets, limits,
+                       default=_setting(config, 'RATE_LIMIT_DEFAULT'),
+                       anonymous=_setting(config, 'RATE_LIMIT_ANONYMOUS'))
+
+
+def _setting(config, name):
+    value = config.get(name)
+    return os.getenv(name) if value is None else value
+
+
+def rate_limiter():
+    '''
+    the current app's RateLimiter, or None
+    '''
+    return current_app.extensions.get('rate_limiter')
+
+
+def init_rate_limit(app):
+    limiter = make_rate_limiter(app.config)
+    app.extensions['rate_limiter'] = limiter
+    if limiter is None or limiter.anonymous is None:
+        return
+
+    @app.before_request
+    def limit_anonymous():
+        # endpoints behind requires_auth are limited per subject there
+        view = app.view_functions.get(request.endpoint)
+        if view is None or hasattr(view, 'required_permissions'):
+            return
+        limiter.charge('ip:%s' % request.remote_addr, limiter.anonymous)
@@ -0,0 +1,417 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from flask import _request_ctx_stack, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.dml import UpdateBase
+
+import metrics
+from dbpool import engine_options, setting
+
+logger = logging.getLogger(__name__)
+
+REPLICA_CHECK_INTERVAL = 5
+REPLICA_MAX_LAG = 10
+READ_YOUR_WRITES_SECONDS = 5
+REPLICA_CONNECT_TIMEOUT = 2
+MAX_PINS = 100000
+# shared by the workers on the host unless REPLICA_PINS says otherwise
+REPLICA_PINS = 'sqlite:///' + os.path.join(tempfile.gettempdir(),
+                                           'casting-pins.db')
+
+READ_METHODS = ('GET', 'HEAD')
+
+POSTGRES_LAG = text(
+    'SELECT CASE WHEN NOT pg_is_in_recovery() '
+    'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE coalesce(extract(epoch FROM now() - '
+    'pg_last_xact_replay_timestamp()), 0) END')
+TABLE_VERSIONS = text('SELECT name, version, updated_at FROM table_versions')
+
+'''
+Read replicas
+    with DATABASE_REPLICA_URLS set (a list in the app config, or a
+    comma-separated environment variable), the queries of GET and HEAD
+    requests go to the replicas in turn and everything else stays on the
+    primary (SQLALCHEMY_DATABASE_URI). Each request reads from one
+    database throughout.
+
+    read-your-writes: a caller whose request committed a write is pinned
+    to the primary for READ_YOUR_WRITES_SECONDS, so their next reads see
+    it, whichever worker serves them. Callers are told apart by the token
+    subject. Pins go in REPLICA_PINS: a SQLite file every worker on the
+    host shares (by default one in the temp directory), or 'memory' for a
+    single process.
+
+    replicas are checked every REPLICA_CHECK_INTERVAL seconds, in a
+    background thread started by whichever request comes first (requests
+    never wait on a check): one that can't be reached, or lags the primary
+    by more than REPLICA_MAX_LAG seconds, gets no reads until a later check
+    finds it healthy. With no healthy replica, reads go to the primary.
+    Lag comes from the WAL replay position on Postgres, and from comparing
+    table_versions with the primary elsewhere (an upper bound: the time
+    since the replica last saw a table the primary has written since).
+
+    a replica that drops or refuses a connection between checks is taken
+    out at once, and the request that hit it is run again on the primary
+    (GET and HEAD views only read, so that is safe). Postgres replicas
+    give up connecting after REPLICA_CONNECT_TIMEOUT seconds.
+
+    pools for the replicas are sized like the primary's (see dbpool.py).
+'''
+
+
+class Replica:
+
+    def __init__(self, index, url, options):
+        self.name = str(index)
+        self.url = url
+        self.engine = create_engine(url, **options)
+        self.healthy = True
+        self.lag = 0.0
+        self.error = None
+        event.listen(self.engine, 'handle_error', self._on_error)
+
+    def _on_error(self, context):
+        # a dropped or refused connection takes it out until the next check
+        if context.is_disconnect or context.connection is None:
+            self.healthy = False
+            self.error = str(context.original_exception)
+
+
+class ReplicaSet:
+
+    def __init__(self, urls, options, primary, pins=None,
+                 check_interval=REPLICA_CHECK_INTERVAL,
+                 max_lag=REPLICA_MAX_LAG,
+                 pin_seconds=READ_YOUR_WRITES_SECONDS):
+        self.replicas = [Replica(i, url, options)
+                         for i, url in enumerate(urls)]
+        self.primary = primary
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.pin_seconds = pin_seconds
+        self._next = 0
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        self._checker = None
+        self.pins = MemoryPins() if pins is None else pins
+
+    def choose(self):
+        '''
+        returns the engine of the next healthy replica, or None
+        '''
+        self.check_if_due()
+        with self._lock:
+            healthy = [r for r in self.replicas if r.healthy]
+            if not healthy:
+                return None
+            replica = healthy[self._next % len(healthy)]
+            self._next += 1
+        return replica.engine
+
+    def check_if_due(self):
+        now = time.monotonic()
+        if self._checked_at is not None and \
+                now - self._checked_at < self.check_interval:
+            return
+        # one thread checks, requests carry on with the last result
+        if not self._check_lock.acquire(blocking=False):
+            return
+        self._checked_at = now
+
+        def run():
+            try:
+                self.check()
+            except Exception:
+                logger.exception('Replica check failed')
+            finally:
+                self._check_lock.release()
+
+        self._checker = threading.Thread(
+            target=run, name='replica-check', daemon=True)
+        self._checker.start()
+
+    def check(self):
+        primary_versions = None
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    if connection.dialect.name == 'postgresql':
+                        lag = float(connection.scalar(POSTGRES_LAG))
+                    else:
+                        if primary_versions is None:
+                            with self.primary() as primary:
+                                primary_versions = _versions(primary)
+                        lag = _version_lag(primary_versions,
+                                           _versions(connection))
+            except Exception as e:
+                replica.healthy, replica.lag = False, None
+                replica.error = str(e)
+                logger.warning('Replica %s is unreachable: %s',
+                               replica.name, e)
+                continue
+
+            replica.lag, replica.error = lag, None
+            replica.healthy = lag <= self.max_lag
+            if not replica.healthy:
+                logger.warning('Replica %s lags by %.1f s, over %s s',
+                               replica.name, lag, self.max_lag)
+        self._checked_at = time.monotonic()
+
+    def failed(self, engine):
+        '''
+        whether `engine` is a replica taken out since it was chosen
+        '''
+        return any(replica.engine is engine and not replica.healthy
+                   for replica in self.replicas)
+
+    def pin(self, subject):
+        self.pins.pin(subject, time.time() + self.pin_seconds)
+
+    def pinned(self, subject):
+        return self.pins.pinned(subject)
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def stats(self):
+        lags = [r.lag for r in self.replicas if r.lag is not None]
+        return {
+            'configured': len(self.replicas),
+            'healthy': sum(r.healthy for r in self.replicas),
+            'max_lag_seconds': max(lags) if lags else 0,
+            'pinned_subjects': self.pins.count()
+        }
+
+
+'''
+MemoryPins / SQLitePins
+    pin(subject, until) sends `subject`'s reads to the primary until the
+    time.time() `until`; pinned(subject) tells whether it still is;
+    count() is the number of subjects pinned now.
+
+    MemoryPins keeps up to MAX_PINS subjects in one process. SQLitePins
+    keeps them in a SQLite file, so a write served by one worker pins the
+    caller's reads on all of them (as rate_limit.SQLiteBuckets does for
+    rate limits).
+'''
+
+
+class MemoryPins:
+
+    def __init__(self, maxsize=MAX_PINS):
+        self.maxsize = maxsize
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    def pin(self, subject, until):
+        with self._lock:
+            if len(self._pins) >= self.maxsize:
+                now = time.time()
+                self._pins = {s: t for s, t in self._pins.items()
+                              if t > now}
+            self._pins[subject] = until
+
+    def pinned(self, subject):
+        until = self._pins.get(subject)
+        return until is not None and until > time.time()
+
+    def count(self):
+        now = time.time()
+        return sum(until > now for until in list(self._pins.values()))
+
+
+class SQLitePins:
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS pins ('
+            ' subject TEXT PRIMARY KEY,'
+            ' until REAL NOT NULL)')
+
+    def _connect(self):
+        # per thread and per process, as in rate_limit.SQLiteBuckets
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def pin(self, subject, until):
+        connection = self._connect()
+        connection.execute(
+            'INSERT OR REPLACE INTO pins (subject, until) VALUES (?, ?)',
+            (subject, until))
+        # pins last seconds: drop the expired ones as new ones come in
+        connection.execute('DELETE FROM pins WHERE until < ?',
+                           (time.time(),))
+
+    def pinned(self, subject):
+        return self._connect().execute(
+            'SELECT 1 FROM pins WHERE subject = ? AND until > ?',
+            (subject, time.time())).fetchone() is not None
+
+    def count(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM pins WHERE until > ?',
+            (time.time(),)).fetchone()[0]
+
+
+def make_pins(config):
+    '''
+    the pin store REPLICA_PINS names, from the app config or the
+    environment
+    '''
+    url = config.get('REPLICA_PINS') or os.getenv('REPLICA_PINS') or \
+        REPLICA_PINS
+    if url == 'memory':
+        return MemoryPins()
+    if url.startswith('sqlite:///'):
+        return SQLitePins(url[len('sqlite:///'):])
+    raise ValueError(f'Unknown REPLICA_PINS store: {url!r}')
+
+
+def _versions(connection):
+    return {name: (version, updated_at) for name, version, updated_at
+            in connection.execute(TABLE_VERSIONS)}
+
+
+def _version_lag(primary, replica):
+    lag = 0.0
+    for name, (version, updated_at) in primary.items():
+        seen_version, seen_at = replica.get(name, (0, None))
+        if seen_version < version:
+            since = seen_at or updated_at
+            if isinstance(since, str):  # SQLite through plain SQL
+                since = datetime.fromisoformat(since)
+            lag = max(lag, (datetime.utcnow() - since).total_seconds())
+    return lag
+
+
+'''
+RoutingSession
+    the session db.session hands out: picks the database for each request
+    the first time it needs one (see read_engine) and keeps to it; flushes
+    and INSERT / UPDATE / DELETE statements always go to the primary
+'''
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not isinstance(clause, UpdateBase):
+            engine = read_engine(self.app)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_engine(app):
+    '''
+    returns the replica engine the current request reads from, or None
+    for the primary
+    '''
+    replicas = app.extensions.get('replicas')
+    if replicas is None or not has_request_context() or \
+            request.method not in READ_METHODS:
+        return None
+
+    # kept on the request context: g can outlive a request (e.g. under a
+    # test client inside an app context)
+    ctx = _request_ctx_stack.top
+    if not hasattr(ctx, 'db_replica'):
+        subject = g.get('subject')
+        if subject is not None and replicas.pinned(subject):
+            ctx.db_replica = None
+        else:
+            ctx.db_replica = replicas.choose()
+        metrics.DB_ROUTES.labels(
+            'primary' if ctx.db_replica is None else 'replica').inc()
+    return ctx.db_replica
+
+
+def use_primary():
+    '''
+    sends the rest of the current request's reads to the primary, e.g.
+    for a command run under a GET test request context
+    '''
+    if has_request_context():
+        _request_ctx_stack.top.db_replica = None
+
+
+def init_replicas(app, db):
+    urls = app.config.get('DATABASE_REPLICA_URLS') or \
+        os.getenv('DATABASE_REPLICA_URLS', '')
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+    if not urls:
+        app.extensions['replicas'] = None
+        return None
+
+    def primary():
+        return db.get_engine(app).connect()
+
+    options = engine_options(app.config, urls[0])
+    if make_url(urls[0]).get_backend_name() == 'postgresql':
+        connect_args = dict(options.get('connect_args') or {})
+        connect_args.setdefault('connect_timeout', setting(
+            app.config, 'REPLICA_CONNECT_TIMEOUT', int,
+            REPLICA_CONNECT_TIMEOUT))
+        options['connect_args'] = connect_args
+
+    replicas = ReplicaSet(
+        urls, options, primary, make_pins(app.config),
+        check_interval=setting(app.config, 'REPLICA_CHECK_INTERVAL', float,
+                               REPLICA_CHECK_INTERVAL),
+        max_lag=setting(app.config, 'REPLICA_MAX_LAG', float,
+                        REPLICA_MAX_LAG),
+        pin_seconds=setting(app.config, 'READ_YOUR_WRITES_SECONDS', float,
+                            READ_YOUR_WRITES_SECONDS))
+    app.extensions['replicas'] = replicas
+
+    @app.errorhandler(DBAPIError)
+    def retry_read_on_primary(error):
+        engine = getattr(_request_ctx_stack.top, 'db_replica', None)
+        if engine is None or not replicas.failed(engine):
+            raise error
+        logger.warning('Replica failed, reading from the primary: %s', error)
+        db.session.rollback()
+        use_primary()
+        try:
+            return app.dispatch_request()
+        except Exception as e:
+            return app.handle_user_exception(e)
+
+    return replicas
+
+
+def pin_writer(replicas):
+    '''
+    pins the caller of the current request to the primary; connected to
+    models.tables_committed
+    '''
+    if has_request_context() and g.get('subject') is not None:
+        replicas.pin(g.subject)
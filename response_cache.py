@@ -0,0 +1,217 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_MAX_BYTES = 64 * 2 ** 20
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 2 * 2 ** 20
+
+'''
+Response cache backends
+    both store (status, mimetype, body) under a key and remember which
+    tables each entry was built from, so a write can drop them.
+
+    MemoryCache is a per-process LRU bounded by entry count and total
+    bytes. SQLiteCache keeps entries in a SQLite file that every gunicorn
+    worker on the host opens, so one worker's response serves the others
+    and one worker's invalidation clears it for all of them.
+
+    keys already contain the tables' version counters (see
+    http_cache.conditional), so an entry written before a commit can
+    never be served after it even if an invalidation is missed; the
+    invalidation just frees the space early.
+'''
+
+
+class CacheStats:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def as_dict(self, entries, size):
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+class MemoryCache:
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._by_table = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = CacheStats()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters.hits += 1
+            return entry[0]
+
+    def set(self, key, value, tables):
+        size = len(value[2])
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, tables)
+            self._bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while self._entries and (len(self._entries) > self.maxsize or
+                                     self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tables):
+        with self._lock:
+            for table in tables:
+                for key in self._by_table.pop(table, ()):
+                    if key in self._entries:
+                        self._remove(key)
+            self.counters.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_table.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return self.counters.as_dict(len(self._entries), self._bytes)
+
+    def _remove(self, key):
+        value, tables = self._entries.pop(key)
+        self._bytes -= len(value[2])
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+
+
+class SQLiteCache:
+
+    def __init__(self, path, maxsize=RESPONSE_CACHE_SIZE,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self.counters = CacheStats()
+
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY,'
+                ' tables TEXT NOT NULL,'
+                ' status INTEGER NOT NULL,'
+                ' mimetype TEXT NOT NULL,'
+                ' body BLOB NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' accessed REAL NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed'
+                ' ON responses (accessed)')
+
+    def _connect(self):
+        # one connection per thread (and per process: after a fork the
+        # pid changes and the inherited connection is not reused)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        connection = self._connect()
+        row = connection.execute(
+            'SELECT status, mimetype, body FROM responses WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            self.counters.misses += 1
+            return None
+        connection.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                           (time.time(), key))
+        self.counters.hits += 1
+        return row[0], row[1], bytes(row[2])
+
+    def set(self, key, value, tables):
+        status, mimetype, body = value
+        connection = self._connect()
+        connection.execute(
+            'INSERT OR REPLACE INTO responses'
+            ' (key, tables, status, mimetype, body, size, accessed)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, ',%s,' % ','.join(tables), status, mimetype, body,
+             len(body), time.time()))
+        self._prune(connection)
+
+    def invalidate(self, tables):
+        connection = self._connect()
+        for table in tables:
+            connection.execute('DELETE FROM responses WHERE tables LIKE ?',
+                               ('%%,%s,%%' % table,))
+        self.counters.invalidations += 1
+
+    def clear(self):
+        self._connect().execute('DELETE FROM responses')
+
+    def stats(self):
+        entries, size = self._connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()
+        return self.counters.as_dict(entries, size)
+
+    def _prune(self, connection):
+        entries, size = connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()
+        if entries <= self.maxsize and size <= self.max_bytes:
+            return
+        # drop the least recently used quarter in one statement
+        connection.execute(
+            'DELETE FROM responses WHERE key IN (SELECT key FROM responses'
+            ' ORDER BY accessed LIMIT ?)', (max(1, entries // 4),))
+
+
+'''
+make_cache(config)
+    the backend named by RESPONSE_CACHE: 'memory' (the default), a path
+    such as 'sqlite:////var/run/casting/cache.db', or '' / 'none' to turn
+    caching off
+'''
+
+
+def make_cache(config):
+    url = config.get('RESPONSE_CACHE', 'memory')
+    maxsize = config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE)
+    max_bytes = config.get('RESPONSE_CACHE_MAX_BYTES',
+                           RESPONSE_CACHE_MAX_BYTES)
+
+    if not url or url == 'none':
+        return None
+    if url == 'memory':
+        return MemoryCache(maxsize, max_bytes)
+    if url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):], maxsize, max_bytes)
+    raise ValueError(f'Unknown RESPONSE_CACHE backend: {url!r}')
@@ -0,0 +1,216 @@
+from functools import wraps
+
+from flask import abort, current_app, json, request
+
+from models import Actor, Movie
+
+# request bodies over this many bytes get a 413 (app config overrides)
+MAX_CONTENT_LENGTH = 1024 * 1024
+BULK_MAX_ITEMS = 10000
+READ_CHUNK_BYTES = 64 * 1024
+
+'''
+ValidationError
+    raised when a request body doesn't match its schema. `errors` holds
+    {field: message} for a single object, or a list of
+    {'index': i, 'errors': {field: message}} for a batch.
+'''
+
+
+class ValidationError(Exception):
+    def __init__(self, message, errors=None):
+        self.message = message
+        self.errors = errors or []
+
+
+'''
+Fields(model, partial=False, with_id=False)
+    a schema for one JSON object holding a model's writable fields
+    (model.PARSERS), compiled once into a tuple of (field, attribute,
+    parser) so checking a body is one pass over it
+
+    validate() returns the body as attribute values, coerced by the
+    parsers (release_year to a date, age to an int): every field is
+    required unless `partial`, in which case at least one is. With
+    `with_id` the object must also carry a positive integer id (bulk
+    updates). Unknown fields are rejected.
+'''
+
+
+class Fields:
+
+    def __init__(self, model, partial=False, with_id=False):
+        self.partial = partial
+        self.with_id = with_id
+        self.fields = tuple((name, model.FIELDS[name], parser)
+                            for name, parser in model.PARSERS.items())
+        self.known = frozenset(model.PARSERS) | {'id'}
+
+    def check(self, item):
+        '''
+        returns (values, {field: message}) for one object
+        '''
+        if not isinstance(item, dict):
+            return None, {'item': 'Expected an object.'}
+
+        values = {}
+        errors = {}
+        if self.with_id:
+            if is_id(item.get('id')):
+                values['id'] = item['id']
+            else:
+                errors['id'] = 'A positive integer id is required.'
+
+        for name, attribute, parser in self.fields:
+            if name in item:
+                try:
+                    values[attribute] = parser(item[name])
+                except ValueError as e:
+                    errors[name] = str(e)
+            elif not self.partial:
+                errors[name] = 'This field is required.'
+
+        if not self.known.issuperset(item):
+            for name in item.keys() - self.known:
+                errors[name] = 'Unknown field.'
+        if self.partial and len(values) == (1 if self.with_id else 0) \
+                and not errors:
+            errors['item'] = 'Nothing to update.'
+        return values, errors
+
+    def validate(self, body):
+        values, errors = self.check(body)
+        if errors:
+            raise ValidationError('The request body is invalid.', errors)
+        return values
+
+
+'''
+Items(key, fields) / Ids(key)
+    schemas for batch bodies: {key: [object, ...]} checked item by item
+    against `fields`, and {key: [id, ...]}. A batch is rejected whole,
+    listing every offending item, and may hold at most BULK_MAX_ITEMS.
+'''
+
+
+class Items:
+
+    def __init__(self, key, fields):
+        self.key = key
+        self.fields = fields
+
+    def validate(self, body):
+        items = _batch(body, self.key, 'items')
+        mappings = []
+        errors = []
+        for index, item in enumerate(items):
+            values, item_errors = self.fields.check(item)
+            if item_errors:
+                errors.append({'index': index, 'errors': item_errors})
+            else:
+                mappings.append(values)
+        if errors:
+            raise ValidationError('Some items are invalid.', errors)
+        return mappings
+
+
+class Ids:
+
+    def __init__(self, key):
+        self.key = key
+
+    def validate(self, body):
+        ids = _batch(body, self.key, 'ids')
+        errors = [{'index': index, 'errors': {
+            'id': 'A positive integer id is required.'}}
+            for index, value in enumerate(ids) if not is_id(value)]
+        if errors:
+            raise ValidationError('Some ids are invalid.', errors)
+        return ids
+
+
+def _batch(body, key, what):
+    if not isinstance(body, dict):
+        raise ValidationError('Expected a JSON object.')
+    items = body.get(key)
+    if not isinstance(items, list) or not items:
+        raise ValidationError(f'Expected a non-empty list of {what}.')
+
+    max_items = current_app.config.get('BULK_MAX_ITEMS', BULK_MAX_ITEMS)
+    if len(items) > max_items:
+        raise ValidationError(
+            f'At most {max_items} {what} can be sent at once.')
+    return items
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) \
+        and value > 0
+
+
+# the write endpoints' bodies, compiled at import
+MOVIE = Fields(Movie)
+MOVIE_PATCH = Fields(Movie, partial=True)
+MOVIES = Items('movies', MOVIE)
+MOVIES_PATCH = Items('movies', Fields(Movie, partial=True, with_id=True))
+ACTOR = Fields(Actor)
+ACTOR_PATCH = Fields(Actor, partial=True)
+ACTORS = Items('actors', ACTOR)
+ACTORS_PATCH = Items('actors', Fields(Actor, partial=True, with_id=True))
+IDS = Ids('ids')
+ACTOR_IDS = Ids('actor_ids')
+
+'''
+@validate_body(schema)
+    checks the request body against `schema` and passes the result to
+    the endpoint as `body`
+
+    goes above @requires_auth, so oversized (413) and malformed (422)
+    bodies are turned away before the token is verified or the database
+    is touched. The size is checked on the bytes read, not just the
+    Content-Length: a chunked body has none, and the server hands the
+    whole stream over.
+'''
+
+
+def validate_body(schema):
+    def validate_body_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            max_length = current_app.config.get(
+                'MAX_CONTENT_LENGTH', MAX_CONTENT_LENGTH)
+            data = read_body(max_length)
+            body = None
+            if request.is_json:
+                try:
+                    body = json.loads(data)
+                except ValueError:
+                    pass
+            kwargs['body'] = schema.validate(body)
+            return f(*args, **kwargs)
+
+        return wrapper
+    return validate_body_decorator
+
+
+def read_body(max_length):
+    '''
+    the request body, read up to one byte past `max_length` (None for no
+    limit); aborts with 413 when it is longer, however it is framed
+    '''
+    if max_length is None:
+        return request.get_data(cache=False)
+    if (request.content_length or 0) > max_length:
+        abort(413)
+
+    chunks = []
+    remaining = max_length + 1
+    while remaining > 0:
+        chunk = request.stream.read(min(remaining, READ_CHUNK_BYTES))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    if remaining <= 0:
+        abort(413)
+    return b''.join(chunks)
@@ -0,0 +1,172 @@
+import re
+
+from flask import abort, current_app, request
+from sqlalchemy import text
+
+from models import db
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+MAX_QUERY_TERMS = 8
+# matches ranked per kind, see search()
+SEARCH_MAX_CANDIDATES = 10000
+
+# ?type= -> (result type, table, searched column, FTS5 table)
+SEARCH_KINDS = {
+    'movies': ('movie', 'Movies', 'title', 'movies_fts'),
+    'actors': ('actor', 'Actors', 'name', 'actors_fts')}
+
+'''
+search_args()
+    reads the search parameters of the current request
+
+    ?q=       words to look for; each is matched as a prefix ('dun' finds
+              'Dune'), all of them must match
+    ?type=    'movies' or 'actors' to search only one of them
+    ?limit=   page size, capped at MAX_SEARCH_PAGE_SIZE
+    ?cursor=  the next_cursor of the previous page
+
+    aborts with 400 on a query with no words or a bad limit or cursor
+'''
+
+
+def search_args():
+    terms = re.findall(r'\w+', request.args.get('q', '').lower())
+    if not terms:
+        abort(400)
+
+    kind = request.args.get('type')
+    if kind is not None and kind not in SEARCH_KINDS:
+        abort(400)
+
+    config = current_app.config
+    limit = request.args.get('limit', config.get(
+        'SEARCH_PAGE_SIZE', SEARCH_PAGE_SIZE))
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, config.get(
+        'MAX_SEARCH_PAGE_SIZE', MAX_SEARCH_PAGE_SIZE))
+
+    return (terms[:MAX_QUERY_TERMS], [kind] if kind else list(SEARCH_KINDS),
+            limit, _parse_cursor(request.args.get('cursor')))
+
+
+'''
+search(terms, kinds, limit, cursor)
+    returns (results, next_cursor, truncated): the best `limit` matches
+    for `terms` in the given kinds, best first
+
+    every kind is searched through its index (see the search DDL in
+    models.py) and scored: ts_rank plus trigram similarity on Postgres,
+    bm25 on SQLite. Each kind keeps its SEARCH_MAX_CANDIDATES best
+    matches, ranked inside the index query (on SQLite from the FTS5 table
+    alone, before the join), so a word most rows share never sorts or
+    joins every row. `truncated` is true when a kind has more matches
+    than that: the pages then hold the best ones only, and the caller
+    should narrow the query rather than page further.
+
+    pages follow a keyset cursor on (score, type, id), applied in each
+    kind's query along with the page size, so each kind hands over at
+    most one page and the kinds are merged from those. A deep page still
+    ranks the matches again, but keeps no more than the cap.
+'''
+
+
+def search(terms, kinds, limit, cursor=None):
+    dialect = db.session.bind.dialect.name
+    if dialect == 'postgresql':
+        queries = [_postgres_queries(kind) for kind in kinds]
+        params = {'tsquery': ' & '.join(t + ':*' for t in terms),
+                  'q': ' '.join(terms)}
+    elif dialect == 'sqlite':
+        queries = [_sqlite_queries(kind) for kind in kinds]
+        params = {'match': ' '.join('"%s"*' % t for t in terms)}
+    else:
+        raise NotImplementedError(f'search is not supported on {dialect}')
+
+    where = ''
+    if cursor is not None:
+        where = ('WHERE score < :score OR (score = :score AND '
+                 '(type > :type OR (type = :type AND id > :id)))')
+        params.update(zip(('score', 'type', 'id'), cursor))
+    params['limit'] = limit + 1
+    params['candidates'] = current_app.config.get(
+        'SEARCH_MAX_CANDIDATES', SEARCH_MAX_CANDIDATES)
+    params['over'] = params['candidates'] + 1
+
+    pages = [
+        'SELECT * FROM (SELECT * FROM (%s) AS candidates '
+        '%s ORDER BY score DESC, id LIMIT :limit) AS page_%d' % (
+            ranked, where, i)
+        for i, (ranked, _) in enumerate(queries)]
+    rows = db.session.execute(text(
+        'SELECT type, id, label, score FROM (%s) AS matches '
+        'ORDER BY score DESC, type, id LIMIT :limit' % (
+            ' UNION ALL '.join(pages))), params).fetchall()
+
+    # stops counting one past the cap, so this never reads every match
+    counts = db.session.execute(text('SELECT %s' % ', '.join(
+        '(SELECT count(*) FROM (%s LIMIT :over) AS matches_%d)' % (
+            matches, i)
+        for i, (_, matches) in enumerate(queries))), params).first()
+    truncated = any(count > params['candidates'] for count in counts)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = '%r:%s:%d' % (last.score, last.type, last.id)
+
+    fields = {kind: column for kind, _, column, _ in SEARCH_KINDS.values()}
+    return [{
+        'type': row.type,
+        'id': row.id,
+        fields[row.type]: row.label,
+        'score': row.score
+    } for row in rows], next_cursor, truncated
+
+
+def _postgres_queries(kind):
+    name, table, column, _ = SEARCH_KINDS[kind]
+    names = {'name': name, 'table': table, 'column': column,
+             'vector': "to_tsvector('simple', coalesce(%s, ''))" % column}
+    names['matching'] = (
+        "FROM \"%(table)s\", to_tsquery('simple', :tsquery) AS query "
+        "WHERE %(vector)s @@ query OR %(column)s %% :q" % names)
+    ranked = (
+        "SELECT '%(name)s' AS type, id, %(column)s AS label, "
+        "CAST(ts_rank(%(vector)s, query) + similarity(%(column)s, :q) "
+        "AS double precision) AS score %(matching)s "
+        "ORDER BY score DESC, id LIMIT :candidates" % names)
+    return ranked, 'SELECT 1 ' + names['matching']
+
+
+def _sqlite_queries(kind):
+    name, table, column, fts_table = SEARCH_KINDS[kind]
+    names = {'name': name, 'table': table, 'column': column,
+             'fts': fts_table}
+    names['matching'] = 'FROM %(fts)s WHERE %(fts)s MATCH :match' % names
+    ranked = (
+        "SELECT '%(name)s' AS type, t.id AS id, t.%(column)s AS label, "
+        "best.score AS score "
+        "FROM (SELECT rowid, -bm25(%(fts)s) AS score %(matching)s "
+        "ORDER BY bm25(%(fts)s), rowid LIMIT :candidates) AS best "
+        "JOIN \"%(table)s\" AS t ON t.id = best.rowid" % names)
+    return ranked, 'SELECT 1 ' + names['matching']
+
+
+def _parse_cursor(value):
+    if not value:
+        return None
+    try:
+        score, kind, id = value.rsplit(':', 2)
+        cursor = float(score), kind, int(id)
+    except ValueError:
+        abort(400)
+    if kind not in [name for name, _, _, _ in SEARCH_KINDS.values()]:
+        abort(400)
+    return cursor
@@ -1,50 +1,308 @@
+import gzip
+import io
 import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import json
-from flask_sqlalchemy import SQLAlchemy
+from datetime import date, datetime, timedelta, timezone
 
+import auth
+import bulk
+import encoding
+import metrics
 from app import create_app
-from models import setup_db, Actor, Movie
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import StaticPool
+from werkzeug.http import http_date
+from werkzeug.test import Client
 
-TEST_DB_NAME = os.getenv('TEST_DB_URL')
+from dbpool import InstrumentedQueuePool, engine_options, pool_stats
+from jwks import JWKSCache
+from local_auth import LocalIssuer
+from token_cache import TokenCache
+from rate_limit import SQLiteBuckets, parse_limit
+from models import db, dispose_engine, Actor, Casting, Movie, TableVersion
+from response_cache import MemoryCache, SQLiteCache
 
+# in-memory SQLite, or the Postgres database at TEST_DB_URL (with a schema
+# per pytest-xdist worker)
+TEST_DB_URL = os.getenv('TEST_DB_URL') or 'sqlite://'
 
-class CapstoneTestCase(unittest.TestCase):
-    """This class represents the trivia test case"""
+# one keypair per test process, published as a file:// JWKS
+ISSUER = LocalIssuer()
+JWKS_DIR = tempfile.TemporaryDirectory()
+JWKS_URL = ISSUER.write_jwks(os.path.join(JWKS_DIR.name, 'jwks.json'))
+
+# what the Auth0 test tokens in setup.sh carried
+ALL_PERMISSIONS = (
+    'get:movies', 'post:movies', 'patch:movies', 'delete:movies',
+    'get:actors', 'post:actors', 'patch:actors', 'delete:actors')
+
+_engine = None
+
+
+def shared_engine():
+    '''
+    the engine the transactional tests share, with the schema created on
+    first use
+    '''
+    global _engine
+    if _engine is not None:
+        return _engine
+
+    if make_url(TEST_DB_URL).get_backend_name() == 'sqlite':
+        engine = create_engine(TEST_DB_URL, poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+
+        # pysqlite only handles SAVEPOINT when SQLAlchemy emits BEGIN
+        @event.listens_for(engine, 'connect')
+        def no_implicit_begin(dbapi_connection, record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.execute('BEGIN')
+    else:
+        # xdist workers each get a schema, so they never wait on each
+        # other's locks
+        schema = 'test_%s' % os.getenv('PYTEST_XDIST_WORKER', 'main')
+        engine = create_engine(TEST_DB_URL, connect_args={
+            'options': '-c search_path=%s' % schema})
+        with engine.begin() as connection:
+            connection.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+            connection.execute('CREATE SCHEMA %s' % schema)
+
+    db.metadata.create_all(engine)
+    _engine = engine
+    return engine
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """Tests for the process-wide JWKS key store"""
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
-        self.database_name = "capstone_test"
-        self.database_path = TEST_DB_NAME
-        # Define tokens for testing
-        self.actors_token = os.getenv('ACTORS_TOKEN')
-        self.movies_token = os.getenv('MOVIES_TOKEN')
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        self.issuer = LocalIssuer()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'jwks.json')
+        self.url = self.issuer.write_jwks(self.path)
 
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        self.tmp.cleanup()
 
+    def test_keys_are_fetched_once(self):
+        cache = JWKSCache(self.url)
+        self.assertIsNotNone(cache.get_key(self.issuer.kid))
+        self.assertIsNotNone(cache.get_key(self.issuer.kid))
+        self.assertEqual(cache.fetch_count, 1)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        cache = JWKSCache(self.url, min_refetch_interval=60)
+        cache.get_key(self.issuer.kid)
+        for _ in range(10):
+            self.assertIsNone(cache.get_key('forged'))
+        self.assertEqual(cache.fetch_count, 1)
+
+    def test_unknown_kid_triggers_refetch(self):
+        cache = JWKSCache(self.url, min_refetch_interval=0)
+        cache.get_key(self.issuer.kid)
+        rotated = LocalIssuer()
+        rotated.write_jwks(self.path)
+        self.assertIsNotNone(cache.get_key(rotated.kid))
+        self.assertEqual(cache.fetch_count, 2)
+
+    def test_stale_keys_served_when_issuer_unreachable(self):
+        cache = JWKSCache(self.url, ttl=0, min_refetch_interval=0)
+        cache.get_key(self.issuer.kid)
+        os.remove(self.path)
+        self.assertIsNotNone(cache.get_key(self.issuer.kid))
+        self.assertEqual(cache.fetch_errors, 1)
+
+    def test_verify_decode_jwt_uses_cache(self):
+        cache = JWKSCache(self.url)
+        saved = (auth.jwks, auth.AUTH0_DOMAIN, auth.API_AUDIENCE,
+                 auth.ALGORITHMS)
+        auth.jwks = cache
+        auth.AUTH0_DOMAIN = self.issuer.domain
+        auth.API_AUDIENCE = self.issuer.audience
+        auth.ALGORITHMS = ['RS256']
+        try:
+            token = self.issuer.token(['get:movies'])
+            for _ in range(3):
+                payload = auth.verify_decode_jwt(token)
+            self.assertEqual(payload['permissions'], ['get:movies'])
+            self.assertEqual(cache.fetch_count, 1)
+        finally:
+            (auth.jwks, auth.AUTH0_DOMAIN, auth.API_AUDIENCE,
+             auth.ALGORITHMS) = saved
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """Tests for the verified-token cache"""
+
+    def test_hit_returns_payload(self):
+        cache = TokenCache(maxsize=2)
+        payload = {'exp': time.time() + 60, 'permissions': []}
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', payload, payload['exp'])
+        self.assertIs(cache.get('a'), payload)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_entries_expire_at_exp(self):
+        cache = TokenCache()
+        cache.put('a', {}, time.time() - 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.expirations, 1)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.put('a', {}, exp)
+        cache.put('b', {}, exp)
+        cache.get('a')
+        cache.put('c', {}, exp)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_decode_token_skips_verification_on_hit(self):
+        issuer = LocalIssuer()
+        with tempfile.TemporaryDirectory() as tmp:
+            auth.configure(
+                domain=issuer.domain,
+                audience=issuer.audience,
+                algorithms=['RS256'],
+                jwks_url=issuer.write_jwks(os.path.join(tmp, 'jwks.json')))
+            token = issuer.token(['get:movies'])
+            first = auth.decode_token(token)
+            fetches = auth.jwks.fetch_count
+            auth.jwks.clear()
+            self.assertIs(auth.decode_token(token), first)
+            self.assertEqual(auth.jwks.fetch_count, fetches)
+
+
+class CheckPermissionsTestCase(unittest.TestCase):
+    """Tests for permission matching in check_permissions"""
+
+    payload = {'permissions': ['get:movies', 'get:actors']}
+
+    def test_all_required(self):
+        self.assertTrue(auth.check_permissions(
+            ['get:movies', 'get:actors'], self.payload))
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions(
+                ['get:movies', 'post:movies'], self.payload)
+
+    def test_any_required(self):
+        self.assertTrue(auth.check_permissions(
+            ['post:movies', 'get:movies'], self.payload, match='any'))
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions(
+                ['post:movies', 'post:actors'], self.payload, match='any')
+
+    def test_missing_permissions_claim(self):
+        with self.assertRaises(auth.AuthError) as ctx:
+            auth.check_permissions('get:movies', {})
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    def test_invalid_match(self):
+        with self.assertRaises(ValueError):
+            auth.requires_auth('get:movies', match='some')
+
+
+class ApiTestCase(unittest.TestCase):
+    """Runs the API against the test database and a local token issuer
+
+    every test runs in a transaction on one connection of shared_engine(),
+    rolled back afterwards; a commit in the app only releases a savepoint.
+    Tests never see each other's rows, so they can run in parallel
+    (pytest -n auto).
     """
-    TODO
-    Write at least one test for each test for successful operation and for expected errors.
-    """
+
+    # passed to create_app() for every test of the class
+    config = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.issuer = ISSUER
+        auth.configure(
+            domain=ISSUER.domain,
+            audience=ISSUER.audience,
+            algorithms=['RS256'],
+            jwks_url=JWKS_URL)
+
+    def setUp(self):
+        self.app = create_app(dict(
+            {'SQLALCHEMY_DATABASE_URI': TEST_DB_URL}, **self.config))
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        self.engine = shared_engine()
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+        if self.connection.dialect.name == 'postgresql':
+            # ids start from 1 in every test, as on SQLite; rolled back
+            # with the rest
+            self.connection.execute('TRUNCATE %s RESTART IDENTITY CASCADE' % (
+                ', '.join('"%s"' % table.name
+                          for table in db.metadata.sorted_tables)))
+
+        # Flask-SQLAlchemy's per-table binds would win over bind
+        factory = db.session.session_factory
+        self.addCleanup(setattr, factory, 'kw', dict(factory.kw))
+        db.session.remove()
+        db.session.configure(bind=self.connection, binds={})
+        self.session = session = db.session()
+        session.begin_nested()
+        # SAVEPOINT now, not in the middle of the next request's queries
+        session.connection()
+
+        def restart_savepoint(session, transaction):
+            # the app committed or rolled back
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+                session.connection()
+
+        event.listen(session, 'after_transaction_end', restart_savepoint)
+        self.restart_savepoint = restart_savepoint
+
+    def tearDown(self):
+        event.remove(self.session, 'after_transaction_end',
+                     self.restart_savepoint)
+        db.session.remove()
+        self.transaction.rollback()
+        self.connection.close()
+        self.ctx.pop()
+
+    def headers(self, *permissions):
+        return {'Authorization': 'Bearer ' + self.issuer.token(permissions)}
+
+    def seed_movies(self, count):
+        db.session.add_all([
+            Movie(title='Movie %d' % i, release_date='2020-01-01')
+            for i in range(count)])
+        db.session.commit()
+
+
+class CapstoneTestCase(ApiTestCase):
+    """The original end-to-end tests, with local tokens and seeded rows"""
+
+    def setUp(self):
+        super().setUp()
+        self.actors_token = self.headers(*ALL_PERMISSIONS)['Authorization']
+        self.movies_token = self.headers(*ALL_PERMISSIONS)['Authorization']
 
     def test_create_movie(self):
         updated_movie = {
             'title': 'Kong: Skull Island',
             'release_year': '2020-01-01'
         }
-        res = self.client().post(
+        res = self.client.post(
             '/movies',
             json=updated_movie,
             headers={
@@ -54,8 +312,9 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['success'], True)
 
     def test_get_movie(self):
-        res = self.client().get('/movies', headers={'Authorization':
-                                                    self.movies_token})
+        self.seed_movies(1)
+        res = self.client.get('/movies', headers={'Authorization':
+                                                  self.movies_token})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -67,15 +326,17 @@ class CapstoneTestCase(unittest.TestCase):
             'age': '60',
             'gender': 'M'
         }
-        res = self.client().post('/actors/create', json=new_actor,
-                                 headers={'Authorization': self.actors_token})
+        res = self.client.post('/actors/create', json=new_actor,
+                               headers={'Authorization': self.actors_token})
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'], True)
 
     def test_get_actor(self):
-        res = self.client().get('/actors', headers={'Authorization':
-                                                    self.actors_token})
+        db.session.add(Actor(name='Michael Bay', age=60, gender='M'))
+        db.session.commit()
+        res = self.client.get('/actors', headers={'Authorization':
+                                                  self.actors_token})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -83,22 +344,25 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(type(data["actors"]), type([]))
 
     def test_delete_actor(self):
-        res = self.client().delete('/actors/14', headers={'Authorization':
-                                                          self.actors_token})
+        actor = Actor(name='Michael Bay', age=60, gender='M')
+        db.session.add(actor)
+        db.session.commit()
+        res = self.client.delete('/actors/%d' % actor.id, headers={
+            'Authorization': self.actors_token})
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'], True)
 
     def test_404_delete_movie(self):
-        res = self.client().delete('/movies/0', headers={'Authorization':
-                                                         self.movies_token})
+        res = self.client.delete('/movies/0', headers={'Authorization':
+                                                       self.movies_token})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
     def test_422_create_actor(self):
-        res = self.client().post(
+        res = self.client.post(
             '/actors/create',
             json={
                 'name': '',
@@ -111,25 +375,1332 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
 
     def test_404_delete_actor(self):
-        res = self.client().delete('/actors/11', headers={'Authorization':
-                                                          self.actors_token})
+        res = self.client.delete('/actors/11', headers={'Authorization':
+                                                        self.actors_token})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
     def test_update_movie(self):
+        self.seed_movies(2)
         updated_movie = {
             'title': 'Dune',
             'release_year': '2023-01-01'
         }
-        res = self.client().patch('/movies/2', json=updated_movie,
-                                  headers={'Authorization': self.movies_token})
+        res = self.client.patch('/movies/2', json=updated_movie,
+                                headers={'Authorization': self.movies_token})
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'], True)
 
 
+class FileDatabaseTestCase(ApiTestCase):
+    """Runs the API against a SQLite file of its own, created per test
+
+    for tests that need the app's own engines rather than the shared
+    transaction: imports save progress on a separate connection and run in
+    threads, replicas have engines of their own
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.database_url = 'sqlite:///' + os.path.join(
+            self.dir.name, 'app.db')
+        self.start()
+
+    def start(self, **config):
+        self.app = create_app(dict(
+            self.config, SQLALCHEMY_DATABASE_URI=self.database_url, **config))
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def stop(self):
+        db.session.remove()
+        dispose_engine(self.app)
+        self.ctx.pop()
+
+    def tearDown(self):
+        self.stop()
+        self.dir.cleanup()
+
+
+class PaginationTestCase(ApiTestCase):
+    """Tests for keyset pagination of the listings"""
+
+    def test_pages_follow_cursor(self):
+        self.seed_movies(5)
+        headers = self.headers('get:movies')
+        seen = []
+        url = '/movies?limit=2'
+        while True:
+            data = json.loads(self.client.get(url, headers=headers).data)
+            seen.extend(movie['id'] for movie in data['movies'])
+            if data['next_cursor'] is None:
+                break
+            url = '/movies?limit=2&after_id=%d' % data['next_cursor']
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(seen), 5)
+
+    def test_page_size_is_capped(self):
+        self.app.config['MAX_PAGE_SIZE'] = 3
+        self.seed_movies(5)
+        res = self.client.get('/movies?limit=100',
+                              headers=self.headers('get:movies'))
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 3)
+        self.assertNotIn('total_movies', data)
+
+    def test_total_is_optional(self):
+        self.seed_movies(4)
+        res = self.client.get('/movies?include_total=true',
+                              headers=self.headers('get:movies'))
+        self.assertEqual(json.loads(res.data)['total_movies'], 4)
+
+    def test_400_invalid_limit(self):
+        res = self.client.get('/movies?limit=abc',
+                              headers=self.headers('get:movies'))
+        self.assertEqual(res.status_code, 400)
+
+
+class ExportTestCase(ApiTestCase):
+    """Tests for the NDJSON export of the listings"""
+
+    def test_export_streams_every_row(self):
+        self.app.config['EXPORT_BATCH_SIZE'] = 2
+        self.seed_movies(5)
+        res = self.client.get('/movies/export',
+                              headers=self.headers('get:movies'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(rows[0], Movie.query.get(1).format())
+
+    def test_listing_negotiates_ndjson(self):
+        self.seed_movies(3)
+        headers = self.headers('get:movies')
+        headers['Accept'] = 'application/x-ndjson'
+        res = self.client.get('/movies', headers=headers)
+        self.assertEqual(len(res.data.splitlines()), 3)
+
+
+class EncodingTestCase(ApiTestCase):
+    """Tests for compact JSON and response compression"""
+
+    def get(self, url, encoding=None):
+        headers = self.headers('get:movies')
+        if encoding is not None:
+            headers['Accept-Encoding'] = encoding
+        res = self.client.get(url, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        return res
+
+    def test_compressed_listing_decodes_to_same_bytes(self):
+        self.seed_movies(100)
+        plain = self.get('/movies?limit=100')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+
+        res = self.get('/movies?limit=100', 'gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+        if encoding.brotli is not None:
+            res = self.get('/movies?limit=100', 'gzip;q=0.5, br')
+            self.assertEqual(res.headers['Content-Encoding'], 'br')
+            self.assertEqual(encoding.brotli.decompress(res.data),
+                             plain.data)
+
+    def test_small_responses_are_not_compressed(self):
+        self.seed_movies(1)
+        res = self.get('/movies', 'gzip')
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_export_is_compressed_as_it_streams(self):
+        self.app.config['EXPORT_BATCH_SIZE'] = 10
+        self.seed_movies(100)
+        plain = self.get('/movies/export')
+        res = self.get('/movies/export', 'gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+    def test_compact_even_in_debug(self):
+        self.seed_movies(1)
+        self.app.debug = True
+        res = self.get('/movies')
+        self.assertNotIn(b'\n ', res.data)
+        self.assertNotIn(b'": ', res.data)
+
+    @unittest.skipIf(encoding.orjson is None, 'orjson is not installed')
+    def test_backends_agree(self):
+        value = {'b': [1, 2.5, None, True], 'a': {'day': date(2020, 1, 1)}}
+        self.assertEqual(
+            encoding.AppJSONEncoder(sort_keys=True).encode(value),
+            encoding.FastAppJSONEncoder(sort_keys=True).encode(value))
+
+
+class ProjectionTestCase(ApiTestCase):
+    """Tests for the column-projected listings"""
+
+    def test_rows_match_format(self):
+        self.seed_movies(2)
+        res = self.client.get('/movies', headers=self.headers('get:movies'))
+        movies = json.loads(res.data)['movies']
+        self.assertEqual(movies, [m.format() for m in Movie.query.all()])
+
+    def test_sparse_fieldset(self):
+        self.seed_movies(3)
+        res = self.client.get('/movies?fields=title&limit=2',
+                              headers=self.headers('get:movies'))
+        data = json.loads(res.data)
+        self.assertEqual(data['movies'], [{'title': 'Movie 0'},
+                                          {'title': 'Movie 1'}])
+        self.assertEqual(data['next_cursor'], 2)
+
+    def test_400_unknown_field(self):
+        res = self.client.get('/actors?fields=id,salary',
+                              headers=self.headers('get:actors'))
+        self.assertEqual(res.status_code, 400)
+
+
+class FilterTestCase(ApiTestCase):
+    """Tests for typed columns and the indexed listing filters"""
+
+    def seed_cast(self):
+        db.session.add_all([
+            Movie(title='Old', release_date='1999-05-01'),
+            Movie(title='New', release_date='2021-10-22'),
+            Movie(title='Newer', release_date='2021'),
+            Actor(name='A', age='25', gender='F'),
+            Actor(name='B', age=40, gender='F'),
+            Actor(name='C', age=50, gender='M')])
+        db.session.commit()
+
+    def test_dates_are_iso_8601(self):
+        self.seed_cast()
+        res = self.client.get('/movies', headers=self.headers('get:movies'))
+        movies = json.loads(res.data)['movies']
+        self.assertEqual([m['release_year'] for m in movies],
+                         ['1999-05-01', '2021-10-22', '2021-01-01'])
+        self.assertEqual(Movie.query.get(1).format()['release_year'],
+                         '1999-05-01')
+
+    def test_year_filter(self):
+        self.seed_cast()
+        res = self.client.get('/movies?year=2021&include_total=true',
+                              headers=self.headers('get:movies'))
+        data = json.loads(res.data)
+        self.assertEqual([m['title'] for m in data['movies']],
+                         ['New', 'Newer'])
+        self.assertEqual(data['total_movies'], 2)
+
+        res = self.client.get('/movies?year=1850',
+                              headers=self.headers('get:movies'))
+        self.assertEqual(res.status_code, 404)
+
+    def test_actor_filters(self):
+        self.seed_cast()
+        res = self.client.get('/actors?gender=F&min_age=30',
+                              headers=self.headers('get:actors'))
+        actors = json.loads(res.data)['actors']
+        self.assertEqual([(a['name'], a['age']) for a in actors], [('B', 40)])
+
+        res = self.client.get('/actors?min_age=45',
+                              headers=self.headers('get:actors'))
+        self.assertEqual([a['name'] for a in json.loads(res.data)['actors']],
+                         ['C'])
+
+    def test_patch_refreshes_filtered_totals(self):
+        self.seed_cast()
+        headers = self.headers('get:actors', 'patch:actors')
+
+        def total():
+            res = self.client.get('/actors?gender=F&include_total=true',
+                                  headers=headers)
+            return json.loads(res.data)['total_actors']
+
+        self.assertEqual(total(), 2)
+        res = self.client.patch('/actors/3', json={'gender': 'F'},
+                                headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(total(), 3)
+
+    def test_400_invalid_filter(self):
+        for query in ('year=abc', 'year=0'):
+            res = self.client.get('/movies?' + query,
+                                  headers=self.headers('get:movies'))
+            self.assertEqual(res.status_code, 400)
+        res = self.client.get('/actors?min_age=-1',
+                              headers=self.headers('get:actors'))
+        self.assertEqual(res.status_code, 400)
+
+    def test_filters_use_indexes(self):
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM "Actors" '
+            'WHERE gender = :gender AND age >= :age',
+            {'gender': 'F', 'age': 30}).fetchall()
+        self.assertIn('ix_Actors_gender_age', str(plan))
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM "Movies" '
+            'WHERE release_date >= :start AND release_date < :end',
+            {'start': '2021-01-01', 'end': '2022-01-01'}).fetchall()
+        self.assertIn('ix_Movies_release_date', str(plan))
+
+    def test_bulk_rejects_bad_types(self):
+        res = self.client.post('/actors/bulk', json={'actors': [
+            {'name': 'A', 'age': 'old', 'gender': 'F'}]},
+            headers=self.headers('post:actors'))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'][0]['errors'],
+                         {'age': 'Expected a whole number of years.'})
+
+        res = self.client.post('/movies/bulk', json={'movies': [
+            {'title': 'Dune', 'release_year': '22/10/2021'}]},
+            headers=self.headers('post:movies'))
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Movie.query.count(), 0)
+
+
+class SearchTestCase(ApiTestCase):
+    """Tests for GET /search"""
+
+    def seed_search(self):
+        db.session.add_all([
+            Movie(title='Dune', release_date='2021'),
+            Movie(title='Dune Part Two', release_date='2024'),
+            Movie(title='Arrival', release_date='2016'),
+            Actor(name='Timoth\u00e9e Chalamet', age=28, gender='M'),
+            Actor(name='Dunya Example', age=30, gender='F')])
+        db.session.commit()
+
+    def search(self, query, *permissions):
+        permissions = permissions or ('get:movies', 'get:actors')
+        return self.client.get('/search?' + query,
+                               headers=self.headers(*permissions))
+
+    def test_prefix_search_across_models(self):
+        self.seed_search()
+        data = json.loads(self.search('q=dun').data)
+        self.assertEqual(
+            sorted((r['type'], r['id']) for r in data['results']),
+            [('actor', 2), ('movie', 1), ('movie', 2)])
+        self.assertEqual(json.loads(self.search('q=timothee').data)[
+            'results'][0]['name'], 'Timoth\u00e9e Chalamet')
+
+    def test_all_words_must_match(self):
+        self.seed_search()
+        data = json.loads(self.search('q=dune+two').data)
+        self.assertEqual([r['title'] for r in data['results']],
+                         ['Dune Part Two'])
+
+    def test_pages_follow_cursor(self):
+        self.seed_search()
+        seen = []
+        cursor = ''
+        while True:
+            data = json.loads(self.search('q=dun&limit=1' + cursor).data)
+            seen.extend((r['type'], r['id']) for r in data['results'])
+            if data['next_cursor'] is None:
+                break
+            cursor = '&cursor=' + data['next_cursor']
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len(set(seen)), 3)
+
+    def test_capped_search_keeps_the_best_matches(self):
+        self.app.config['SEARCH_MAX_CANDIDATES'] = 50
+        db.session.add_all([
+            Movie(title='Filler dune %d' % i, release_date='2020')
+            for i in range(200)] + [Movie(title='Dune', release_date='2021')])
+        db.session.commit()
+        seen = []
+        cursor = ''
+        while True:
+            data = json.loads(self.search(
+                'q=dune&type=movies&limit=40' + cursor).data)
+            seen.extend(r['title'] for r in data['results'])
+            self.assertTrue(data['truncated'])
+            if data['next_cursor'] is None:
+                break
+            cursor = '&cursor=' + data['next_cursor']
+        self.assertEqual(len(seen), 50)
+        self.assertEqual(seen[0], 'Dune')
+
+        data = json.loads(self.search('q=dune+150&type=movies').data)
+        self.assertFalse(data['truncated'])
+        self.assertEqual([r['title'] for r in data['results']],
+                         ['Filler dune 150'])
+
+    def test_index_follows_writes(self):
+        self.seed_search()
+        movie = Movie.query.get(1)
+        movie.title = 'Blade Runner'
+        movie.update()
+        Movie.query.get(2).delete()
+        data = json.loads(self.search('q=dun').data)
+        self.assertEqual([r['type'] for r in data['results']], ['actor'])
+        data = json.loads(self.search('q=blade').data)
+        self.assertEqual([r['id'] for r in data['results']], [1])
+
+    def test_results_limited_to_granted_permissions(self):
+        self.seed_search()
+        data = json.loads(self.search('q=dun', 'get:movies').data)
+        self.assertEqual({r['type'] for r in data['results']}, {'movie'})
+        res = self.search('q=dun&type=actors', 'get:movies')
+        self.assertEqual(res.status_code, 401)
+        res = self.search('q=dun', 'post:movies')
+        self.assertEqual(res.status_code, 401)
+
+    def test_400_without_words(self):
+        for query in ('q=', 'q=%20%21', 'q=dun&type=studios',
+                      'q=dun&cursor=bad'):
+            self.assertEqual(self.search(query).status_code, 400)
+
+
+class CastingTestCase(ApiTestCase):
+    """Tests for the movie cast endpoints and ?include=actors"""
+
+    def seed_cast(self, movies, actors_per_movie=3):
+        self.seed_movies(movies)
+        actors = [Actor(name='Actor %d' % i, age=30, gender='F')
+                  for i in range(actors_per_movie)]
+        db.session.add_all(actors)
+        db.session.flush()
+        db.session.add_all([Casting(movie_id, actor.id)
+                            for movie_id in range(1, movies + 1)
+                            for actor in actors])
+        db.session.commit()
+
+    def query_count(self, url, *permissions):
+        res = self.client.get(url, headers=self.headers(*permissions))
+        self.assertEqual(res.status_code, 200)
+        timing = res.headers['Server-Timing']
+        return res, int(timing.split('desc="')[1].split(' ')[0])
+
+    def test_cast_and_list_actors(self):
+        self.seed_movies(1)
+        db.session.add_all([Actor(name='A', age=30, gender='F'),
+                            Actor(name='B', age=40, gender='M')])
+        db.session.commit()
+
+        res = self.client.post('/movies/1/cast', json={'actor_ids': [2, 1]},
+                               headers=self.headers('patch:movies'))
+        self.assertEqual(json.loads(res.data)['added'], [2, 1])
+        res = self.client.post('/movies/1/cast', json={'actor_ids': [1]},
+                               headers=self.headers('patch:movies'))
+        self.assertEqual(json.loads(res.data)['added'], [])
+
+        res = self.client.get('/movies/1/actors',
+                              headers=self.headers('get:movies', 'get:actors'))
+        data = json.loads(res.data)
+        self.assertEqual([a['name'] for a in data['actors']], ['A', 'B'])
+
+        res = self.client.delete('/movies/1/cast/1',
+                                 headers=self.headers('patch:movies'))
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get('/movies/1/actors',
+                              headers=self.headers('get:movies', 'get:actors'))
+        self.assertEqual([a['id'] for a in json.loads(res.data)['actors']],
+                         [2])
+
+    def test_cast_rejects_unknown_actors(self):
+        self.seed_movies(1)
+        res = self.client.post('/movies/1/cast', json={'actor_ids': [7]},
+                               headers=self.headers('patch:movies'))
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Casting.query.count(), 0)
+
+        res = self.client.post('/movies/9/cast', json={'actor_ids': [7]},
+                               headers=self.headers('patch:movies'))
+        self.assertEqual(res.status_code, 404)
+
+    def test_include_actors_query_count_is_constant(self):
+        self.seed_cast(20)
+        perms = ('get:movies', 'get:actors')
+        res, small = self.query_count(
+            '/movies?limit=2&include=actors', *perms)
+        self.assertEqual(
+            [a['name'] for a in json.loads(res.data)['movies'][0]['actors']],
+            ['Actor 0', 'Actor 1', 'Actor 2'])
+        res, large = self.query_count(
+            '/movies?limit=20&include=actors', *perms)
+        self.assertEqual(len(json.loads(res.data)['movies']), 20)
+        self.assertEqual(small, large)
+
+    def test_include_needs_actor_permission(self):
+        self.seed_cast(1)
+        res = self.client.get('/movies?include=actors',
+                              headers=self.headers('get:movies'))
+        self.assertEqual(res.status_code, 401)
+        res = self.client.get('/movies?include=studios',
+                              headers=self.headers('get:movies'))
+        self.assertEqual(res.status_code, 400)
+
+    def test_casting_changes_included_listing_etag(self):
+        self.seed_cast(1)
+        headers = self.headers('get:movies', 'get:actors')
+        plain = self.client.get('/movies', headers=headers).headers['ETag']
+        included = self.client.get('/movies?include=actors',
+                                   headers=headers).headers['ETag']
+        self.client.delete('/movies/1/cast/1',
+                           headers=self.headers('patch:movies'))
+        self.assertEqual(
+            self.client.get('/movies', headers=headers).headers['ETag'],
+            plain)
+        self.assertNotEqual(
+            self.client.get('/movies?include=actors',
+                            headers=headers).headers['ETag'],
+            included)
+
+    def test_include_is_parsed_before_computing_etag(self):
+        self.seed_cast(1)
+        headers = self.headers('get:movies', 'get:actors')
+        etag = self.client.get('/movies?include=actors,',
+                               headers=headers).headers['ETag']
+        self.client.delete('/movies/1/cast/1',
+                           headers=self.headers('patch:movies'))
+        res = self.client.get('/movies?include=actors,', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        cast = json.loads(res.data)['movies'][0]['actors']
+        self.assertNotIn(1, [actor['id'] for actor in cast])
+
+    def test_include_permission_is_checked_before_cache(self):
+        self.seed_cast(1)
+        res = self.client.get('/movies?include=actors', headers=self.headers(
+            'get:movies', 'get:actors'))
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        etag = res.headers['ETag']
+
+        # a token with only get:movies, for the cached page and then
+        # revalidating the ETag of the first response
+        headers = self.headers('get:movies')
+        res = self.client.get('/movies?include=actors', headers=headers)
+        self.assertEqual(res.status_code, 401)
+        res = self.client.get('/movies?include=actors', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 401)
+
+    def test_deletes_remove_castings(self):
+        self.seed_cast(2)
+        self.client.delete('/movies/1', headers=self.headers('delete:movies'))
+        self.client.delete('/actors/bulk', json={'ids': [1]},
+                           headers=self.headers('delete:actors'))
+        self.assertEqual(
+            sorted((c.movie_id, c.actor_id) for c in Casting.query),
+            [(2, 2), (2, 3)])
+
+
+class BulkTestCase(ApiTestCase):
+    """Tests for the bulk create/update/delete endpoints"""
+
+    def test_bulk_create(self):
+        movies = [{'title': 'Movie %d' % i, 'release_year': '2020-01-01'}
+                  for i in range(3)]
+        res = self.client.post('/movies/bulk', json={'movies': movies},
+                               headers=self.headers('post:movies'))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['created'] * 3)
+        self.assertEqual(Movie.query.count(), 3)
+        self.assertEqual(Movie.query.get(data['results'][2]['id']).title,
+                         'Movie 2')
+
+    def test_bulk_create_rejects_whole_payload(self):
+        actors = [{'name': 'A', 'age': '30', 'gender': 'F'},
+                  {'name': '', 'age': '30'}]
+        res = self.client.post('/actors/bulk', json={'actors': actors},
+                               headers=self.headers('post:actors'))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'][0]['index'], 1)
+        self.assertEqual(set(data['errors'][0]['errors']), {'name', 'gender'})
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_bulk_update_and_delete(self):
+        self.seed_movies(2)
+        res = self.client.patch('/movies/bulk', json={'movies': [
+            {'id': 1, 'title': 'Dune'}, {'id': 99, 'title': 'Nope'}]},
+            headers=self.headers('patch:movies'))
+        data = json.loads(res.data)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['updated', 'not_found'])
+        db.session.expire_all()
+        self.assertEqual(Movie.query.get(1).title, 'Dune')
+
+        res = self.client.delete('/movies/bulk', json={'ids': [1, 2, 3]},
+                                 headers=self.headers('delete:movies'))
+        data = json.loads(res.data)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['deleted', 'deleted', 'not_found'])
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_bulk_writes_in_chunks(self):
+        self.app.config['BULK_CHUNK_SIZE'] = 2
+        self.app.config['BULK_COMMIT_EACH_CHUNK'] = True
+        actors = [{'name': 'A%d' % i, 'age': 30, 'gender': 'F'}
+                  for i in range(5)]
+        res = self.client.post('/actors/bulk', json={'actors': actors},
+                               headers=self.headers('post:actors'))
+        self.assertEqual(len(json.loads(res.data)['results']), 5)
+        self.assertEqual(Actor.query.count(), 5)
+
+    def test_failed_chunk_reports_committed_items(self):
+        self.app.config['BULK_CHUNK_SIZE'] = 2
+        self.app.config['BULK_COMMIT_EACH_CHUNK'] = True
+        insert_chunk = bulk._insert_chunk
+        chunks = []
+
+        def fail_third_chunk(model, chunk):
+            chunks.append(chunk)
+            if len(chunks) == 3:
+                raise RuntimeError('connection lost')
+            return insert_chunk(model, chunk)
+
+        actors = [{'name': 'A%d' % i, 'age': 30, 'gender': 'F'}
+                  for i in range(6)]
+        with mock.patch.object(bulk, '_insert_chunk', fail_third_chunk):
+            res = self.client.post('/actors/bulk', json={'actors': actors},
+                                   headers=self.headers('post:actors'))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([r['id'] for r in data['results']], [1, 2, 3, 4])
+        self.assertIn('4 items were written', data['message'])
+        self.assertEqual(Actor.query.count(), 4)
+
+    def test_bulk_create_is_one_insert_per_chunk(self):
+        self.app.config['BULK_CHUNK_SIZE'] = 2
+        self.seed_movies(1)
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(self.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute',
+                        record)
+        movies = [{'title': 'Movie %d' % i, 'release_year': '2020-01-01'}
+                  for i in range(1, 6)]
+        res = self.client.post('/movies/bulk', json={'movies': movies},
+                               headers=self.headers('post:movies'))
+        results = json.loads(res.data)['results']
+        self.assertEqual([r['id'] for r in results], [2, 3, 4, 5, 6])
+        inserts = [s for s in statements
+                   if s.startswith('INSERT INTO "Movies"')]
+        self.assertEqual(len(inserts), 3)
+
+
+class SchemaTestCase(ApiTestCase):
+    """Tests for request body schemas and the body size cap"""
+
+    def test_rejects_before_auth(self):
+        res = self.client.post('/actors/create', json={'name': 'A'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], {
+            'age': 'This field is required.',
+            'gender': 'This field is required.'})
+
+        res = self.client.post('/movies', data='{"title": ',
+                               content_type='application/json')
+        self.assertEqual(res.status_code, 422)
+
+    def test_coerces_types_once(self):
+        res = self.client.post('/actors/create', json={
+            'name': 'A', 'age': '31', 'gender': 'F'},
+            headers=self.headers('post:actors'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Actor.query.get(1).age, 31)
+
+        res = self.client.post('/movies', json={
+            'title': 'Dune', 'release_year': '2021'},
+            headers=self.headers('post:movies'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Movie.query.get(1).format()['release_year'],
+                         '2021-01-01')
+
+    def test_rejects_unknown_and_invalid_fields(self):
+        res = self.client.post('/movies', json={
+            'title': 'Dune', 'release_year': 'soon', 'rating': 5},
+            headers=self.headers('post:movies'))
+        self.assertEqual(json.loads(res.data)['errors'], {
+            'release_year': 'Expected a date (YYYY-MM-DD).',
+            'rating': 'Unknown field.'})
+
+    def test_413_over_max_content_length(self):
+        self.app.config['MAX_CONTENT_LENGTH'] = 64
+        res = self.client.post('/movies/bulk', json={'movies': [
+            {'title': 'Movie %d' % i, 'release_year': '2020'}
+            for i in range(10)]}, headers=self.headers('post:movies'))
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_413_for_chunked_body_over_max_content_length(self):
+        self.app.config['MAX_CONTENT_LENGTH'] = 64
+
+        def chunked(environ, start_response):
+            # no Content-Length, as with Transfer-Encoding: chunked
+            del environ['CONTENT_LENGTH']
+            return self.app(environ, start_response)
+
+        def post(movies):
+            data = json.dumps({'movies': [
+                {'title': 'Movie %d' % i, 'release_year': '2020'}
+                for i in range(movies)]}).encode()
+            return Client(chunked).post(
+                '/movies/bulk', input_stream=io.BytesIO(data),
+                content_type='application/json',
+                headers=self.headers('post:movies'),
+                environ_base={'wsgi.input_terminated': True})
+
+        self.assertEqual(post(10).status_code, 413)
+        self.assertEqual(Movie.query.count(), 0)
+        self.assertEqual(post(1).status_code, 200)
+
+    def test_text_fields_must_be_strings(self):
+        res = self.client.post('/movies', json={
+            'title': 5, 'release_year': '2021'},
+            headers=self.headers('post:movies'))
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(json.loads(res.data)['errors'], {
+            'title': 'Expected a string.'})
+
+
+class PatchTestCase(ApiTestCase):
+    """Tests for single-row PATCH and If-Match"""
+
+    def patch(self, url, body, permission, **headers):
+        headers.update(self.headers(permission))
+        return self.client.patch(url, json=body, headers=headers)
+
+    def test_patch_writes_only_sent_fields(self):
+        self.seed_movies(1)
+        res = self.patch('/movies/1', {'title': 'Dune'}, 'patch:movies')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], {
+            'id': 1, 'title': 'Dune', 'release_year': '2020-01-01',
+            'version': 2})
+        self.assertEqual(res.headers['ETag'], '"2"')
+        db.session.expire_all()
+        self.assertEqual(Movie.query.get(1).format(), data['updated'])
+
+    def test_patch_validates_body(self):
+        self.seed_movies(1)
+        for body in ({}, {'release_year': 'soon'}, {'rating': 5}):
+            res = self.patch('/movies/1', body, 'patch:movies')
+            self.assertEqual(res.status_code, 422)
+        res = self.patch('/movies/9', {'title': 'Dune'}, 'patch:movies')
+        self.assertEqual(res.status_code, 404)
+
+    def test_if_match(self):
+        self.seed_movies(1)
+        res = self.patch('/movies/1', {'title': 'A'}, 'patch:movies',
+                         **{'If-Match': '"1"'})
+        self.assertEqual(res.status_code, 200)
+        res = self.patch('/movies/1', {'title': 'B'}, 'patch:movies',
+                         **{'If-Match': '"1"'})
+        self.assertEqual(res.status_code, 412)
+        db.session.expire_all()
+        self.assertEqual(Movie.query.get(1).title, 'A')
+
+        res = self.patch('/movies/1', {'title': 'C'}, 'patch:movies',
+                         **{'If-Match': '*'})
+        self.assertEqual(res.headers['ETag'], '"3"')
+
+        self.app.config['REQUIRE_IF_MATCH'] = True
+        res = self.patch('/movies/1', {'title': 'D'}, 'patch:movies')
+        self.assertEqual(res.status_code, 428)
+
+    def test_patch_is_one_statement(self):
+        self.seed_movies(1)
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(self.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute',
+                        record)
+        self.patch('/movies/1', {'title': 'Dune'}, 'patch:movies')
+        writes = [s for s in statements if s.startswith('UPDATE "Movies"')]
+        self.assertEqual(len(writes), 1)
+
+    def test_other_writes_bump_versions(self):
+        self.seed_movies(1)
+        self.client.patch('/movies/bulk', json={'movies': [
+            {'id': 1, 'title': 'Dune'}]}, headers=self.headers('patch:movies'))
+        movie = Movie.query.get(1)
+        self.assertEqual(movie.version, 2)
+        movie.title = 'Dune 2'
+        db.session.commit()
+        self.assertEqual(movie.version, 3)
+
+    def test_patch_actor(self):
+        db.session.add(Actor(name='A', age=30, gender='F'))
+        db.session.commit()
+        res = self.patch('/actors/1', {'age': '31'}, 'patch:actors')
+        data = json.loads(res.data)
+        self.assertEqual(data['updated']['age'], 31)
+        self.assertEqual(data['updated']['version'], 2)
+        res = self.patch('/actors/1', {'age': 32}, 'patch:movies')
+        self.assertEqual(res.status_code, 401)
+
+
+class ConditionalGetTestCase(ApiTestCase):
+    """Tests for ETag / Last-Modified handling on the listings"""
+
+    def test_304_until_table_changes(self):
+        self.seed_movies(2)
+        headers = self.headers('get:movies', 'post:movies')
+        res = self.client.get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        res = self.client.get('/movies', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+
+        self.client.post('/movies', headers=headers, json={
+            'title': 'Dune', 'release_year': '2021-10-22'})
+        res = self.client.get('/movies', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_last_modified_waits_for_the_write_second(self):
+        self.seed_movies(1)
+        written = TableVersion.query.filter_by(
+            name=Movie.__tablename__).one().updated_at
+        second = written.replace(microsecond=0)
+        headers = self.headers('get:movies')
+        since = dict(headers, **{
+            'If-Modified-Since': http_date(second.replace(
+                tzinfo=timezone.utc))})
+        with mock.patch('http_cache.datetime', wraps=datetime) as clock:
+            # another write could still land in this second
+            clock.utcnow.return_value = written
+            res = self.client.get('/movies', headers=headers)
+            self.assertNotIn('Last-Modified', res.headers)
+            res = self.client.get('/movies', headers=since)
+            self.assertEqual(res.status_code, 200)
+
+            clock.utcnow.return_value = second + timedelta(seconds=1)
+            res = self.client.get('/movies', headers=headers)
+            self.assertEqual(res.last_modified.replace(tzinfo=None), second)
+            res = self.client.get('/movies', headers=since)
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+
+    def test_etag_depends_on_query(self):
+        self.seed_movies(3)
+        headers = self.headers('get:movies')
+        first = self.client.get('/movies?limit=1', headers=headers)
+        second = self.client.get('/movies?limit=2', headers=headers)
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+
+    def test_bulk_writes_change_etag(self):
+        self.seed_movies(2)
+        headers = self.headers('get:movies', 'delete:movies')
+        etag = self.client.get('/movies', headers=headers).headers['ETag']
+        self.client.delete('/movies/bulk', json={'ids': [1]},
+                           headers=headers)
+        res = self.client.get('/movies', headers=dict(
+            headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+
+
+class ResponseCacheTestCase(ApiTestCase):
+    """Tests for the write-invalidated listing cache"""
+
+    def test_second_request_is_served_from_cache(self):
+        self.seed_movies(2)
+        headers = self.headers('get:movies')
+        first = self.client.get('/movies', headers=headers)
+        second = self.client.get('/movies', headers=headers)
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+        stats = self.app.extensions['response_cache'].stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_writes_invalidate_entries(self):
+        self.seed_movies(1)
+        cache = self.app.extensions['response_cache']
+        headers = self.headers('get:movies', 'post:movies')
+        self.client.get('/movies', headers=headers)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+        self.client.post('/movies', headers=headers, json={
+            'title': 'Dune', 'release_year': '2021-10-22'})
+        self.assertEqual(cache.stats()['entries'], 0)
+        res = self.client.get('/movies', headers=headers)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(res.data)['movies']), 2)
+
+    def test_entries_are_not_shared_across_permissions(self):
+        self.seed_movies(1)
+        res = self.client.get('/movies?include=actors', headers=self.headers(
+            'get:movies', 'get:actors'))
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        res = self.client.get('/movies?include=actors',
+                              headers=self.headers('get:movies'))
+        self.assertEqual(res.status_code, 401)
+        self.assertNotIn('actors', res.get_data(as_text=True))
+
+    def test_memory_cache_is_bounded(self):
+        cache = MemoryCache(maxsize=2)
+        for key in 'abc':
+            cache.set(key, (200, 'application/json', b'{}'), ('Movies',))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_sqlite_cache_is_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.db')
+            writer, reader = SQLiteCache(path), SQLiteCache(path)
+            value = (200, 'application/json', b'{"movies": []}')
+            writer.set('k', value, ('Movies',))
+            self.assertEqual(reader.get('k'), value)
+            reader.invalidate({'Movies'})
+            self.assertIsNone(writer.get('k'))
+
+
+class FactoryTestCase(unittest.TestCase):
+    """Tests that building the app has no side effects"""
+
+    def test_create_app_does_not_connect(self):
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, 'missing', 'app.db')
+        # connecting to a file in a missing directory would fail
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path})
+        self.assertEqual(app.test_client().get('/').status_code, 200)
+        tmp.cleanup()
+
+    def test_module_app_is_built_on_first_use(self):
+        import app as app_module
+        app_module.__dict__.pop('app', None)
+        self.assertIs(app_module.app, app_module.app)
+
+
+class PoolTestCase(unittest.TestCase):
+    """Tests for connection pool configuration and stats"""
+
+    def test_engine_options_from_config(self):
+        options = engine_options({
+            'DB_POOL_SIZE': 20,
+            'DB_POOL_RECYCLE': '300',
+            'DB_POOL_PRE_PING': 'false',
+            'DB_STATEMENT_TIMEOUT': 5000
+        }, 'postgresql://localhost/capstone')
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['pool_recycle'], 300)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['connect_args']['options'],
+                         '-c statement_timeout=5000')
+
+    def test_sqlite_keeps_its_own_pool(self):
+        options = engine_options({}, 'sqlite://')
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('poolclass', options)
+
+    def test_pool_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(
+                'sqlite:///' + os.path.join(tmp, 'pool.db'),
+                poolclass=InstrumentedQueuePool, pool_size=2)
+            with engine.connect() as connection:
+                connection.execute('SELECT 1')
+                stats = pool_stats(engine)
+                self.assertEqual(stats['checked_out'], 1)
+            stats = pool_stats(engine)
+            self.assertEqual(stats['checked_out'], 0)
+            self.assertEqual(stats['checkouts'], 1)
+            engine.dispose()
+
+
+class ImportTestCase(FileDatabaseTestCase):
+    """Tests for CSV and NDJSON catalogue imports"""
+
+    config = {'IMPORT_ASYNC': False, 'IMPORT_CHUNK_SIZE': 2}
+
+    def upload(self, path, data, mimetype, *permissions):
+        return self.client.post(path, data=data, content_type=mimetype,
+                                headers=self.headers(*permissions))
+
+    def test_csv_import_reports_rejected_rows(self):
+        data = ('title,release_year\n'
+                'Dune,2021-10-22\n'
+                ',2020-01-01\n'
+                'Alien,1979\n'
+                '"Heat, again",not a date\n'
+                'Up,2009-05-29\n')
+        res = self.upload('/movies/import', data, 'text/csv', 'post:movies')
+        self.assertEqual(res.status_code, 201)
+        job = json.loads(res.data)['import']
+        self.assertEqual((job['status'], job['method']),
+                         ('done', 'executemany'))
+        self.assertEqual((job['rows_read'], job['rows_imported'],
+                          job['rows_rejected']), (5, 3, 2))
+        self.assertEqual([r['line'] for r in job['rejected']], [3, 5])
+        self.assertIn('release_year', job['rejected'][1]['errors'])
+        self.assertEqual(res.headers['Location'],
+                         'http://localhost/imports/%d' % job['id'])
+        self.assertEqual(sorted(m.title for m in Movie.query),
+                         ['Alien', 'Dune', 'Up'])
+
+    def test_ndjson_import(self):
+        data = ('{"name": "Ana", "age": 30, "gender": "female"}\n'
+                'not json\n'
+                '\n'
+                '{"name": "Ben", "age": "41", "gender": "male"}\n')
+        res = self.upload('/actors/import', data, 'application/x-ndjson',
+                          'post:actors')
+        job = json.loads(res.data)['import']
+        self.assertEqual((job['rows_imported'], job['rows_rejected']), (2, 1))
+        self.assertEqual(job['rejected'], [
+            {'line': 2, 'errors': {'item': 'Invalid JSON.'}}])
+        self.assertEqual([a.age for a in Actor.query.order_by(Actor.id)],
+                         [30, 41])
+
+        res = self.client.get('/imports/%d' % job['id'],
+                              headers=self.headers('post:actors'))
+        self.assertEqual(json.loads(res.data)['import']['status'], 'done')
+
+    def test_unknown_columns_fail_the_import(self):
+        res = self.upload('/movies/import', 'title,budget\nDune,1\n',
+                          'text/csv', 'post:movies')
+        job = json.loads(res.data)['import']
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['error'], 'Unknown columns: budget.')
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_upload_needs_a_known_format(self):
+        res = self.upload('/movies/import', '{}', 'application/json',
+                          'post:movies')
+        self.assertEqual(res.status_code, 415)
+        res = self.upload('/movies/import', 'title', 'text/csv',
+                          'get:movies')
+        self.assertEqual(res.status_code, 401)
+        res = self.client.get('/imports/99',
+                              headers=self.headers('post:movies'))
+        self.assertEqual(res.status_code, 404)
+
+    def test_jobs_are_private_to_their_subject_and_kind(self):
+        res = self.upload('/movies/import', 'title\nDune\n', 'text/csv',
+                          'post:movies')
+        path = '/imports/%d' % json.loads(res.data)['import']['id']
+        owner = self.client.get(path, headers=self.headers('post:movies'))
+        self.assertEqual(owner.status_code, 200)
+        other_kind = self.client.get(path, headers=self.headers('post:actors'))
+        self.assertEqual(other_kind.status_code, 404)
+        other_subject = self.client.get(path, headers={
+            'Authorization': 'Bearer ' + self.issuer.token(
+                ['post:movies'], subject='local|other')})
+        self.assertEqual(other_subject.status_code, 404)
+
+    def test_background_import(self):
+        self.stop()
+        self.start(IMPORT_ASYNC=True)
+
+        data = 'title,release_year\n' + ''.join(
+            'Movie %d,2020-01-01\n' % i for i in range(50))
+        res = self.upload('/movies/import', data, 'text/csv', 'post:movies')
+        self.assertEqual(res.status_code, 202)
+        location = res.headers['Location']
+        deadline = time.time() + 10
+        while True:
+            job = json.loads(self.client.get(
+                location, headers=self.headers('post:movies')).data)['import']
+            if job['status'] not in ('pending', 'running') or \
+                    time.time() > deadline:
+                break
+            time.sleep(0.01)
+        self.assertEqual((job['status'], job['rows_imported']), ('done', 50))
+
+
+class RateLimitTestCase(ApiTestCase):
+    """Tests for per-subject token-bucket rate limits"""
+
+    config = {
+        'RATE_LIMIT': 'memory',
+        'RATE_LIMITS': 'post:movies=2/minute, delete:movies=1/hour',
+        'RATE_LIMIT_DEFAULT': '5/minute',
+        'RATE_LIMIT_ANONYMOUS': '1/minute'}
+
+    def post(self, subject='local|tester'):
+        return self.client.post('/movies', json={
+            'title': 'Dune', 'release_year': '2021-10-22'}, headers={
+            'Authorization': 'Bearer ' + self.issuer.token(
+                ['post:movies', 'get:movies'], subject=subject)})
+
+    def test_limits_are_per_permission_and_subject(self):
+        self.assertEqual([self.post().status_code for _ in range(3)],
+                         [200, 200, 429])
+        res = self.post()
+        self.assertEqual(json.loads(res.data)['error'], 429)
+        self.assertEqual(res.headers['Retry-After'], '30')
+        self.assertEqual(self.post('local|other').status_code, 200)
+
+        # get:movies has a budget of its own, the default
+        headers = self.headers('get:movies')
+        self.assertEqual([self.client.get('/movies', headers=headers)
+                          .status_code for _ in range(6)],
+                         [200] * 5 + [429])
+        limiter = self.app.extensions['rate_limiter']
+        self.assertEqual(limiter.stats()['limited'], 3)
+
+    def test_bad_tokens_are_limited_before_verification(self):
+        token = LocalIssuer().token(['get:movies'])
+        headers = {'Authorization': 'Bearer ' + token}
+        with mock.patch.object(auth, 'verify_decode_jwt',
+                               wraps=auth.verify_decode_jwt) as verify:
+            codes = [self.client.get('/movies', headers=headers).status_code
+                     for _ in range(7)]
+        self.assertEqual(codes, [401] * 5 + [429] * 2)
+        self.assertEqual(verify.call_count, 5)
+
+    def test_fresh_bad_tokens_are_limited_by_address(self):
+        client = Client(self.app)
+        forger = LocalIssuer()
+
+        def get(address, i):
+            token = forger.token(['get:movies'], subject='forged|%d' % i)
+            return client.get('/movies', environ_base={
+                'REMOTE_ADDR': address}, headers={
+                'Authorization': 'Bearer ' + token}).status_code
+
+        with mock.patch.object(auth, 'verify_decode_jwt',
+                               wraps=auth.verify_decode_jwt) as verify:
+            codes = [get('10.0.0.1', i) for i in range(8)]
+        self.assertEqual(codes, [401] * 5 + [429] * 3)
+        self.assertEqual(verify.call_count, 5)
+        self.assertEqual(get('10.0.0.2', 8), 401)
+
+    def test_anonymous_routes_are_limited_by_address(self):
+        # werkzeug's own client: Flask 1.1's drops REMOTE_ADDR
+        client = Client(self.app)
+
+        def get(address):
+            return client.get('/', environ_base={
+                'REMOTE_ADDR': address}).status_code
+
+        self.assertEqual([get('10.0.0.1'), get('10.0.0.1'), get('10.0.0.2')],
+                         [200, 429, 200])
+
+    def test_parse_limit(self):
+        limit = parse_limit('get:movies', '100/minute')
+        self.assertEqual((limit.burst, round(limit.rate, 3)), (100, 1.667))
+        self.assertEqual(parse_limit('x', '5/10seconds').rate, 0.5)
+        with self.assertRaises(ValueError):
+            parse_limit('x', '5 per minute')
+
+    def test_sqlite_buckets_are_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'limits.db')
+            first, second = SQLiteBuckets(path), SQLiteBuckets(path)
+            self.assertIsNone(first.take('k', 1.0, 2))
+            self.assertIsNone(second.take('k', 1.0, 2))
+            retry_after = first.take('k', 1.0, 2)
+            self.assertGreater(retry_after, 0.9)
+            self.assertEqual(len(second), 1)
+
+
+class ReplicaTestCase(FileDatabaseTestCase):
+    """Tests for read routing between a primary and a replica database"""
+
+    config = {'RESPONSE_CACHE': 'none'}
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.database_url = 'sqlite:///' + os.path.join(
+            self.dir.name, 'primary.db')
+        self.replica = 'sqlite:///' + os.path.join(self.dir.name,
+                                                   'replica.db')
+        self.start(DATABASE_REPLICA_URLS=[self.replica])
+
+    def start(self, **config):
+        config.setdefault('REPLICA_PINS', 'sqlite:///' + os.path.join(
+            self.dir.name, 'pins.db'))
+        super().start(**config)
+
+    def tearDown(self):
+        self.wait_for_check()
+        super().tearDown()
+
+    @property
+    def replicas(self):
+        return self.app.extensions['replicas']
+
+    def wait_for_check(self):
+        if self.replicas._checker is not None:
+            self.replicas._checker.join()
+
+    def replica_engine(self):
+        engine = self.replicas.replicas[0].engine
+        db.metadata.create_all(engine)
+        return engine
+
+    def titles(self, subject='local|tester'):
+        res = self.client.get('/movies', headers={
+            'Authorization': 'Bearer ' + self.issuer.token(
+                ['get:movies'], subject=subject)})
+        self.assertEqual(res.status_code, 200)
+        return [m['title'] for m in json.loads(res.data)['movies']]
+
+    def test_reads_go_to_replica(self):
+        self.replica_engine().execute(Movie.__table__.insert(), title='Copy')
+        self.seed_movies(1)
+        self.assertEqual(self.titles(), ['Copy'])
+        self.wait_for_check()
+        self.assertEqual(self.replicas.stats()['healthy'], 1)
+
+    def test_checks_run_in_the_background(self):
+        self.replica_engine().execute(Movie.__table__.insert(), title='Copy')
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_check():
+            started.set()
+            finish.wait(10)
+
+        with mock.patch.object(self.replicas, 'check', slow_check):
+            self.assertEqual(self.titles(), ['Copy'])
+            self.assertTrue(started.is_set())
+            finish.set()
+
+    def test_writer_is_pinned_to_primary(self):
+        self.replica_engine().execute(Movie.__table__.insert(), title='Copy')
+        res = self.client.post('/movies', headers=self.headers(
+            'post:movies'), json={'title': 'Dune',
+                                  'release_year': '2021-10-22'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.titles(), ['Dune'])
+        self.assertEqual(self.titles('local|other'), ['Copy'])
+        self.assertEqual(self.replicas.stats()['pinned_subjects'], 1)
+
+    def test_pins_are_shared_between_workers(self):
+        self.replica_engine().execute(Movie.__table__.insert(), title='Copy')
+        # another worker process: an app of its own on the same databases
+        worker = create_app(dict(
+            self.config, SQLALCHEMY_DATABASE_URI=self.database_url,
+            DATABASE_REPLICA_URLS=[self.replica],
+            REPLICA_PINS=self.app.config['REPLICA_PINS']))
+        self.addCleanup(dispose_engine, worker)
+        res = self.client.post('/movies', headers=self.headers(
+            'post:movies'), json={'title': 'Dune',
+                                  'release_year': '2021-10-22'})
+        self.assertEqual(res.status_code, 200)
+        # the scoped session belongs to the app it was made under
+        db.session.remove()
+        res = worker.test_client().get('/movies',
+                                       headers=self.headers('get:movies'))
+        self.assertEqual([m['title'] for m in json.loads(res.data)['movies']],
+                         ['Dune'])
+
+    def test_import_jobs_are_read_from_primary(self):
+        self.replica_engine()
+        self.app.config['IMPORT_ASYNC'] = False
+        res = self.client.post('/movies/import', data='title\nDune\n',
+                               content_type='text/csv',
+                               headers=self.headers('post:movies'))
+        res = self.client.get(res.headers['Location'],
+                              headers=self.headers('post:movies'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['import']['status'], 'done')
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        self.stop()
+        self.start(DATABASE_REPLICA_URLS=['sqlite:///' + os.path.join(
+            self.dir.name, 'missing', 'replica.db')])
+        self.seed_movies(1)
+        # not checked yet: the read fails on the replica and is run again
+        # on the primary
+        self.assertEqual(self.titles(), ['Movie 0'])
+        self.assertEqual(self.replicas.stats()['healthy'], 0)
+        self.assertEqual(self.titles(), ['Movie 0'])
+
+    def test_lagging_replica_is_evicted(self):
+        self.stop()
+        self.start(DATABASE_REPLICA_URLS=[self.replica], REPLICA_MAX_LAG=10)
+        self.replica_engine().execute(
+            TableVersion.__table__.insert(), name='Movies', version=0,
+            updated_at=datetime.utcnow() - timedelta(seconds=60))
+        self.seed_movies(1)
+        self.replicas.check()
+        self.assertEqual(self.titles(), ['Movie 0'])
+        stats = self.replicas.stats()
+        self.assertEqual(stats['healthy'], 0)
+        self.assertGreater(stats['max_lag_seconds'], 10)
+
+
+class InstrumentationTestCase(ApiTestCase):
+    """Tests for per-request timing and the metrics endpoint"""
+
+    config = {'METRICS': True, 'METRICS_ALLOW': '127.0.0.1, 10.1.0.0/16'}
+
+    def scrape(self, address='127.0.0.1'):
+        # werkzeug's own client: Flask 1.1's drops REMOTE_ADDR
+        return Client(self.app).get('/metrics', environ_base={
+            'REMOTE_ADDR': address})
+
+    def test_server_timing_header(self):
+        self.seed_movies(2)
+        res = self.client.get('/movies', headers=self.headers('get:movies'))
+        timing = res.headers['Server-Timing']
+        for name in ('db', 'serialize', 'app', 'total'):
+            self.assertIn(name + ';dur=', timing)
+        self.assertIn('"2 queries"', timing)
+
+    def test_metrics_export_route_histograms(self):
+        self.seed_movies(1)
+        self.client.get('/movies', headers=self.headers('get:movies'))
+        res = self.scrape()
+        self.assertEqual(res.status_code, 200)
+        body = res.get_data(as_text=True)
+        self.assertIn('casting_request_duration_seconds_bucket{'
+                      'le="0.005",method="GET",route="/movies"', body)
+        self.assertIn('casting_response_cache_hits', body)
+        self.assertIn('casting_token_cache_hit_ratio', body)
+
+    def test_auth_metrics(self):
+        before = metrics.AUTH_ERRORS.labels('unauthorized')._value.get()
+        res = self.client.get('/movies', headers=self.headers('get:actors'))
+        self.assertEqual(res.status_code, 401)
+        self.assertIn('auth;dur=', res.headers['Server-Timing'])
+        self.assertEqual(
+            metrics.AUTH_ERRORS.labels('unauthorized')._value.get(),
+            before + 1)
+
+        body = self.scrape('10.1.2.3').get_data(as_text=True)
+        self.assertIn('casting_auth_errors_total{code="unauthorized"}', body)
+        self.assertIn('casting_auth_seconds_count{stage="requires_auth"}',
+                      body)
+        self.assertIn('casting_jwks_fetches_total{result="ok"}', body)
+        self.assertIn('casting_requests_total{method="GET",route="/movies",'
+                      'status="401"}', body)
+
+    def test_metrics_are_limited_to_allowed_addresses(self):
+        self.assertEqual(self.scrape('10.2.0.1').status_code, 404)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.assertEqual(self.scrape('::1').status_code, 404)
+
+        # off unless METRICS is set
+        app = create_app({'SQLALCHEMY_DATABASE_URI': TEST_DB_URL})
+        res = Client(app).get('/metrics', environ_base={
+            'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(res.status_code, 404)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,96 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+'''
+TokenCache
+    bounded LRU of what was derived from verified JWTs
+
+    entries are keyed by a SHA-256 digest of the raw token, so the tokens
+    themselves are never kept in memory, and expire at the token's `exp`
+    claim. A hit lets requires_auth skip the JWKS lookup and the RS256
+    signature check; permission checks still run per endpoint.
+'''
+
+
+class TokenCache:
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        '''
+        returns the value cached for `token`, or None
+        '''
+        if self.maxsize <= 0:
+            return None
+
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, token, value, expires_at):
+        '''
+        caches `value` until `expires_at` (the token's exp claim, in
+        seconds since the epoch); tokens without one aren't cached
+        '''
+        if self.maxsize <= 0 or expires_at is None:
+            return
+
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, token):
+        # a lookup that leaves the stats and the LRU order alone
+        entry = self._entries.get(self.key(token))
+        return entry is not None and entry[0] > time.time()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,73 @@
+from flask import abort, current_app, request
+
+from models import db, touch
+from projection import Projection
+
+'''
+if_match_versions()
+    the row versions the request's If-Match accepts, or None to accept
+    any (no If-Match, or If-Match: *)
+
+    row ETags are the quoted version number ("3"), as sent back by PATCH
+    and listed as `version` by the listings. With REQUIRE_IF_MATCH set,
+    a PATCH without If-Match is refused with 428.
+'''
+
+
+def if_match_versions():
+    if not request.if_match:
+        if current_app.config.get('REQUIRE_IF_MATCH', False):
+            abort(428)
+        return None
+    if request.if_match.star_tag:
+        return None
+    versions = [int(tag) for tag in request.if_match.as_set()
+                if tag.isdigit()]
+    if not versions:
+        abort(412)
+    return versions
+
+
+'''
+update_returning(model, id, values, versions)
+    applies `values` to row `id` in a single UPDATE ... WHERE id = :id
+    [AND version IN :versions] RETURNING, bumping its version, and returns
+    the updated row as model.format() would
+
+    aborts with 404 if there's no such row and 412 if its version isn't
+    one of `versions`: the row changed since the caller read it, and
+    nothing is written. Databases without UPDATE ... RETURNING (SQLite)
+    run the same UPDATE followed by a primary-key SELECT in the same
+    transaction.
+'''
+
+
+def update_returning(model, id, values, versions=None):
+    table = model.__table__
+    projection = Projection(model)
+
+    statement = table.update().where(table.c.id == id).values(
+        version=table.c.version + 1, **values)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+
+    connection = db.session.connection()
+    # set once the dialect has checked the server supports RETURNING
+    if connection.dialect.implicit_returning:
+        row = connection.execute(
+            statement.returning(*projection.columns)).first()
+    else:
+        row = None
+        if connection.execute(statement).rowcount:
+            row = projection.query().filter(model.id == id).first()
+
+    if row is None:
+        db.session.rollback()
+        exists = db.session.query(model.id).filter(
+            model.id == id).first() is not None
+        abort(412 if exists else 404)
+
+    # a Core UPDATE doesn't go through the flush events
+    touch(model)
+    db.session.commit()
+    return projection.to_dict(row)